@@ -37,6 +37,7 @@ func main() {
 	router.GET("/api/monitor/users", handlers.MonitorUsers)
 	router.GET("/api/monitor/users/list", handlers.MonitorUsersList)
 	router.GET("/api/monitor/files", handlers.MonitorFilesList)
+	router.GET("/api/monitor/files/stream", handlers.MonitorFilesStream)
 	router.GET("/api/monitor/runtime", handlers.MonitorRuntime)
 	router.GET("/api/monitor/snapshot", handlers.MonitorSnapshot)
 	router.GET("/api/monitor/all", handlers.MonitorAll)
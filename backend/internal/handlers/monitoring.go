@@ -3,6 +3,7 @@ package handlers
 import (
 	"cloudtune/internal/database"
 	"cloudtune/internal/monitoring"
+	"encoding/json"
 	"fmt"
 	"io/fs"
 	"math"
@@ -266,6 +267,68 @@ func MonitorFilesList(c *gin.Context) {
 	})
 }
 
+// MonitorFilesStream отдает все файлы uploads одним NDJSON-потоком за один обход
+// дерева, без сортировки: первая строка — {"root_path": ...}, затем по строке на файл,
+// последняя — {"total_files": N} или {"error": ...}, если обход прервался.
+func MonitorFilesStream(c *gin.Context) {
+	if !checkMonitoringToken(c) {
+		return
+	}
+
+	rootPath := filepath.Clean(resolveUploadsBasePath())
+	absRootPath, err := filepath.Abs(rootPath)
+	if err == nil {
+		rootPath = absRootPath
+	}
+
+	c.Header("Content-Type", "application/x-ndjson")
+	c.Status(http.StatusOK)
+	encoder := json.NewEncoder(c.Writer)
+	if err := encoder.Encode(gin.H{"root_path": rootPath}); err != nil {
+		return
+	}
+
+	totalFiles := 0
+	walkErr := filepath.WalkDir(rootPath, func(path string, d fs.DirEntry, walkErr error) error {
+		if walkErr != nil {
+			return fmt.Errorf("walk error at %q: %w", path, walkErr)
+		}
+		if d.IsDir() {
+			return nil
+		}
+
+		info, infoErr := d.Info()
+		if infoErr != nil {
+			return fmt.Errorf("stat error for %q: %w", path, infoErr)
+		}
+
+		relativePath, relErr := filepath.Rel(rootPath, path)
+		if relErr != nil {
+			relativePath = d.Name()
+		}
+
+		if err := encoder.Encode(monitorFileItem{
+			Name:         d.Name(),
+			RelativePath: filepath.ToSlash(relativePath),
+			SizeBytes:    info.Size(),
+			ModifiedAt:   info.ModTime().UTC(),
+		}); err != nil {
+			return err
+		}
+		totalFiles++
+		if totalFiles%1000 == 0 {
+			c.Writer.Flush()
+		}
+		return nil
+	})
+	if walkErr != nil {
+		_ = encoder.Encode(gin.H{"error": "Failed to scan files", "details": walkErr.Error()})
+	} else {
+		_ = encoder.Encode(gin.H{"total_files": totalFiles})
+	}
+	c.Writer.Flush()
+}
+
 func parsePositiveInt(raw string, fallback int) int {
 	value, err := strconv.Atoi(raw)
 	if err != nil || value <= 0 {
@@ -1,23 +1,55 @@
 import asyncio
+import base64
+import bisect
 import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
 import html
 import io
+import json
 import logging
+import math
 import os
 import re
+import signal
+import sqlite3
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
 import uuid
+import zlib
+from array import array
+from contextlib import aclosing, asynccontextmanager
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
-from typing import Any, Optional, Set, Tuple
+from typing import Any, Awaitable, Callable, Coroutine, Optional, Set, Tuple
 
 import httpx
 from dotenv import load_dotenv
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, Update
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    ReplyKeyboardMarkup,
+    Update,
+)
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
+    InlineQueryHandler,
     MessageHandler,
     filters,
 )
@@ -75,10 +107,14 @@ BACKEND_BASE_URL = os.getenv("BACKEND_BASE_URL", "http://localhost:8080").rstrip
 BACKEND_MONITORING_API_KEY = os.getenv("BACKEND_MONITORING_API_KEY", "").strip()
 REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "10"))
 BACKEND_HEALTH_PATH = os.getenv("BACKEND_HEALTH_PATH", "/health").strip() or "/health"
+BACKEND_TARGETS_RAW = os.getenv("BACKEND_TARGETS", "").strip()
+BACKEND_TARGET_NAME_RE = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
 ALERT_CHECK_INTERVAL_SECONDS = int(os.getenv("ALERT_CHECK_INTERVAL_SECONDS", "300"))
 ALERTS_ENABLED = parse_bool(os.getenv("ALERTS_ENABLED", "true"), True)
 ALERT_NOTIFY_ON_START = parse_bool(os.getenv("ALERT_NOTIFY_ON_START", "true"), True)
 ALLOWED_CHAT_IDS = parse_chat_ids(os.getenv("TELEGRAM_ALLOWED_CHAT_IDS", ""))
+# Inline-запросы приходят от пользователя без чата: отдельный список user id, пустой — запрет.
+INLINE_ALLOWED_USER_IDS = parse_chat_ids(os.getenv("INLINE_ALLOWED_USER_IDS", ""))
 ALERT_RECIPIENT_CHAT_IDS = parse_chat_ids(os.getenv("ALERT_RECIPIENT_CHAT_IDS", ""))
 USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "8"))
 DEPLOY_ENABLED = parse_bool(os.getenv("DEPLOY_ENABLED", "true"), True)
@@ -115,6 +151,200 @@ ALERT_MAX_UPLOAD_5XX_RATE_PCT = parse_float(
 )
 ALERT_MAX_UPLOAD_4XX_TOTAL = parse_int(os.getenv("ALERT_MAX_UPLOAD_4XX_TOTAL", "100"), 100)
 ALERT_MAX_UPLOAD_5XX_TOTAL = parse_int(os.getenv("ALERT_MAX_UPLOAD_5XX_TOTAL", "30"), 30)
+# Значения по умолчанию для всех backend-целей; переопределяются BACKEND_<NAME>_<ключ>.
+ALERT_THRESHOLD_DEFAULTS: dict[str, float] = {
+    "ALERT_MAX_ACTIVE_HTTP_REQUESTS": ALERT_MAX_ACTIVE_HTTP_REQUESTS,
+    "ALERT_MAX_DB_IN_USE_CONNECTIONS": ALERT_MAX_DB_IN_USE_CONNECTIONS,
+    "ALERT_MAX_GOROUTINES": ALERT_MAX_GOROUTINES,
+    "ALERT_MAX_GO_MEMORY_MB": ALERT_MAX_GO_MEMORY_MB,
+    "ALERT_MIN_UPLOADS_DISK_FREE_MB": ALERT_MIN_UPLOADS_DISK_FREE_MB,
+    "ALERT_MIN_UPLOAD_REQUESTS_FOR_RATE": ALERT_MIN_UPLOAD_REQUESTS_FOR_RATE,
+    "ALERT_MAX_UPLOAD_4XX_RATE_PCT": ALERT_MAX_UPLOAD_4XX_RATE_PCT,
+    "ALERT_MAX_UPLOAD_5XX_RATE_PCT": ALERT_MAX_UPLOAD_5XX_RATE_PCT,
+    "ALERT_MAX_UPLOAD_4XX_TOTAL": ALERT_MAX_UPLOAD_4XX_TOTAL,
+    "ALERT_MAX_UPLOAD_5XX_TOTAL": ALERT_MAX_UPLOAD_5XX_TOTAL,
+}
+DISK_FORECAST_WINDOW_HOURS = parse_int(os.getenv("DISK_FORECAST_WINDOW_HOURS", "24"), 24)
+DISK_FORECAST_ALERT_HORIZON_HOURS = parse_int(os.getenv("DISK_FORECAST_ALERT_HORIZON_HOURS", "72"), 72)
+DISK_FORECAST_MIN_POINTS = 6
+DISK_FORECAST_MIN_SPAN_SECONDS = 1800
+DISK_FORECAST_MAX_POINTS = 120
+ANOMALY_DETECTION_ENABLED = parse_bool(os.getenv("ANOMALY_DETECTION_ENABLED", "true"), True)
+ANOMALY_EWMA_ALPHA = parse_float(os.getenv("ANOMALY_EWMA_ALPHA", "0.05"), 0.05)
+ANOMALY_SEASONAL_ALPHA = parse_float(os.getenv("ANOMALY_SEASONAL_ALPHA", "0.2"), 0.2)
+ANOMALY_Z_THRESHOLD = parse_float(os.getenv("ANOMALY_Z_THRESHOLD", "4"), 4.0)
+ANOMALY_Z_CLEAR = parse_float(os.getenv("ANOMALY_Z_CLEAR", "2"), 2.0)
+ANOMALY_SUSTAIN_TICKS = parse_int(os.getenv("ANOMALY_SUSTAIN_TICKS", "3"), 3)
+ANOMALY_WARMUP_SAMPLES = parse_int(os.getenv("ANOMALY_WARMUP_SAMPLES", "288"), 288)
+ANOMALY_SEASONAL_MIN_SAMPLES = 4
+ANOMALY_METRICS = {
+    "http_active_requests": "HTTP active",
+    "db_in_use_connections": "DB in_use",
+    "goroutines": "Goroutines",
+    "go_memory_alloc_bytes": "Go alloc",
+    "go_heap_in_use_bytes": "Go heap_in_use",
+}
+LEAK_DETECTION_ENABLED = parse_bool(os.getenv("LEAK_DETECTION_ENABLED", "true"), True)
+LEAK_WINDOW_SAMPLES = parse_int(os.getenv("LEAK_WINDOW_SAMPLES", "48"), 48)
+LEAK_MK_Z_THRESHOLD = parse_float(os.getenv("LEAK_MK_Z_THRESHOLD", "2.33"), 2.33)
+LEAK_MIN_SAMPLES = 12
+LEAK_MINIMA_CHUNK = 4
+METRICS_STORE_ENABLED = parse_bool(os.getenv("METRICS_STORE_ENABLED", "true"), True)
+METRICS_DB_PATH = os.getenv(
+    "METRICS_DB_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "metrics.sqlite3"),
+).strip()
+METRICS_FLUSH_INTERVAL_SECONDS = parse_int(os.getenv("METRICS_FLUSH_INTERVAL_SECONDS", "30"), 30)
+METRICS_FLUSH_BATCH_SIZE = parse_int(os.getenv("METRICS_FLUSH_BATCH_SIZE", "50"), 50)
+METRICS_RAW_RETENTION_HOURS = parse_int(os.getenv("METRICS_RAW_RETENTION_HOURS", "48"), 48)
+# Уровни rollup: размер бакета в секундах -> срок хранения в секундах.
+METRICS_ROLLUP_TIERS = {
+    60: parse_int(os.getenv("METRICS_RETENTION_1M_DAYS", "3"), 3) * 86400,
+    3600: parse_int(os.getenv("METRICS_RETENTION_1H_DAYS", "95"), 95) * 86400,
+    86400: parse_int(os.getenv("METRICS_RETENTION_1D_DAYS", "730"), 730) * 86400,
+}
+CHART_WIDTH = parse_int(os.getenv("CHART_WIDTH", "800"), 800)
+CHART_PANEL_HEIGHT = parse_int(os.getenv("CHART_PANEL_HEIGHT", "200"), 200)
+CHART_CACHE_TTL_SECONDS = parse_int(os.getenv("CHART_CACHE_TTL_SECONDS", "60"), 60)
+CHART_CACHE_MAX_ENTRIES = 32
+CHART_MAX_METRICS = 4
+CHART_PADDING = 12
+CHART_COLORS = (
+    ("синий", (31, 119, 180)),
+    ("оранжевый", (255, 127, 14)),
+    ("зеленый", (44, 160, 44)),
+    ("красный", (214, 39, 40)),
+)
+LIVE_DEFAULT_INTERVAL_SECONDS = parse_int(os.getenv("LIVE_DEFAULT_INTERVAL_SECONDS", "30"), 30)
+LIVE_MIN_INTERVAL_SECONDS = 10
+LIVE_SESSION_TIMEOUT_SECONDS = parse_int(os.getenv("LIVE_SESSION_TIMEOUT_SECONDS", "1800"), 1800)
+LIVE_DELTA_METRICS = (
+    ("http_active_requests", "HTTP active", False),
+    ("http_total_requests", "HTTP total", False),
+    ("goroutines", "Goroutines", False),
+    ("db_in_use_connections", "DB in_use", False),
+    ("go_heap_in_use_bytes", "Go heap_in_use", True),
+    ("uploads_size_bytes", "Uploads size", True),
+    ("uploads_fs_free_bytes", "Uploads free", True),
+    ("upload_failed_total", "Upload failed", False),
+)
+MESSAGE_RENDER_FRESH_SECONDS = parse_float(os.getenv("MESSAGE_RENDER_FRESH_SECONDS", "5"), 5.0)
+MESSAGE_FINGERPRINT_MAX_ENTRIES = 1000
+REQUEST_DEBOUNCE_SECONDS = parse_float(os.getenv("REQUEST_DEBOUNCE_SECONDS", "3"), 3.0)
+PAGE_CACHE_TTL_SECONDS = parse_int(os.getenv("PAGE_CACHE_TTL_SECONDS", "60"), 60)
+PAGE_CACHE_MAX_ENTRIES = parse_int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "200"), 200)
+BOTSTATS_MAX_ROWS = 15
+UPDATE_WORKERS = max(2, parse_int(os.getenv("UPDATE_WORKERS", "8"), 8))
+UPDATE_RESERVED_WORKERS = min(
+    UPDATE_WORKERS - 1,
+    max(1, parse_int(os.getenv("UPDATE_RESERVED_WORKERS", "2"), 2)),
+)
+UPDATE_QUEUE_LIMIT = max(UPDATE_WORKERS, parse_int(os.getenv("UPDATE_QUEUE_LIMIT", "256"), 256))
+UPDATE_PRIORITY_CONTROL = 0
+UPDATE_PRIORITY_ALERTS = 1
+UPDATE_PRIORITY_BROWSING = 2
+UPDATE_PRIORITY_NAMES = ("control", "alerts", "browsing")
+CONTROL_COMMANDS = frozenset({"deploy", "delete_user", "purge_all_users"})
+ALERT_COMMANDS = frozenset({"start", "help", "status", "snapshot", "live", "botstats"})
+# Browsing-команды с тяжелым запросом/рендером: не выстраиваются в очередь чата,
+# чтобы не держать остальные кнопки. /export и /reconcile и так уходят в фоновую задачу.
+PARALLEL_COMMANDS = frozenset({"top_users", "chart"})
+METRICS_EXPORTER_ENABLED = parse_bool(os.getenv("METRICS_EXPORTER_ENABLED", "false"), False)
+METRICS_EXPORTER_HOST = os.getenv("METRICS_EXPORTER_HOST", "127.0.0.1").strip() or "127.0.0.1"
+METRICS_EXPORTER_PORT = parse_int(os.getenv("METRICS_EXPORTER_PORT", "9464"), 9464)
+METRICS_EXPORTER_CACHE_SECONDS = parse_float(os.getenv("METRICS_EXPORTER_CACHE_SECONDS", "5"), 5.0)
+METRICS_EXPORTER_QUANTILES = (0.5, 0.95, 0.99)
+# Тип семейства задается явно по ключу снимка: суффикс _total в backend не означает
+# монотонность (users_total падает при удалении), а http_total_requests — счетчик.
+BACKEND_OPENMETRICS_COUNTERS = {
+    "http_total_requests": "http_requests",
+    "db_wait_count": "db_waits",
+    "go_gc_count": "go_gc_cycles",
+    "upload_requests_total": "upload_requests",
+    "upload_failed_total": "upload_failed",
+    "upload_bytes_in_total": "upload_bytes_in",
+    "upload_4xx_total": "upload_4xx",
+    "upload_5xx_total": "upload_5xx",
+}
+BACKEND_OPENMETRICS_GAUGES = {
+    "users_total": "users",
+    "songs_total": "songs",
+    "playlists_total": "playlists",
+    "songs_total_size_bytes": "songs_size_bytes",
+    "uploads_fs_total_bytes": "uploads_fs_size_bytes",
+}
+HTTP_READ_TIMEOUT_SECONDS = 10
+WEBHOOK_ENABLED = parse_bool(os.getenv("WEBHOOK_ENABLED", "false"), False)
+WEBHOOK_LISTEN_HOST = os.getenv("WEBHOOK_LISTEN_HOST", "127.0.0.1").strip() or "127.0.0.1"
+WEBHOOK_LISTEN_PORT = parse_int(os.getenv("WEBHOOK_LISTEN_PORT", "8081"), 8081)
+WEBHOOK_PATH = "/" + (os.getenv("WEBHOOK_PATH", "/telegram/webhook").strip().strip("/") or "telegram/webhook")
+WEBHOOK_PUBLIC_URL = os.getenv("WEBHOOK_PUBLIC_URL", "").strip()
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "").strip()
+WEBHOOK_MAX_CONNECTIONS = parse_int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"), 40)
+WEBHOOK_MAX_BODY_BYTES = 1024 * 1024
+WEBHOOK_SECRET_RE = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+USER_CACHE_TTL_SECONDS = parse_int(os.getenv("USER_CACHE_TTL_SECONDS", "120"), 120)
+USER_CACHE_MAX_ENTRIES = parse_int(os.getenv("USER_CACHE_MAX_ENTRIES", "256"), 256)
+PREFETCH_MAX_PER_CHAT = parse_int(os.getenv("PREFETCH_MAX_PER_CHAT", "2"), 2)
+EMAIL_INDEX_ENABLED = parse_bool(os.getenv("EMAIL_INDEX_ENABLED", "true"), True)
+EMAIL_INDEX_REFRESH_SECONDS = parse_int(os.getenv("EMAIL_INDEX_REFRESH_SECONDS", "60"), 60)
+EMAIL_INDEX_FULL_REBUILD_SECONDS = parse_int(os.getenv("EMAIL_INDEX_FULL_REBUILD_SECONDS", "21600"), 21600)
+EMAIL_INDEX_BATCH_SIZE = 20000
+EMAIL_INDEX_MERGE_THRESHOLD = 2000
+FIND_RESULTS_LIMIT = 10
+INLINE_RESULTS_LIMIT = 20
+PURGE_BATCH_SIZE = parse_int(os.getenv("PURGE_BATCH_SIZE", "200"), 200)
+PURGE_CONCURRENCY = parse_int(os.getenv("PURGE_CONCURRENCY", "4"), 4)
+PURGE_MAX_DB_IN_USE_CONNECTIONS = parse_int(
+    os.getenv("PURGE_MAX_DB_IN_USE_CONNECTIONS", str(max(ALERT_MAX_DB_IN_USE_CONNECTIONS // 2, 1))),
+    max(ALERT_MAX_DB_IN_USE_CONNECTIONS // 2, 1),
+)
+PURGE_THROTTLE_SECONDS = parse_int(os.getenv("PURGE_THROTTLE_SECONDS", "10"), 10)
+PURGE_PROGRESS_INTERVAL_SECONDS = parse_float(os.getenv("PURGE_PROGRESS_INTERVAL_SECONDS", "5"), 5.0)
+PURGE_CHECKPOINT_PATH = os.getenv(
+    "PURGE_CHECKPOINT_PATH",
+    os.path.join(os.path.dirname(METRICS_DB_PATH), "purge_checkpoint.json"),
+).strip()
+PURGE_FAILURE_PREVIEW = 3
+BULK_DELETE_CALLBACK_PREFIX = "bulk_delete:"
+BULK_DELETE_MAX_FILE_BYTES = parse_int(os.getenv("BULK_DELETE_MAX_FILE_BYTES", str(1024 * 1024)), 1024 * 1024)
+BULK_DELETE_MAX_EMAILS = parse_int(os.getenv("BULK_DELETE_MAX_EMAILS", "5000"), 5000)
+BULK_DELETE_CONCURRENCY = parse_int(os.getenv("BULK_DELETE_CONCURRENCY", "4"), 4)
+BACKEND_MAX_CONCURRENCY = max(1, parse_int(os.getenv("BACKEND_MAX_CONCURRENCY", "8"), 8))
+DB_MAX_CONCURRENCY = max(1, parse_int(os.getenv("DB_MAX_CONCURRENCY", "4"), 4))
+CIRCUIT_FAILURE_THRESHOLD = max(1, parse_int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"), 5))
+CIRCUIT_OPEN_SECONDS = max(1.0, parse_float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"), 30.0))
+BACKEND_LAST_KNOWN_MAX_ENTRIES = 128
+BULK_DELETE_RETRIES = parse_int(os.getenv("BULK_DELETE_RETRIES", "3"), 3)
+BULK_DELETE_RETRY_BASE_SECONDS = 1.0
+BULK_DELETE_PENDING_TTL_SECONDS = 900
+BULK_DELETE_PROGRESS_INTERVAL_SECONDS = 5
+BULK_DELETE_FAILURE_PREVIEW = 5
+# Списком email считаются только текстовые документы; остальные файлы бот игнорирует.
+BULK_DELETE_DOCUMENT_FILTER = (
+    filters.Document.MimeType("text/plain")
+    | filters.Document.MimeType("text/csv")
+    | filters.Document.FileExtension("csv")
+    | filters.Document.FileExtension("txt")
+)
+EMAIL_LIST_SPLIT_RE = re.compile(r"[\s,;]+")
+BOT_STATE_ENABLED = parse_bool(os.getenv("BOT_STATE_ENABLED", "true"), True)
+BOT_STATE_PATH = os.getenv(
+    "BOT_STATE_PATH",
+    os.path.join(os.path.dirname(METRICS_DB_PATH), "bot_state.sqlite3"),
+).strip()
+BOT_STATE_FLUSH_INTERVAL_SECONDS = parse_int(os.getenv("BOT_STATE_FLUSH_INTERVAL_SECONDS", "5"), 5)
+EXPORT_SPOOL_MAX_BYTES = parse_int(os.getenv("EXPORT_SPOOL_MAX_BYTES", str(8 * 1024 * 1024)), 8 * 1024 * 1024)
+EXPORT_MAX_DOCUMENT_BYTES = parse_int(
+    os.getenv("EXPORT_MAX_DOCUMENT_BYTES", str(50 * 1024 * 1024)),
+    50 * 1024 * 1024,
+)
+EXPORT_PROGRESS_INTERVAL_SECONDS = parse_float(os.getenv("EXPORT_PROGRESS_INTERVAL_SECONDS", "5"), 5.0)
+EXPORT_READ_CHUNK_BYTES = 64 * 1024
+EXPORT_UPLOAD_TIMEOUT_SECONDS = 300
+EXPORT_KINDS = ("users", "tracks", "playlists")
+EXPORT_FORMATS = ("csv", "jsonl")
 DEPLOY_OUTPUT_CHUNK_SIZE = parse_int(os.getenv("DEPLOY_OUTPUT_CHUNK_SIZE", "3000"), 3000)
 DEPLOY_OUTPUT_MAX_CHUNKS = parse_int(os.getenv("DEPLOY_OUTPUT_MAX_CHUNKS", "20"), 20)
 
@@ -159,21 +389,41 @@ USER_TRACKS_PAGE_SIZE = 5
 USER_PLAYLISTS_PAGE_SIZE = 5
 SERVER_FILES_PAGE_SIZE = 10
 USER_SESSION_TTL_SECONDS = parse_int(os.getenv("USER_SESSION_TTL_SECONDS", "3600"), 3600)
-USER_SESSION_CLEANUP_INTERVAL_SECONDS = parse_int(
-    os.getenv("USER_SESSION_CLEANUP_INTERVAL_SECONDS", "300"),
-    300,
+USER_CALLBACK_SECRET = os.getenv("USER_CALLBACK_SECRET", "").strip()
+USER_CALLBACK_VIEWS = ("home", "about", "files", "tracks", "playlists", "playlist_items")
+USER_CALLBACK_MAC_BYTES = 8
+USER_CALLBACK_EXPIRY_STEP_SECONDS = 300
+# view, user_id, expires_at (unix seconds), page — 15 байт + 8 байт HMAC = 32 символа base64url.
+USER_CALLBACK_STRUCT = struct.Struct(">BQIH")
+RECONCILE_DB_BATCH_SIZE = parse_int(os.getenv("RECONCILE_DB_BATCH_SIZE", "5000"), 5000)
+RECONCILE_SAMPLE_SIZE = 5
+TOP_USERS_DEFAULT_LIMIT = 10
+TOP_USERS_MAX_LIMIT = 50
+TOP_USERS_CACHE_TTL_SECONDS = parse_int(os.getenv("TOP_USERS_CACHE_TTL_SECONDS", "300"), 300)
+TOP_USERS_SAMPLE_INTERVAL_SECONDS = parse_int(
+    os.getenv("TOP_USERS_SAMPLE_INTERVAL_SECONDS", "3600"),
+    3600,
 )
-USER_SESSION_MAX_ENTRIES = parse_int(os.getenv("USER_SESSION_MAX_ENTRIES", "2000"), 2000)
+TOP_USERS_SAMPLE_RETENTION_SECONDS = 8 * 24 * 3600
+TOP_USERS_GROWTH_WINDOWS = {"day": 24 * 3600, "week": 7 * 24 * 3600}
 DB_CONTAINER_NAME = os.getenv("DB_CONTAINER_NAME", "cloudtune-db").strip() or "cloudtune-db"
 DB_NAME = os.getenv("DB_NAME", "cloudtune").strip() or "cloudtune"
 DB_USER = os.getenv("DB_USER", "cloudtune").strip() or "cloudtune"
 EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+# Логарифмические бакеты гистограмм задержек: от 0.05 мс до 10 мин с шагом 8%.
+LATENCY_MIN_MS = 0.05
+LATENCY_GROWTH = 1.08
+LATENCY_BUCKETS = math.ceil(math.log(600_000 / LATENCY_MIN_MS) / math.log(LATENCY_GROWTH)) + 1
 
 
 def is_chat_allowed(chat_id: int) -> bool:
     return not ALLOWED_CHAT_IDS or chat_id in ALLOWED_CHAT_IDS
 
 
+def is_inline_user_allowed(user_id: int) -> bool:
+    return user_id in INLINE_ALLOWED_USER_IDS
+
+
 def is_deploy_chat_allowed(chat_id: int) -> bool:
     allowed = DEPLOY_ALLOWED_CHAT_IDS or ALLOWED_CHAT_IDS
     return not allowed or chat_id in allowed
@@ -181,7 +431,9 @@ def is_deploy_chat_allowed(chat_id: int) -> bool:
 
 def register_runtime_chat(application: Application, chat_id: int) -> None:
     runtime_chat_ids = application.bot_data.setdefault("runtime_chat_ids", set())
-    runtime_chat_ids.add(chat_id)
+    if chat_id not in runtime_chat_ids:
+        runtime_chat_ids.add(chat_id)
+        mark_state_dirty(application, "runtime_chat_ids")
 
 
 def resolve_alert_recipients(application: Application) -> Set[int]:
@@ -192,43 +444,551 @@ def resolve_alert_recipients(application: Application) -> Set[int]:
     return set(application.bot_data.get("runtime_chat_ids", set()))
 
 
-async def fetch_monitoring_json(path: str, params: Optional[dict[str, Any]] = None) -> dict[str, Any]:
-    url = f"{BACKEND_BASE_URL}{path}"
-    headers = {"X-Monitoring-Key": BACKEND_MONITORING_API_KEY}
+class LatencyHistogram:
+    # Фиксированный набор счетчиков на метрику (HDR-подобно): память не растет с числом
+    # замеров, перцентиль считается с относительной погрешностью не больше шага бакета.
 
-    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-        response = await client.get(url, headers=headers, params=params)
+    __slots__ = ("counts", "count", "errors", "total_ms", "max_ms")
+
+    def __init__(self) -> None:
+        self.counts = array("I", bytes(4 * LATENCY_BUCKETS))
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms: float, error: bool = False) -> None:
+        if elapsed_ms <= LATENCY_MIN_MS:
+            idx = 0
+        else:
+            idx = int(math.log(elapsed_ms / LATENCY_MIN_MS) / math.log(LATENCY_GROWTH))
+            idx = min(idx, LATENCY_BUCKETS - 1)
+        self.counts[idx] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        if error:
+            self.errors += 1
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        target = max(math.ceil(q * self.count), 1)
+        seen = 0
+        for idx, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(LATENCY_MIN_MS * LATENCY_GROWTH ** (idx + 1), self.max_ms)
+        return self.max_ms
+
+
+LATENCY_HISTOGRAMS: dict[str, LatencyHistogram] = {}
+
+
+def record_latency(name: str, elapsed_ms: float, error: bool = False) -> None:
+    histogram = LATENCY_HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = LATENCY_HISTOGRAMS[name] = LatencyHistogram()
+    histogram.record(elapsed_ms, error)
+
+
+def timed(
+    name: str,
+    label: Optional[Callable[..., str]] = None,
+) -> Callable[[Callable[..., Awaitable[Any]]], Any]:
+    def decorator(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            metric = f"{name} {label(*args, **kwargs)}".rstrip() if label is not None else name
+            started = time.perf_counter()
+            error = False
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                record_latency(metric, (time.perf_counter() - started) * 1000, error)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_handlers(application: Application) -> None:
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            name = getattr(handler.callback, "__name__", type(handler).__name__)
+            handler.callback = timed(f"handler {name}")(handler.callback)
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    # Все исходящие вызовы Bot API (send/edit/answer...) с разбивкой по методу.
+
+    async def do_request(self, url: str, method: str, *args: Any, **kwargs: Any) -> tuple[int, bytes]:
+        started = time.perf_counter()
+        status = 0
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+            return status, payload
+        finally:
+            record_latency(
+                f"telegram {url.rsplit('/', 1)[-1]}",
+                (time.perf_counter() - started) * 1000,
+                not 200 <= status < 300,
+            )
+
+
+def update_command(update: object) -> Optional[str]:
+    if not isinstance(update, Update) or update.message is None:
+        return None
+    text = (update.message.text or "").strip()
+    if not text.startswith("/"):
+        return None
+    return text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower() if len(text) > 1 else ""
+
+
+def classify_update(update: object) -> int:
+    if not isinstance(update, Update):
+        return UPDATE_PRIORITY_BROWSING
+    query = update.callback_query
+    if query is not None:
+        if (query.data or "").startswith(BULK_DELETE_CALLBACK_PREFIX):
+            return UPDATE_PRIORITY_CONTROL
+        return UPDATE_PRIORITY_BROWSING
+    message = update.message
+    if message is None:
+        return UPDATE_PRIORITY_BROWSING
+    if message.document is not None and BULK_DELETE_DOCUMENT_FILTER.check_update(update):
+        return UPDATE_PRIORITY_CONTROL
+    text = (message.text or "").strip()
+    command = update_command(update)
+    if command is not None:
+        if command in CONTROL_COMMANDS:
+            return UPDATE_PRIORITY_CONTROL
+        if command in ALERT_COMMANDS:
+            return UPDATE_PRIORITY_ALERTS
+        return UPDATE_PRIORITY_BROWSING
+    if text == MENU_BUTTON_DEPLOY:
+        return UPDATE_PRIORITY_CONTROL
+    if text in (MENU_BUTTON_STATUS, MENU_BUTTON_SNAPSHOT, MENU_BUTTON_HELP):
+        return UPDATE_PRIORITY_ALERTS
+    return UPDATE_PRIORITY_BROWSING
+
+
+class PrioritizedUpdateProcessor(BaseUpdateProcessor):
+    # Ограниченный пул обработчиков вместо concurrent_updates(True).
+    # max_concurrent_updates базового класса ограничивает только число апдейтов в очереди;
+    # реально одновременно выполняются не больше workers, причем browsing никогда не занимает
+    # последние reserved слотов — деплой/удаление и /status проходят даже при забитом пуле.
+    # Browsing-апдейты одного чата (кроме PARALLEL_COMMANDS) выполняются строго по очереди,
+    # а повторный клик по той же кнопке, пока первый еще ждет в очереди, отбрасывается.
+
+    def __init__(self, workers: int, reserved_workers: int, queue_limit: int) -> None:
+        super().__init__(queue_limit)
+        self.workers = workers
+        self.browsing_workers = workers - reserved_workers
+        self.active = 0
+        self.active_browsing = 0
+        self.busy_chats: set[int] = set()
+        self.pending: list[tuple[int, int, Optional[int], asyncio.Future]] = []
+        self.pending_clicks: set[tuple[int, int, str]] = set()
+        self.sequence = 0
+        self.coalesced = 0
+        self.processed = [0, 0, 0]
+
+    async def initialize(self) -> None:
+        return None
+
+    async def shutdown(self) -> None:
+        for _, _, _, waiter in self.pending:
+            if not waiter.done():
+                waiter.cancel()
+        self.pending.clear()
+        self.pending_clicks.clear()
+
+    @staticmethod
+    def click_key(update: object) -> Optional[tuple[int, int, str]]:
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        query = update.callback_query
+        message = query.message
+        if message is None or query.data is None:
+            return None
+        return message.chat.id, message.message_id, query.data
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        priority = classify_update(update)
+        chat_id: Optional[int] = None
+        if (
+            priority == UPDATE_PRIORITY_BROWSING
+            and isinstance(update, Update)
+            and update_command(update) not in PARALLEL_COMMANDS
+        ):
+            if update.effective_chat is not None:
+                chat_id = update.effective_chat.id
+            elif update.effective_user is not None:
+                chat_id = update.effective_user.id
+
+        click = self.click_key(update)
+        if click is not None and click in self.pending_clicks:
+            self.coalesced += 1
+            coroutine.close()  # type: ignore[attr-defined]
+            try:
+                await update.callback_query.answer()  # type: ignore[union-attr]
+            except Exception:
+                pass
+            return
+
+        waiter: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        heapq.heappush(self.pending, (priority, self.sequence, chat_id, waiter))
+        if click is not None:
+            self.pending_clicks.add(click)
+        self.dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(priority, chat_id)
+            else:
+                waiter.cancel()
+                self.dispatch()
+            coroutine.close()  # type: ignore[attr-defined]
+            raise
+        finally:
+            if click is not None:
+                self.pending_clicks.discard(click)
+
+        self.processed[priority] += 1
+        try:
+            await coroutine
+        finally:
+            self.release(priority, chat_id)
+
+    def release(self, priority: int, chat_id: Optional[int]) -> None:
+        self.active -= 1
+        if priority == UPDATE_PRIORITY_BROWSING:
+            self.active_browsing -= 1
+        if chat_id is not None:
+            self.busy_chats.discard(chat_id)
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        # Кучу перебираем по приоритету; пропущенные (чат занят, нет слота для browsing)
+        # возвращаются обратно. Очередь ограничена queue_limit, так что перебор дешевый.
+        skipped = []
+        while self.pending and self.active < self.workers:
+            entry = heapq.heappop(self.pending)
+            priority, _, chat_id, waiter = entry
+            if waiter.done():
+                continue
+            if priority == UPDATE_PRIORITY_BROWSING:
+                if self.active_browsing >= self.browsing_workers:
+                    skipped.append(entry)
+                    break
+                if chat_id is not None and chat_id in self.busy_chats:
+                    skipped.append(entry)
+                    continue
+                self.active_browsing += 1
+                if chat_id is not None:
+                    self.busy_chats.add(chat_id)
+            self.active += 1
+            waiter.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self.pending, entry)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "active": self.active,
+            "queued": sum(1 for entry in self.pending if not entry[3].done()),
+            "coalesced": self.coalesced,
+            "processed": dict(zip(UPDATE_PRIORITY_NAMES, self.processed)),
+        }
+
+
+class BackendHTTPError(RuntimeError):
+    def __init__(self, status_code: int, body: str) -> None:
+        super().__init__(f"Backend вернул {status_code}: {body}")
+        self.status_code = status_code
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class DBQueryError(RuntimeError):
+    def __init__(self, message: str, stderr: str) -> None:
+        super().__init__(message)
+        self.stderr = stderr
+
+
+def is_db_unavailable_error(exc: BaseException) -> bool:
+    # Ошибка самого запроса (psql печатает "ERROR: ...") не значит, что БД недоступна;
+    # сбой подключения, FATAL, ошибки docker и таймауты выражений — значат.
+    if not isinstance(exc, DBQueryError):
+        return True
+    stderr = exc.stderr.lstrip()
+    return not stderr.startswith("ERROR:") or "statement timeout" in stderr
+
+
+def is_transient_backend_error(exc: BaseException) -> bool:
+    if isinstance(exc, (httpx.TransportError, CircuitOpenError)):
+        return True
+    return isinstance(exc, BackendHTTPError) and (exc.status_code >= 500 or exc.status_code == 429)
+
+
+class DependencyGuard:
+    # Общий для всех хендлеров и фоновых задач лимит одновременных вызовов зависимости
+    # плюс circuit breaker: после CIRCUIT_FAILURE_THRESHOLD сбоев подряд вызовы сразу
+    # падают с CircuitOpenError, через CIRCUIT_OPEN_SECONDS (или после успешного /health)
+    # пропускается один пробный вызов — успех закрывает цепь, сбой снова открывает.
+
+    def __init__(self, name: str, limit: int) -> None:
+        self.name = name
+        self.limit = limit
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.in_flight = 0
+        self.rejected = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def retry_in(self) -> float:
+        return max(CIRCUIT_OPEN_SECONDS - (time.monotonic() - self.opened_at), 0.0)
+
+    def reject(self) -> CircuitOpenError:
+        self.rejected += 1
+        return CircuitOpenError(f"{self.name} недоступен, повтор через {self.retry_in():.0f} с")
+
+    def admit(self) -> bool:
+        if self.state == "open":
+            if self.retry_in() > 0:
+                raise self.reject()
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                raise self.reject()
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def record(self, ok: bool, probe: bool = False) -> None:
+        if probe:
+            self.probe_in_flight = False
+        if ok:
+            if self.state != "closed":
+                logger.info("%s: circuit breaker закрыт", self.name)
+            self.state = "closed"
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            if self.state != "open":
+                logger.warning("%s: circuit breaker открыт после %s сбоев", self.name, self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def observe_health(self, ok: bool) -> None:
+        if not ok:
+            self.record(False)
+        elif self.state == "open":
+            # Backend снова отвечает на /health — не ждем конца таймаута, пускаем пробу.
+            self.state = "half_open"
+
+    @asynccontextmanager
+    async def call(self, is_failure: Callable[[BaseException], bool] = lambda exc: True):
+        if self.state == "open" and self.retry_in() > 0:
+            raise self.reject()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        async with self._semaphore:
+            probe = self.admit()
+            self.in_flight += 1
+            try:
+                yield
+            except Exception as exc:
+                self.record(not is_failure(exc), probe)
+                raise
+            except BaseException:
+                # Отмена или закрытие генератора — о здоровье зависимости ничего не говорит.
+                if probe:
+                    self.probe_in_flight = False
+                raise
+            else:
+                self.record(True, probe)
+            finally:
+                self.in_flight -= 1
+
+
+class BackendTarget:
+    # Один экземпляр backend: свой URL, ключ Monitoring API, пороги алертов и circuit breaker.
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        api_key: str,
+        thresholds: dict[str, float],
+        guard_name: str,
+    ) -> None:
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.thresholds = thresholds
+        self.guard = DependencyGuard(guard_name, BACKEND_MAX_CONCURRENCY)
+
+
+def parse_backend_targets(raw: str) -> tuple[list[BackendTarget], list[str]]:
+    # BACKEND_TARGETS="prod=https://api.example.com,staging=http://10.0.0.5:8080".
+    # Пусто — одна цель "main" из BACKEND_BASE_URL/BACKEND_MONITORING_API_KEY, как раньше.
+    entries: list[tuple[str, str]] = []
+    invalid: list[str] = []
+    for chunk in re.split(r"[,\s]+", raw):
+        if not chunk:
+            continue
+        name, _, url = chunk.partition("=")
+        name = name.strip().lower()
+        url = url.strip()
+        if not BACKEND_TARGET_NAME_RE.match(name) or not url.startswith(("http://", "https://")):
+            invalid.append(chunk)
+            continue
+        entries.append((name, url))
+    if not entries:
+        entries = [("main", BACKEND_BASE_URL)]
+
+    targets = []
+    for name, url in entries:
+        env_prefix = f"BACKEND_{name.upper().replace('-', '_')}_"
+        thresholds: dict[str, float] = {}
+        for key, default in ALERT_THRESHOLD_DEFAULTS.items():
+            override = os.getenv(env_prefix + key, "")
+            if isinstance(default, int):
+                thresholds[key] = parse_int(override, default) if override else default
+            else:
+                thresholds[key] = parse_float(override, default) if override else default
+        api_key = os.getenv(env_prefix + "MONITORING_API_KEY", "").strip() or BACKEND_MONITORING_API_KEY
+        guard_name = "Backend" if len(entries) == 1 else f"Backend {name}"
+        targets.append(BackendTarget(name, url, api_key, thresholds, guard_name))
+    return targets, invalid
+
+
+class SharedHTTPClient:
+    # Один httpx.AsyncClient с пулом keep-alive соединений на все цели и все вызовы;
+    # создается лениво в работающем event loop и закрывается в on_shutdown.
+
+    def __init__(self) -> None:
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def get(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            pool_size = BACKEND_MAX_CONCURRENCY * len(BACKEND_TARGETS) + len(BACKEND_TARGETS)
+            self._client = httpx.AsyncClient(
+                timeout=REQUEST_TIMEOUT,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+BACKEND_TARGETS, BACKEND_TARGETS_INVALID = parse_backend_targets(BACKEND_TARGETS_RAW)
+PRIMARY_TARGET = BACKEND_TARGETS[0]
+BACKEND_HTTP = SharedHTTPClient()
+DB_GUARD = DependencyGuard("БД", DB_MAX_CONCURRENCY)
+BACKEND_LAST_KNOWN: OrderedDict[tuple[str, str, str], tuple[float, dict[str, Any]]] = OrderedDict()
+
+
+def find_backend_target(name: str) -> Optional[BackendTarget]:
+    name = name.strip().lower()
+    return next((target for target in BACKEND_TARGETS if target.name == name), None)
 
-    if response.status_code != 200:
-        raise RuntimeError(f"Backend вернул {response.status_code}: {response.text}")
+
+def is_multi_target() -> bool:
+    return len(BACKEND_TARGETS) > 1
+
+
+def format_target_line(target: BackendTarget) -> str:
+    # С одной целью сообщения остаются прежними; с несколькими — всегда называем узел.
+    return f"🖥️ Узел: <code>{html.escape(target.name)}</code>\n" if is_multi_target() else ""
+
+
+def backend_latency_label(path: str, *args: Any, target: Optional[BackendTarget] = None, **kwargs: Any) -> str:
+    return f"{path} @{target.name}" if target is not None and is_multi_target() else path
+
+
+@timed("backend", label=backend_latency_label)
+async def fetch_monitoring_json(
+    path: str,
+    params: Optional[dict[str, Any]] = None,
+    allow_stale: bool = True,
+    target: Optional[BackendTarget] = None,
+) -> dict[str, Any]:
+    # При открытом circuit breaker отдаем последний успешный ответ с пометкой stale_at
+    # вместо ожидания таймаутов; фоновые задачи (watchdog, live) передают allow_stale=False.
+    target = target or PRIMARY_TARGET
+    url = f"{target.base_url}{path}"
+    headers = {"X-Monitoring-Key": target.api_key}
+    cache_key = (target.name, path, json.dumps(params or {}, sort_keys=True, default=str))
+
+    try:
+        async with target.guard.call(is_transient_backend_error):
+            response = await BACKEND_HTTP.get().get(url, headers=headers, params=params)
+            if response.status_code != 200:
+                raise BackendHTTPError(response.status_code, response.text)
+    except CircuitOpenError:
+        cached = BACKEND_LAST_KNOWN.get(cache_key)
+        if not allow_stale or cached is None:
+            raise
+        return {**cached[1], "stale_at": cached[0]}
 
     payload = response.json()
     if not isinstance(payload, dict):
         raise RuntimeError("Некорректный формат ответа backend")
+    BACKEND_LAST_KNOWN[cache_key] = (now_utc_ts(), payload)
+    BACKEND_LAST_KNOWN.move_to_end(cache_key)
+    while len(BACKEND_LAST_KNOWN) > BACKEND_LAST_KNOWN_MAX_ENTRIES:
+        BACKEND_LAST_KNOWN.popitem(last=False)
     return payload
 
 
-async def fetch_monitoring_text(path: str) -> str:
-    payload = await fetch_monitoring_json(path)
+def format_stale_notice(payload: dict[str, Any]) -> str:
+    stale_at = payload.get("stale_at")
+    if not stale_at:
+        return ""
+    stamp = datetime.fromtimestamp(float(stale_at), timezone.utc).strftime("%H:%M:%S UTC")
+    return f"⚠️ Backend недоступен, показаны последние данные от {stamp}"
+
+
+async def fetch_monitoring_text(path: str, target: Optional[BackendTarget] = None) -> str:
+    payload = await fetch_monitoring_json(path, target=target)
     text = payload.get("text")
     if not isinstance(text, str):
         raise RuntimeError("Некорректный формат ответа backend")
-    return text
+    notice = format_stale_notice(payload)
+    return f"{notice}\n\n{text}" if notice else text
 
 
+@timed("backend /api/monitor/users/delete")
 async def delete_user_profile_by_email(email: str) -> dict[str, Any]:
     normalized_email = email.strip().lower()
     if not normalized_email:
         raise RuntimeError("Email не задан")
 
-    url = f"{BACKEND_BASE_URL}/api/monitor/users/delete"
-    headers = {"X-Monitoring-Key": BACKEND_MONITORING_API_KEY}
+    # Пользователи и файлы живут на основной цели (первой в BACKEND_TARGETS).
+    url = f"{PRIMARY_TARGET.base_url}/api/monitor/users/delete"
+    headers = {"X-Monitoring-Key": PRIMARY_TARGET.api_key}
 
-    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-        response = await client.delete(url, headers=headers, params={"email": normalized_email})
+    async with PRIMARY_TARGET.guard.call(is_transient_backend_error):
+        response = await BACKEND_HTTP.get().delete(url, headers=headers, params={"email": normalized_email})
 
     if response.status_code != 200:
-        raise RuntimeError(f"Backend вернул {response.status_code}: {response.text}")
+        raise BackendHTTPError(response.status_code, response.text)
 
     payload = response.json()
     if not isinstance(payload, dict):
@@ -236,20 +996,41 @@ async def delete_user_profile_by_email(email: str) -> dict[str, Any]:
     return payload
 
 
-async def purge_all_users_via_api() -> dict[str, Any]:
-    url = f"{BACKEND_BASE_URL}/api/monitor/users/purge-all"
-    headers = {"X-Monitoring-Key": BACKEND_MONITORING_API_KEY}
-
-    async with httpx.AsyncClient(timeout=max(REQUEST_TIMEOUT, 120)) as client:
-        response = await client.delete(url, headers=headers)
+async def delete_user_with_retry(email: str, retries: int) -> dict[str, Any]:
+    attempt = 0
+    while True:
+        try:
+            return await delete_user_profile_by_email(email)
+        except Exception as exc:
+            if attempt >= retries or not is_transient_backend_error(exc):
+                raise
+            delay = BULK_DELETE_RETRY_BASE_SECONDS * (2**attempt)
+            attempt += 1
+            logger.warning("Повтор удаления %s через %.0f с (%s/%s): %s", email, delay, attempt, retries, exc)
+            await asyncio.sleep(delay)
+
+
+async def run_delete_pool(
+    emails: list[str],
+    concurrency: int,
+    on_result: Callable[[str, Optional[dict[str, Any]], Optional[Exception]], None],
+    retries: int = BULK_DELETE_RETRIES,
+) -> None:
+    # Фиксированное число воркеров разбирает общий итератор: одновременно в backend
+    # уходит не больше concurrency запросов, задачи на каждый email не создаются.
+    pending = iter(emails)
 
-    if response.status_code != 200:
-        raise RuntimeError(f"Backend вернул {response.status_code}: {response.text}")
+    async def worker() -> None:
+        for email in pending:
+            try:
+                payload = await delete_user_with_retry(email, retries)
+            except Exception as exc:
+                on_result(email, None, exc)
+                continue
+            on_result(email, payload, None)
 
-    payload = response.json()
-    if not isinstance(payload, dict):
-        raise RuntimeError("Некорректный формат ответа backend")
-    return payload
+    workers = max(1, min(concurrency, len(emails)))
+    await asyncio.gather(*(worker() for _ in range(workers)))
 
 
 async def fetch_server_files_page(page: int, limit: int = SERVER_FILES_PAGE_SIZE) -> dict[str, Any]:
@@ -259,8 +1040,47 @@ async def fetch_server_files_page(page: int, limit: int = SERVER_FILES_PAGE_SIZE
     )
 
 
-async def fetch_snapshot() -> dict[str, Any]:
-    return await fetch_monitoring_json("/api/monitor/snapshot")
+async def iter_server_files():
+    # Весь список uploads одним NDJSON-потоком: backend обходит дерево один раз, а не на
+    # каждую страницу /api/monitor/files. Первая строка — root_path, последняя — итог.
+    url = f"{PRIMARY_TARGET.base_url}/api/monitor/files/stream"
+    headers = {"X-Monitoring-Key": PRIMARY_TARGET.api_key}
+    client = BACKEND_HTTP.get()
+    # Guard (слот backend и circuit breaker) держим только на открытие потока: чтение
+    # идет столько, сколько backend обходит дерево, и ограничено таймаутом чтения клиента.
+    async with PRIMARY_TARGET.guard.call(is_transient_backend_error):
+        response = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+        if response.status_code != 200:
+            await response.aread()
+            await response.aclose()
+            raise BackendHTTPError(response.status_code, response.text)
+    try:
+        finished = False
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not isinstance(item, dict):
+                raise RuntimeError("Некорректный формат ответа backend")
+            if "error" in item:
+                raise RuntimeError(f"Backend: {item.get('error')}: {item.get('details', '')}")
+            finished = finished or "total_files" in item
+            yield item
+        if not finished:
+            raise RuntimeError("Поток файлов backend оборвался")
+    finally:
+        await response.aclose()
+
+
+async def fetch_users_page(page: int) -> dict[str, Any]:
+    return await fetch_monitoring_json(
+        "/api/monitor/users/list",
+        params={"page": max(page, 1), "limit": max(USERS_PAGE_SIZE, 1)},
+    )
+
+
+async def fetch_snapshot(allow_stale: bool = True, target: Optional[BackendTarget] = None) -> dict[str, Any]:
+    return await fetch_monitoring_json("/api/monitor/snapshot", allow_stale=allow_stale, target=target)
 
 
 def looks_like_email(value: str) -> bool:
@@ -271,32 +1091,33 @@ def _sql_quote(value: str) -> str:
     return value.replace("'", "''")
 
 
+@timed("db query")
 async def run_db_query(sql: str) -> list[dict[str, str]]:
-    process = await asyncio.create_subprocess_exec(
-        "docker",
-        "exec",
-        "-i",
-        DB_CONTAINER_NAME,
-        "psql",
-        "-U",
-        DB_USER,
-        "-d",
-        DB_NAME,
-        "--csv",
-        "-v",
-        "ON_ERROR_STOP=1",
-        "-P",
-        "pager=off",
-        "-c",
-        sql,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    stdout, stderr = await process.communicate()
-    if process.returncode != 0:
-        raise RuntimeError(
-            f"DB query failed ({process.returncode}): {stderr.decode('utf-8', errors='replace').strip()}"
+    async with DB_GUARD.call(is_db_unavailable_error):
+        process = await asyncio.create_subprocess_exec(
+            "docker",
+            "exec",
+            "-i",
+            DB_CONTAINER_NAME,
+            "psql",
+            "-U",
+            DB_USER,
+            "-d",
+            DB_NAME,
+            "--csv",
+            "-v",
+            "ON_ERROR_STOP=1",
+            "-P",
+            "pager=off",
+            "-c",
+            sql,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
         )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            error_text = stderr.decode("utf-8", errors="replace").strip()
+            raise DBQueryError(f"DB query failed ({process.returncode}): {error_text}", error_text)
 
     text = stdout.decode("utf-8", errors="replace").strip()
     if not text:
@@ -305,6 +1126,57 @@ async def run_db_query(sql: str) -> list[dict[str, str]]:
     return list(reader)
 
 
+async def stream_db_copy(sql: str, output_format: str):
+    # COPY ... TO STDOUT отдает строки по мере выполнения запроса, ничего не копится в памяти.
+    # Для JSONL используется csv-режим с управляющими символами вместо кавычки и разделителя:
+    # так строка JSON выходит без экранирования, которое добавил бы текстовый формат COPY.
+    if output_format == "jsonl":
+        copy_sql = (
+            f"COPY (SELECT row_to_json(t)::text FROM ({sql}) t) TO STDOUT "
+            "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+        )
+    else:
+        copy_sql = f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+
+    async with DB_GUARD.call(is_db_unavailable_error):
+        process = await asyncio.create_subprocess_exec(
+            "docker",
+            "exec",
+            "-i",
+            DB_CONTAINER_NAME,
+            "psql",
+            "-U",
+            DB_USER,
+            "-d",
+            DB_NAME,
+            "-v",
+            "ON_ERROR_STOP=1",
+            "-c",
+            copy_sql,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        assert process.stdout is not None and process.stderr is not None
+        stderr_task = asyncio.create_task(process.stderr.read())
+        try:
+            while True:
+                chunk = await process.stdout.read(EXPORT_READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+            return_code = await process.wait()
+            stderr = await stderr_task
+            if return_code != 0:
+                error_text = stderr.decode("utf-8", errors="replace").strip()
+                raise DBQueryError(f"DB export failed ({return_code}): {error_text}", error_text)
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if not stderr_task.done():
+                stderr_task.cancel()
+
+
 async def get_user_by_email(email: str) -> Optional[dict[str, str]]:
     email_quoted = _sql_quote(email.strip().lower())
     rows = await run_db_query(
@@ -316,6 +1188,16 @@ async def get_user_by_email(email: str) -> Optional[dict[str, str]]:
     return rows[0] if rows else None
 
 
+async def get_user_by_id(user_id: int) -> Optional[dict[str, str]]:
+    rows = await run_db_query(
+        "SELECT id, email, username, created_at "
+        "FROM users "
+        f"WHERE id = {int(user_id)} "
+        "LIMIT 1;"
+    )
+    return rows[0] if rows else None
+
+
 async def get_user_storage_summary(user_id: int) -> dict[str, int]:
     rows = await run_db_query(
         "SELECT COALESCE(SUM(s.filesize), 0)::bigint AS used_bytes, "
@@ -333,40 +1215,46 @@ async def get_user_storage_summary(user_id: int) -> dict[str, int]:
     }
 
 
+def split_window_total(rows: list[dict[str, str]]) -> int:
+    # total_count приходит из COUNT(*) OVER () в каждой строке страницы; убираем его из строк.
+    total = int(rows[0].get("total_count", "0") or 0) if rows else 0
+    for row in rows:
+        row.pop("total_count", None)
+    return total
+
+
 async def get_user_tracks(user_id: int, page: int, limit: int) -> tuple[list[dict[str, str]], int]:
+    # Страница и общее число — одним запросом (COUNT(*) OVER ()). Отдельный COUNT нужен
+    # только для пустой страницы за концом списка, где оконному итогу не в чем прийти.
     offset = max(page - 1, 0) * max(limit, 1)
-    count_rows = await run_db_query(
-        "SELECT COUNT(*)::int AS total_tracks "
-        "FROM songs s "
-        "JOIN user_library ul ON ul.song_id = s.id "
-        f"WHERE ul.user_id = {user_id};"
-    )
-    total_tracks = int(count_rows[0].get("total_tracks", "0")) if count_rows else 0
-
     rows = await run_db_query(
         "SELECT s.id, COALESCE(s.original_filename, s.filename) AS title, "
-        "s.filesize::bigint AS filesize, s.upload_date "
+        "s.filesize::bigint AS filesize, s.upload_date, "
+        "COUNT(*) OVER ()::int AS total_count "
         "FROM songs s "
         "JOIN user_library ul ON ul.song_id = s.id "
         f"WHERE ul.user_id = {user_id} "
         "ORDER BY s.upload_date DESC, s.id DESC "
         f"LIMIT {max(limit, 1)} OFFSET {offset};"
     )
-    return rows, total_tracks
+    if rows or offset == 0:
+        return rows, split_window_total(rows)
 
-
-async def get_user_playlists(user_id: int, page: int, limit: int) -> tuple[list[dict[str, str]], int]:
-    offset = max(page - 1, 0) * max(limit, 1)
     count_rows = await run_db_query(
-        "SELECT COUNT(*)::int AS total_playlists "
-        "FROM playlists "
-        f"WHERE owner_id = {user_id};"
+        "SELECT COUNT(*)::int AS total_tracks "
+        "FROM songs s "
+        "JOIN user_library ul ON ul.song_id = s.id "
+        f"WHERE ul.user_id = {user_id};"
     )
-    total_playlists = int(count_rows[0].get("total_playlists", "0")) if count_rows else 0
+    return rows, int(count_rows[0].get("total_tracks", "0")) if count_rows else 0
 
+
+async def get_user_playlists(user_id: int, page: int, limit: int) -> tuple[list[dict[str, str]], int]:
+    offset = max(page - 1, 0) * max(limit, 1)
     rows = await run_db_query(
         "SELECT p.id, p.name, p.is_favorite, p.created_at, p.updated_at, "
-        "COUNT(ps.song_id)::int AS song_count "
+        "COUNT(ps.song_id)::int AS song_count, "
+        "COUNT(*) OVER ()::int AS total_count "
         "FROM playlists p "
         "LEFT JOIN playlist_songs ps ON ps.playlist_id = p.id "
         f"WHERE p.owner_id = {user_id} "
@@ -374,158 +1262,1151 @@ async def get_user_playlists(user_id: int, page: int, limit: int) -> tuple[list[
         "ORDER BY p.is_favorite DESC, p.created_at DESC "
         f"LIMIT {max(limit, 1)} OFFSET {offset};"
     )
-    return rows, total_playlists
+    if rows or offset == 0:
+        return rows, split_window_total(rows)
+
+    count_rows = await run_db_query(
+        "SELECT COUNT(*)::int AS total_playlists "
+        "FROM playlists "
+        f"WHERE owner_id = {user_id};"
+    )
+    return rows, int(count_rows[0].get("total_playlists", "0")) if count_rows else 0
+
+
+def parse_export_args(args: list[str]) -> tuple[str, str, dict[str, str]]:
+    if not args or args[0].strip().lower() not in EXPORT_KINDS:
+        raise ValueError("unknown export kind")
+    kind = args[0].strip().lower()
+    output_format = "csv"
+    filters: dict[str, str] = {}
+    for raw in args[1:]:
+        token = raw.strip()
+        if token.lower() in EXPORT_FORMATS:
+            output_format = token.lower()
+            continue
+        key, sep, value = token.partition("=")
+        key = key.strip().lower()
+        value = value.strip()
+        if not sep or not value:
+            raise ValueError(f"bad filter: {token}")
+        if key in ("since", "until"):
+            datetime.strptime(value, "%Y-%m-%d")
+        elif key == "user":
+            if not looks_like_email(value):
+                raise ValueError(f"bad email: {value}")
+            value = value.lower()
+        elif key != "q" or kind != "users":
+            raise ValueError(f"unknown filter: {key}")
+        filters[key] = value
+    return kind, output_format, filters
+
+
+def build_export_query(kind: str, filters: dict[str, str]) -> tuple[str, str]:
+    conditions: list[str] = []
+    if kind == "users":
+        date_column = "u.created_at"
+    elif kind == "tracks":
+        date_column = "s.upload_date"
+    else:
+        date_column = "p.created_at"
+    if "since" in filters:
+        conditions.append(f"{date_column} >= '{_sql_quote(filters['since'])}'::date")
+    if "until" in filters:
+        conditions.append(f"{date_column} < '{_sql_quote(filters['until'])}'::date + 1")
+    if "user" in filters:
+        conditions.append(f"lower(u.email) = '{_sql_quote(filters['user'])}'")
+    if "q" in filters:
+        fragment = filters["q"].lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = _sql_quote(fragment)
+        conditions.append(f"(lower(u.email) LIKE '%{pattern}%' OR lower(u.username) LIKE '%{pattern}%')")
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+
+    if kind == "users":
+        source = "FROM users u "
+        select = (
+            "SELECT u.id, u.email, u.username, u.created_at, "
+            "COALESCE(lib.tracks_count, 0) AS tracks_count, "
+            "COALESCE(lib.used_bytes, 0) AS used_bytes "
+            "FROM users u "
+            "LEFT JOIN ("
+            "SELECT ul.user_id, COUNT(*)::int AS tracks_count, SUM(s.filesize)::bigint AS used_bytes "
+            "FROM user_library ul JOIN songs s ON s.id = ul.song_id GROUP BY ul.user_id"
+            ") lib ON lib.user_id = u.id "
+            f"{where}"
+            "ORDER BY u.id"
+        )
+    elif kind == "tracks":
+        source = "FROM user_library ul JOIN users u ON u.id = ul.user_id JOIN songs s ON s.id = ul.song_id "
+        select = (
+            "SELECT ul.user_id, u.email, s.id AS song_id, "
+            "COALESCE(s.original_filename, s.filename) AS title, s.filename, "
+            "s.filesize::bigint AS filesize, s.upload_date "
+            f"{source}"
+            f"{where}"
+            "ORDER BY ul.user_id, s.id"
+        )
+    else:
+        source = "FROM playlists p JOIN users u ON u.id = p.owner_id "
+        select = (
+            "SELECT p.id, p.owner_id, u.email, p.name, p.is_favorite, p.created_at, p.updated_at, "
+            "(SELECT COUNT(*) FROM playlist_songs ps WHERE ps.playlist_id = p.id)::int AS song_count "
+            f"{source}"
+            f"{where}"
+            "ORDER BY p.id"
+        )
+    count = f"SELECT COUNT(*)::bigint AS total {source}{where}".strip() + ";"
+    return select, count
+
+
+def count_csv_records(chunk: bytes, in_quotes: bool) -> tuple[int, bool]:
+    # Перевод строки внутри кавычек (имя плейлиста, original_filename) — часть поля,
+    # а не конец записи. Состояние кавычек переносится между чанками COPY;
+    # экранированная кавычка "" переключает его дважды и ничего не меняет.
+    if not in_quotes and b'"' not in chunk:
+        return chunk.count(b"\n"), False
+    records = 0
+    for idx, part in enumerate(chunk.split(b'"')):
+        if idx:
+            in_quotes = not in_quotes
+        if not in_quotes:
+            records += part.count(b"\n")
+    return records, in_quotes
+
+
+async def write_export(
+    select_sql: str,
+    output_format: str,
+    spool: Any,
+    on_progress: Callable[[int, int], Awaitable[None]],
+) -> tuple[int, int]:
+    rows = 0
+    raw_bytes = 0
+    in_quotes = False
+    last_progress = time.monotonic()
+    # aclosing: при выходе по лимиту размера или ошибке генератор закрывается сразу,
+    # и его finally убивает psql, а не ждет сборщика мусора.
+    with gzip.GzipFile(fileobj=spool, mode="wb", compresslevel=6) as gz:
+        async with aclosing(stream_db_copy(select_sql, output_format)) as chunks:
+            async for chunk in chunks:
+                await asyncio.to_thread(gz.write, chunk)
+                if output_format == "csv":
+                    records, in_quotes = count_csv_records(chunk, in_quotes)
+                    rows += records
+                else:
+                    # JSONL: row_to_json экранирует переводы строк, одна строка — одна запись.
+                    rows += chunk.count(b"\n")
+                raw_bytes += len(chunk)
+                if spool.tell() > EXPORT_MAX_DOCUMENT_BYTES:
+                    raise RuntimeError(
+                        f"export exceeds {format_bytes(EXPORT_MAX_DOCUMENT_BYTES)} after compression, "
+                        "narrow it with filters"
+                    )
+                now = time.monotonic()
+                if now - last_progress >= EXPORT_PROGRESS_INTERVAL_SECONDS:
+                    last_progress = now
+                    await on_progress(rows, spool.tell())
+    if output_format == "csv" and rows:
+        rows -= 1
+    return rows, raw_bytes
+
+
+async def iter_song_file_batches(batch_size: int = RECONCILE_DB_BATCH_SIZE):
+    last_id = 0
+    safe_batch_size = max(batch_size, 1)
+    while True:
+        rows = await run_db_query(
+            "SELECT id, filename, filesize::bigint AS filesize "
+            "FROM songs "
+            f"WHERE id > {last_id} "
+            "ORDER BY id "
+            f"LIMIT {safe_batch_size};"
+        )
+        if not rows:
+            return
+        yield [
+            (str(row.get("filename", "")), int(row.get("filesize", "0") or 0))
+            for row in rows
+        ]
+        last_id = int(rows[-1].get("id", last_id) or last_id)
+        if len(rows) < safe_batch_size:
+            return
 
 
-def now_utc_ts() -> float:
-    return datetime.now(timezone.utc).timestamp()
+async def reconcile_uploads_with_songs() -> dict[str, Any]:
+    # Симметричный diff: каждая сторона хранит только еще не сопоставленные записи
+    # (имя файла -> размер), поэтому память растет лишь на расхождениях.
+    pending_disk: dict[str, int] = {}
+    pending_rows: dict[str, int] = {}
+    mismatch_heap: list[tuple[int, str, int, int]] = []
+    stats = {
+        "disk_files": 0,
+        "disk_bytes": 0,
+        "db_rows": 0,
+        "db_bytes": 0,
+        "matched": 0,
+        "mismatch_count": 0,
+        "mismatch_delta_bytes": 0,
+    }
 
+    def match(name: str, disk_size: int, row_size: int) -> None:
+        stats["matched"] += 1
+        if disk_size != row_size:
+            stats["mismatch_count"] += 1
+            stats["mismatch_delta_bytes"] += abs(disk_size - row_size)
+            heapq.heappush(mismatch_heap, (abs(disk_size - row_size), name, disk_size, row_size))
+            if len(mismatch_heap) > RECONCILE_SAMPLE_SIZE:
+                heapq.heappop(mismatch_heap)
+
+    def add_disk_file(name: str, size: int) -> None:
+        stats["disk_files"] += 1
+        stats["disk_bytes"] += size
+        row_size = pending_rows.pop(name, None)
+        if row_size is None:
+            pending_disk[name] = size
+        else:
+            match(name, size, row_size)
+
+    def add_song_row(name: str, size: int) -> None:
+        stats["db_rows"] += 1
+        stats["db_bytes"] += size
+        disk_size = pending_disk.pop(name, None)
+        if disk_size is None:
+            pending_rows[name] = size
+        else:
+            match(name, disk_size, size)
 
-def normalize_user_session(raw_session: Any, now_ts: float) -> Optional[dict[str, Any]]:
-    if isinstance(raw_session, str):
-        email = raw_session.strip().lower()
-        if not email:
-            return None
-        return {
-            "email": email,
-            "expires_at": now_ts + max(USER_SESSION_TTL_SECONDS, 60),
-        }
+    root_path = "-"
 
-    if not isinstance(raw_session, dict):
-        return None
+    async def files_worker() -> None:
+        nonlocal root_path
+        async for item in iter_server_files():
+            if "root_path" in item:
+                root_path = str(item["root_path"])
+            elif "name" in item:
+                add_disk_file(str(item.get("name", "")), int(item.get("size_bytes", 0) or 0))
 
-    email = raw_session.get("email")
-    expires_at = raw_session.get("expires_at")
-    if not isinstance(email, str) or not email.strip():
-        return None
-    if not isinstance(expires_at, (int, float)):
-        return None
+    async def songs_worker() -> None:
+        async for batch in iter_song_file_batches():
+            for name, size in batch:
+                add_song_row(name, size)
+
+    await asyncio.gather(songs_worker(), files_worker())
 
     return {
-        "email": email.strip().lower(),
-        "expires_at": float(expires_at),
+        "root_path": root_path,
+        **stats,
+        "orphan_files": len(pending_disk),
+        "orphan_bytes": sum(pending_disk.values()),
+        "orphan_sample": heapq.nlargest(
+            RECONCILE_SAMPLE_SIZE, pending_disk.items(), key=lambda item: item[1]
+        ),
+        "dangling_rows": len(pending_rows),
+        "dangling_bytes": sum(pending_rows.values()),
+        "dangling_sample": heapq.nlargest(
+            RECONCILE_SAMPLE_SIZE, pending_rows.items(), key=lambda item: item[1]
+        ),
+        "mismatch_sample": [
+            (name, disk_size, row_size)
+            for _, name, disk_size, row_size in sorted(mismatch_heap, reverse=True)
+        ],
     }
 
 
-def cleanup_user_sessions(application: Application, force: bool = False) -> None:
-    sessions = application.bot_data.setdefault("user_sessions", {})
-    if not isinstance(sessions, dict):
-        sessions = {}
-        application.bot_data["user_sessions"] = sessions
+async def fetch_users_usage() -> list[dict[str, Any]]:
+    rows = await run_db_query(
+        "SELECT u.id, u.email, u.username, "
+        "COALESCE(SUM(s.filesize), 0)::bigint AS used_bytes, "
+        "COUNT(s.id)::int AS tracks_count "
+        "FROM users u "
+        "JOIN user_library ul ON ul.user_id = u.id "
+        "JOIN songs s ON s.id = ul.song_id "
+        "GROUP BY u.id, u.email, u.username "
+        "ORDER BY used_bytes DESC;"
+    )
+    return [
+        {
+            "id": int(row.get("id", "0") or 0),
+            "email": str(row.get("email", "-")),
+            "username": str(row.get("username", "-")),
+            "used_bytes": int(row.get("used_bytes", "0") or 0),
+            "tracks_count": int(row.get("tracks_count", "0") or 0),
+        }
+        for row in rows
+    ]
+
 
-    now_ts = now_utc_ts()
-    cleanup_interval = max(USER_SESSION_CLEANUP_INTERVAL_SECONDS, 1)
-    last_cleanup_raw = application.bot_data.get("user_sessions_last_cleanup_ts", 0.0)
+async def record_user_usage_sample(application: Application, users: list[dict[str, Any]], now_ts: float) -> None:
+    store = get_metrics_store(application)
+    if store is None:
+        return
     try:
-        last_cleanup = float(last_cleanup_raw)
-    except (TypeError, ValueError):
-        last_cleanup = 0.0
+        await asyncio.to_thread(
+            store.write_user_usage,
+            now_ts,
+            [(user["id"], user["used_bytes"]) for user in users],
+            max(TOP_USERS_SAMPLE_INTERVAL_SECONDS, 60),
+        )
+    except Exception:
+        logger.exception("Ошибка записи выборки занятого места пользователей")
 
-    if not force and now_ts - last_cleanup < cleanup_interval:
-        return
 
-    for token, raw_session in list(sessions.items()):
-        session = normalize_user_session(raw_session, now_ts)
-        if session is None or session["expires_at"] <= now_ts:
-            sessions.pop(token, None)
-            continue
-        if session is not raw_session:
-            sessions[token] = session
+async def get_users_usage(application: Application, force: bool = False) -> dict[str, Any]:
+    cache = application.bot_data.get("top_users_cache")
+    now_ts = now_utc_ts()
+    if (
+        not force
+        and isinstance(cache, dict)
+        and now_ts - float(cache.get("fetched_at", 0.0)) < TOP_USERS_CACHE_TTL_SECONDS
+    ):
+        return cache
+
+    users = await fetch_users_usage()
+    cache = {"fetched_at": now_ts, "users": users}
+    application.bot_data["top_users_cache"] = cache
+    await record_user_usage_sample(application, users, now_ts)
+    return cache
+
+
+async def rank_users_by_growth(
+    application: Application,
+    users: list[dict[str, Any]],
+    window_seconds: int,
+    now_ts: float,
+) -> tuple[list[tuple[dict[str, Any], int]], float]:
+    # Выборки живут в хранилище метрик и переживают рестарт; без него роста не считаем.
+    store = get_metrics_store(application)
+    if store is None:
+        return [], 0.0
+    baseline = await asyncio.to_thread(store.load_user_usage_baseline, now_ts - window_seconds)
+    if baseline is None or now_ts - baseline[0] <= 0:
+        return [], 0.0
+
+    base_ts, base_usage = baseline
+    ranked = [
+        (user, user["used_bytes"] - base_usage.get(user["id"], 0))
+        for user in users
+    ]
+    ranked.sort(key=lambda item: item[1], reverse=True)
+    return ranked, now_ts - base_ts
+
+
+async def user_usage_sampler_loop(application: Application) -> None:
+    while True:
+        try:
+            await get_users_usage(application, force=True)
+        except Exception:
+            logger.exception("Ошибка сбора выборки занятого места пользователей")
+        await asyncio.sleep(max(TOP_USERS_SAMPLE_INTERVAL_SECONDS, 60))
+
+
+class EmailIndex:
+    # Все записи лежат в одном отсортированном UTF-8 блобе b"email\tusername\n..." плюс
+    # массив смещений начала строк. bytes, а не str: одна кириллическая буква в str
+    # перевела бы всю строку в UCS-2/UCS-4, а так ASCII-почта стоит 1 байт на символ.
+    # Префикс по email ищется бинарным поиском (порядок байт UTF-8 совпадает с порядком
+    # символов), подстрока (в т.ч. по username) — bytes.find. Новые пользователи копятся
+    # в маленьком отсортированном списке, удаленные — в tombstones; при слиянии они уходят.
+
+    __slots__ = ("_blob", "_offsets", "_pending", "_removed", "watermark", "built_at")
+
+    def __init__(self) -> None:
+        self._blob = b""
+        self._offsets = array("I")
+        self._pending: list[str] = []
+        self._removed: set[str] = set()
+        self.watermark: Optional[tuple[str, int]] = None
+        self.built_at = 0.0
+
+    @staticmethod
+    def _line(email: str, username: str) -> str:
+        def clean(value: str) -> str:
+            return value.replace("\t", " ").replace("\n", " ").strip().lower()
+
+        return f"{clean(email)}\t{clean(username)}"
+
+    def __len__(self) -> int:
+        return len(self._offsets) + len(self._pending)
+
+    def memory_bytes(self) -> int:
+        return (
+            sys.getsizeof(self._blob)
+            + self._offsets.itemsize * len(self._offsets)
+            + sum(sys.getsizeof(line) for line in self._pending)
+        )
 
-    max_entries = max(USER_SESSION_MAX_ENTRIES, 0)
-    if max_entries > 0 and len(sessions) > max_entries:
-        sorted_tokens = sorted(
-            sessions.items(),
-            key=lambda item: float(item[1].get("expires_at", 0.0)) if isinstance(item[1], dict) else 0.0,
+    def rebuild(self, lines: list[str]) -> None:
+        lines.sort()
+        encoded = [line.encode("utf-8") for line in lines]
+        offsets = array("I")
+        position = 0
+        for line in encoded:
+            offsets.append(position)
+            position += len(line) + 1
+        self._blob = b"\n".join(encoded) + b"\n" if encoded else b""
+        self._offsets = offsets
+        self._pending = []
+        self._removed = set()
+
+    def add(self, email: str, username: str) -> None:
+        bisect.insort(self._pending, self._line(email, username))
+        self._removed.discard(email.strip().lower())
+
+    def remove(self, email: str) -> None:
+        self._removed.add(email.strip().lower())
+
+    def needs_merge(self) -> bool:
+        return (
+            len(self._pending) >= EMAIL_INDEX_MERGE_THRESHOLD
+            or len(self._removed) >= EMAIL_INDEX_MERGE_THRESHOLD
         )
-        extra = len(sessions) - max_entries
-        for token, _ in sorted_tokens[:extra]:
-            sessions.pop(token, None)
 
-    application.bot_data["user_sessions_last_cleanup_ts"] = now_ts
+    def all_lines(self) -> list[str]:
+        return [
+            line
+            for line in self._blob.decode("utf-8").splitlines() + self._pending
+            if line.partition("\t")[0] not in self._removed
+        ]
+
+    def _line_end(self, idx: int) -> int:
+        return self._blob.index(b"\n", self._offsets[idx])
+
+    def _line_at(self, idx: int) -> str:
+        return self._blob[self._offsets[idx] : self._line_end(idx)].decode("utf-8")
+
+    def search(self, fragment: str, limit: int) -> list[tuple[str, str]]:
+        needle = fragment.strip().lower()
+        if not needle or "\n" in needle:
+            return []
+
+        found: list[str] = []
+        seen: set[str] = set()
 
+        def accept(line: str) -> bool:
+            email = line.partition("\t")[0]
+            if email in seen or email in self._removed:
+                return len(found) < limit
+            seen.add(email)
+            found.append(line)
+            return len(found) < limit
+
+        encoded = needle.encode("utf-8")
+
+        # 1) Префикс email: бинарный поиск по отсортированным строкам.
+        idx = bisect.bisect_left(
+            self._offsets, encoded, key=lambda start: self._blob[start : start + len(encoded)]
+        )
+        while idx < len(self._offsets):
+            line = self._line_at(idx)
+            if not line.startswith(needle) or not accept(line):
+                break
+            idx += 1
+        for line in self._pending[bisect.bisect_left(self._pending, needle) :]:
+            if not line.startswith(needle) or not accept(line):
+                break
+
+        # 2) Подстрока в email или username.
+        position = self._blob.find(encoded)
+        while position != -1 and len(found) < limit:
+            idx = bisect.bisect_right(self._offsets, position) - 1
+            accept(self._line_at(idx))
+            position = self._blob.find(encoded, self._line_end(idx) + 1)
+        for line in self._pending:
+            if len(found) >= limit:
+                break
+            if needle in line:
+                accept(line)
+
+        return [(line.partition("\t")[0], line.partition("\t")[2]) for line in found[:limit]]
+
+
+async def fetch_users_for_index(
+    watermark: Optional[tuple[str, int]],
+) -> list[dict[str, str]]:
+    # created_at допускает NULL: такие строки идут первыми с ключом -infinity,
+    # иначе водяной знак получился бы пустой строкой и ''::timestamp ломал бы обновление.
+    sort_key = "COALESCE(created_at, '-infinity'::timestamp)"
+    if watermark is None:
+        condition = ""
+    else:
+        created_at, user_id = watermark
+        condition = f"WHERE ({sort_key}, id) > ('{_sql_quote(created_at)}'::timestamp, {int(user_id)}) "
+    return await run_db_query(
+        f"SELECT id, email, username, {sort_key} AS sort_at "
+        "FROM users "
+        f"{condition}"
+        f"ORDER BY {sort_key}, id "
+        f"LIMIT {EMAIL_INDEX_BATCH_SIZE};"
+    )
 
-def get_user_sessions(application: Application) -> dict[str, Any]:
-    cleanup_user_sessions(application)
-    sessions = application.bot_data.setdefault("user_sessions", {})
-    if isinstance(sessions, dict):
-        return sessions
-    application.bot_data["user_sessions"] = {}
-    return application.bot_data["user_sessions"]
 
+async def refresh_email_index(application: Application, full: bool = False) -> EmailIndex:
+    index = application.bot_data.get("email_index")
+    if full or not isinstance(index, EmailIndex):
+        fresh = EmailIndex()
+        lines: list[str] = []
+        watermark: Optional[tuple[str, int]] = None
+        while True:
+            rows = await fetch_users_for_index(watermark)
+            for row in rows:
+                lines.append(EmailIndex._line(str(row.get("email", "")), str(row.get("username", ""))))
+            if rows:
+                watermark = (str(rows[-1].get("sort_at") or "-infinity"), int(rows[-1].get("id", "0") or 0))
+            if len(rows) < EMAIL_INDEX_BATCH_SIZE:
+                break
+        await asyncio.to_thread(fresh.rebuild, lines)
+        fresh.watermark = watermark
+        fresh.built_at = now_utc_ts()
+        application.bot_data["email_index"] = fresh
+        logger.info("Индекс email перестроен: users=%s, ~%s", len(fresh), format_bytes(fresh.memory_bytes()))
+        return fresh
 
-def create_user_session(application: Application, email: str) -> str:
-    sessions = get_user_sessions(application)
     while True:
-        token = uuid.uuid4().hex[:10]
-        if token not in sessions:
+        rows = await fetch_users_for_index(index.watermark)
+        for row in rows:
+            index.add(str(row.get("email", "")), str(row.get("username", "")))
+        if rows:
+            index.watermark = (str(rows[-1].get("sort_at") or "-infinity"), int(rows[-1].get("id", "0") or 0))
+        if len(rows) < EMAIL_INDEX_BATCH_SIZE:
             break
-    sessions[token] = {
-        "email": email.strip().lower(),
-        "expires_at": now_utc_ts() + max(USER_SESSION_TTL_SECONDS, 60),
-    }
-    if USER_SESSION_MAX_ENTRIES > 0 and len(sessions) > USER_SESSION_MAX_ENTRIES:
-        cleanup_user_sessions(application, force=True)
-    return token
+    if index.needs_merge():
+        await asyncio.to_thread(index.rebuild, index.all_lines())
+    return index
 
 
-def resolve_user_email_by_token(application: Application, token: str) -> Optional[str]:
-    sessions = get_user_sessions(application)
-    raw_session = sessions.get(token)
-    if raw_session is None:
-        return None
+def get_email_index(application: Application) -> Optional[EmailIndex]:
+    index = application.bot_data.get("email_index")
+    return index if isinstance(index, EmailIndex) else None
 
-    now_ts = now_utc_ts()
-    session = normalize_user_session(raw_session, now_ts)
-    if session is None or session["expires_at"] <= now_ts:
-        sessions.pop(token, None)
+
+async def email_index_loop(application: Application) -> None:
+    while True:
+        try:
+            index = get_email_index(application)
+            full = index is None or now_utc_ts() - index.built_at >= EMAIL_INDEX_FULL_REBUILD_SECONDS
+            await refresh_email_index(application, full=full)
+        except Exception:
+            logger.exception("Ошибка обновления индекса email")
+        await asyncio.sleep(max(EMAIL_INDEX_REFRESH_SECONDS, 5))
+
+
+def load_purge_checkpoint() -> Optional[dict[str, Any]]:
+    try:
+        with open(PURGE_CHECKPOINT_PATH, "r", encoding="utf-8") as fh:
+            state = json.load(fh)
+    except FileNotFoundError:
         return None
+    except (OSError, ValueError):
+        logger.exception("Не удалось прочитать checkpoint очистки %s", PURGE_CHECKPOINT_PATH)
+        return None
+    return state if isinstance(state, dict) else None
+
 
-    session["expires_at"] = now_ts + max(USER_SESSION_TTL_SECONDS, 60)
-    sessions[token] = session
-    return session["email"]
+def save_purge_checkpoint(state: dict[str, Any]) -> None:
+    directory = os.path.dirname(PURGE_CHECKPOINT_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{PURGE_CHECKPOINT_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(state, fh, ensure_ascii=False)
+    os.replace(tmp_path, PURGE_CHECKPOINT_PATH)
 
 
-async def check_backend_health() -> Tuple[bool, str]:
-    url = f"{BACKEND_BASE_URL}{BACKEND_HEALTH_PATH}"
+def clear_purge_checkpoint() -> None:
     try:
-        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-            response = await client.get(url)
-        if 200 <= response.status_code < 300:
-            return True, f"HTTP {response.status_code}"
-        return False, f"HTTP {response.status_code}: {response.text[:120]}"
-    except Exception as exc:
-        return False, str(exc)
+        os.remove(PURGE_CHECKPOINT_PATH)
+    except FileNotFoundError:
+        pass
 
 
-def split_output_chunks(value: str, chunk_size: int = DEPLOY_OUTPUT_CHUNK_SIZE) -> list[str]:
-    value = value.strip()
-    if not value:
-        return []
+async def fetch_purge_batch(after_id: int, limit: int) -> list[tuple[int, str]]:
+    rows = await run_db_query(
+        "SELECT id, email "
+        "FROM users "
+        f"WHERE id > {int(after_id)} "
+        "ORDER BY id "
+        f"LIMIT {max(limit, 1)};"
+    )
+    return [(int(row.get("id", "0") or 0), str(row.get("email", ""))) for row in rows]
 
-    safe_chunk_size = max(chunk_size, 800)
-    chunks: list[str] = []
-    current_lines: list[str] = []
-    current_len = 0
 
-    def flush_current() -> None:
-        nonlocal current_lines, current_len
-        if current_lines:
-            chunks.append("\n".join(current_lines))
-            current_lines = []
-            current_len = 0
+async def count_users() -> int:
+    rows = await run_db_query("SELECT COUNT(*)::bigint AS total FROM users;")
+    return int(rows[0].get("total", "0") or 0) if rows else 0
 
-    for raw_line in value.splitlines():
-        line = raw_line.rstrip("\n")
-        if not line:
-            if current_len + 1 <= safe_chunk_size:
-                current_lines.append("")
-                current_len += 1
-            else:
-                flush_current()
-                current_lines.append("")
-                current_len = 1
-            continue
+
+def format_purge_progress(state: dict[str, Any]) -> str:
+    total = int(state.get("total", 0))
+    processed = int(state.get("processed", 0))
+    status = state.get("status", "running")
+    if status == "done":
+        header = "✅ <b>Массовое удаление завершено</b>"
+    elif status == "error":
+        header = "🚨 <b>Массовое удаление остановлено с ошибкой</b>"
+    elif status == "stopped":
+        header = "⏹️ <b>Массовое удаление остановлено</b>"
+    else:
+        header = "🧹 <b>Массовое удаление пользователей</b>"
+
+    percent = f" ({min(processed * 100 // total, 100)}%)" if total else ""
+    lines = [
+        header,
+        f"Обработано: <code>{processed}/{total}</code>{percent}",
+        f"Удалено пользователей: <code>{state.get('deleted', 0)}</code> | "
+        f"ошибок: <code>{state.get('failed', 0)}</code>",
+        f"Удалено песен: <code>{state.get('deleted_songs', 0)}</code> | "
+        f"файлов: <code>{state.get('deleted_files', 0)}</code>",
+    ]
+
+    elapsed = max(now_utc_ts() - float(state.get("started_at", now_utc_ts())), 1.0)
+    if status == "running" and processed:
+        rate = processed / elapsed
+        eta = max(total - processed, 0) / rate if rate > 0 else 0
+        lines.append(
+            f"Скорость: <code>{rate * 60:.0f}</code> польз/мин | "
+            f"осталось ~<code>{format_duration(eta)}</code>"
+        )
+    if state.get("resumed"):
+        lines.append(f"Возобновлено после перезапуска: <code>{state.get('resumed')}</code> раз")
+    if status == "running" and state.get("throttled"):
+        in_use = state.get("db_in_use")
+        lines.append(
+            "⏸️ Пауза: DB in_use "
+            f"<code>{'-' if in_use is None else in_use}</code> ≥ <code>{PURGE_MAX_DB_IN_USE_CONNECTIONS}</code>"
+        )
+    if status == "done" and "remaining_users" in state:
+        lines.append(f"Осталось пользователей: <code>{state['remaining_users']}</code>")
+    if status == "error" and state.get("error"):
+        lines.append(f"Ошибка: <code>{html.escape(str(state['error']))}</code>")
+        lines.append("Продолжить: <code>/purge_all_users RESUME</code>")
+
+    failures = state.get("failures") or []
+    if failures:
+        lines.append("")
+        lines.append("Первые ошибки:")
+        for item in failures[:PURGE_FAILURE_PREVIEW]:
+            email = html.escape(str(item.get("email", "-")))
+            reason = html.escape(str(item.get("error", "-")))
+            lines.append(f"• <code>{email}</code>: {reason}")
+    return "\n".join(lines)
+
+
+async def wait_for_db_headroom(
+    state: dict[str, Any],
+    report: Callable[[bool], Awaitable[None]],
+) -> None:
+    while True:
+        try:
+            snapshot = await fetch_snapshot(allow_stale=False)
+            in_use: Optional[int] = int(snapshot.get("db_in_use_connections", 0))
+        except Exception as exc:
+            logger.warning("Очистка: снимок недоступен, пауза: %s", exc)
+            in_use = None
+        if in_use is not None and in_use < PURGE_MAX_DB_IN_USE_CONNECTIONS:
+            state["throttled"] = False
+            return
+        state["throttled"] = True
+        state["db_in_use"] = in_use
+        await report(False)
+        await asyncio.sleep(max(PURGE_THROTTLE_SECONDS, 1))
+
+
+def forget_deleted_users(application: Application) -> None:
+    # Индекс email не сбрасывается: удаленные адреса уже помечены через forget_indexed_email.
+    forget_message_renders(application)
+    invalidate_page_cache(application)
+    invalidate_user_cache(application)
+
+
+def forget_indexed_email(application: Application, email: str) -> None:
+    index = get_email_index(application)
+    if index is not None:
+        index.remove(email)
+
+
+async def purge_users_loop(application: Application, state: dict[str, Any]) -> None:
+    last_report = 0.0
+
+    async def report(force: bool) -> None:
+        nonlocal last_report
+        now = time.monotonic()
+        if not force and now - last_report < PURGE_PROGRESS_INTERVAL_SECONDS:
+            return
+        last_report = now
+        try:
+            await application.bot.edit_message_text(
+                chat_id=state["chat_id"],
+                message_id=state["message_id"],
+                text=format_purge_progress(state),
+                parse_mode=ParseMode.HTML,
+            )
+        except BadRequest:
+            pass
+        except Exception:
+            logger.warning("Не удалось обновить прогресс очистки", exc_info=True)
+
+    def on_result(email: str, payload: Optional[dict[str, Any]], error: Optional[Exception]) -> None:
+        state["processed"] += 1
+        if error is not None:
+            state["failed"] += 1
+            if len(state["failures"]) < PURGE_FAILURE_PREVIEW:
+                state["failures"].append({"email": email, "error": str(error)})
+            return
+        forget_indexed_email(application, email)
+        summary = payload.get("summary") if isinstance(payload.get("summary"), dict) else {}
+        state["deleted"] += 1
+        state["deleted_songs"] += int(summary.get("deleted_songs", 0) or 0)
+        state["deleted_files"] += int(summary.get("deleted_files", 0) or 0)
+
+    try:
+        while True:
+            await wait_for_db_headroom(state, report)
+            batch = await fetch_purge_batch(int(state["after_id"]), PURGE_BATCH_SIZE)
+            if not batch:
+                break
+            await run_delete_pool([email for _, email in batch], PURGE_CONCURRENCY, on_result)
+            state["after_id"] = batch[-1][0]
+            state["total"] = max(int(state["total"]), int(state["processed"]))
+            await asyncio.to_thread(save_purge_checkpoint, state)
+            forget_deleted_users(application)
+            await report(False)
+
+        state["status"] = "done"
+        state["throttled"] = False
+        state["remaining_users"] = await count_users()
+        await asyncio.to_thread(clear_purge_checkpoint)
+        logger.info(
+            "Очистка завершена: processed=%s deleted=%s failed=%s",
+            state["processed"],
+            state["deleted"],
+            state["failed"],
+        )
+    except asyncio.CancelledError:
+        # Остановка бота: checkpoint остается в статусе running и подхватывается на старте.
+        await asyncio.to_thread(save_purge_checkpoint, state)
+        raise
+    except Exception as exc:
+        logger.exception("Ошибка массового удаления пользователей")
+        state["status"] = "error"
+        state["error"] = str(exc)
+        await asyncio.to_thread(save_purge_checkpoint, state)
+    finally:
+        forget_deleted_users(application)
+    await report(True)
+
+
+def start_purge_task(application: Application, state: dict[str, Any]) -> None:
+    application.bot_data["purge_state"] = state
+    application.bot_data["purge_task"] = asyncio.create_task(purge_users_loop(application, state))
+
+
+def get_purge_task(application: Application) -> Optional[asyncio.Task]:
+    task = application.bot_data.get("purge_task")
+    return task if isinstance(task, asyncio.Task) and not task.done() else None
+
+
+def get_purge_start_lock(application: Application) -> asyncio.Lock:
+    # Держится от проверки до start_purge_task: между ними есть await (count_users,
+    # ответ, запись checkpoint), а purge-команды относятся к control и не сериализуются.
+    return application.bot_data.setdefault("purge_start_lock", asyncio.Lock())
+
+
+def is_purge_busy(application: Application) -> bool:
+    return get_purge_task(application) is not None or get_purge_start_lock(application).locked()
+
+
+def start_background_job(application: Application, name: str, coroutine: Coroutine[Any, Any, None]) -> bool:
+    # Долгие команды (/export, /reconcile) работают фоновой задачей, как очистка: хендлер
+    # возвращается сразу и не держит обработчик апдейтов и очередь чата минутами.
+    # Проверка и регистрация идут без await — два вызова подряд не стартуют оба.
+    jobs = application.bot_data.setdefault("background_jobs", {})
+    task = jobs.get(name)
+    if isinstance(task, asyncio.Task) and not task.done():
+        coroutine.close()
+        return False
+    jobs[name] = asyncio.create_task(coroutine)
+    return True
+
+
+async def resume_purge(application: Application) -> None:
+    state = await asyncio.to_thread(load_purge_checkpoint)
+    if state is None or state.get("status") != "running":
+        return
+    state["resumed"] = int(state.get("resumed", 0)) + 1
+    logger.info("Возобновляю очистку пользователей с id > %s", state.get("after_id"))
+    start_purge_task(application, state)
+
+
+def parse_email_list(data: bytes) -> tuple[list[str], list[str], int]:
+    text = data.decode("utf-8-sig", errors="replace")
+    emails: list[str] = []
+    invalid: list[str] = []
+    seen: set[str] = set()
+    duplicates = 0
+    for raw in EMAIL_LIST_SPLIT_RE.split(text):
+        token = raw.strip().strip("\"'<>").lower()
+        if not token or token == "email":
+            continue
+        if not looks_like_email(token):
+            invalid.append(token)
+            continue
+        if token in seen:
+            duplicates += 1
+            continue
+        seen.add(token)
+        emails.append(token)
+    return emails, invalid, duplicates
+
+
+def cleanup_bulk_delete_jobs(application: Application) -> dict[str, dict[str, Any]]:
+    jobs = application.bot_data.setdefault("bulk_delete_jobs", {})
+    cutoff = time.monotonic() - BULK_DELETE_PENDING_TTL_SECONDS
+    for job_id in [job_id for job_id, job in jobs.items() if job["created_at"] < cutoff]:
+        jobs.pop(job_id, None)
+    return jobs
+
+
+def format_bulk_delete_result(result: dict[str, Any], total: int, finished: bool) -> str:
+    header = "✅ <b>Удаление по списку завершено</b>" if finished else "🗑️ <b>Удаление по списку</b>"
+    lines = [
+        header,
+        f"Обработано: <code>{result['processed']}/{total}</code>",
+        f"Удалено пользователей: <code>{result['deleted']}</code>",
+        f"Не найдено: <code>{result['not_found']}</code> | ошибок: <code>{len(result['failures'])}</code>",
+        f"Удалено песен: <code>{result['deleted_songs']}</code> | файлов: <code>{result['deleted_files']}</code>",
+        f"Ошибок удаления файлов: <code>{result['file_delete_errors']}</code>",
+    ]
+    if result["failures"]:
+        lines.append("")
+        lines.append("Первые ошибки:")
+        for email, reason in result["failures"][:BULK_DELETE_FAILURE_PREVIEW]:
+            lines.append(f"• <code>{html.escape(email)}</code>: {html.escape(shorten(reason, 120))}")
+    return "\n".join(lines)
+
+
+async def load_cached_page(
+    application: Application,
+    key: tuple[Any, ...],
+    loader: Callable[[], Awaitable[Any]],
+    force: bool = False,
+) -> Any:
+    cache = application.bot_data.setdefault("page_cache", OrderedDict())
+    cached = cache.get(key)
+    if not force and cached is not None and now_utc_ts() - cached[0] < PAGE_CACHE_TTL_SECONDS:
+        cache.move_to_end(key)
+        return cached[1]
+
+    generation = application.bot_data.get("page_cache_generation", 0)
+    value = await loader()
+    # Если пока шел запрос кэш инвалидировали (удаление пользователя), результат не сохраняем.
+    if application.bot_data.get("page_cache_generation", 0) == generation:
+        cache[key] = (now_utc_ts(), value)
+        cache.move_to_end(key)
+        while len(cache) > max(PAGE_CACHE_MAX_ENTRIES, 1):
+            cache.popitem(last=False)
+    return value
+
+
+def invalidate_page_cache(application: Application) -> None:
+    application.bot_data["page_cache_generation"] = application.bot_data.get("page_cache_generation", 0) + 1
+    application.bot_data.setdefault("page_cache", OrderedDict()).clear()
+
+
+async def load_cached_user_value(
+    application: Application,
+    key: tuple[Any, ...],
+    loader: Callable[[], Awaitable[Any]],
+) -> Any:
+    # Строки users и сводки хранилища: TTL+LRU, как у кэша страниц, но со своей
+    # точечной инвалидацией и счетчиками попаданий. Строка пользователя кладется
+    # сразу под двумя ключами (email и id), отрицательные ответы не кэшируются.
+    cache = application.bot_data.setdefault("user_cache", OrderedDict())
+    stats = application.bot_data.setdefault("user_cache_stats", {"hits": 0, "misses": 0})
+    cached = cache.get(key)
+    if cached is not None and now_utc_ts() - cached[0] < USER_CACHE_TTL_SECONDS:
+        cache.move_to_end(key)
+        stats["hits"] += 1
+        return cached[1]
+
+    stats["misses"] += 1
+    generation = application.bot_data.get("user_cache_generation", 0)
+    value = await loader()
+    if value is None or application.bot_data.get("user_cache_generation", 0) != generation:
+        return value
+
+    keys = [key]
+    if key[0] in ("user_email", "user_id") and isinstance(value, dict):
+        keys = [
+            ("user_email", str(value.get("email", "")).strip().lower()),
+            ("user_id", int(value.get("id", "0") or 0)),
+        ]
+    stored_at = now_utc_ts()
+    for item_key in keys:
+        cache[item_key] = (stored_at, value)
+        cache.move_to_end(item_key)
+    while len(cache) > max(USER_CACHE_MAX_ENTRIES, 1):
+        cache.popitem(last=False)
+    return value
+
+
+async def get_cached_user_by_email(application: Application, email: str) -> Optional[dict[str, str]]:
+    normalized_email = email.strip().lower()
+    return await load_cached_user_value(
+        application,
+        ("user_email", normalized_email),
+        lambda: get_user_by_email(normalized_email),
+    )
+
+
+async def get_cached_user_by_id(application: Application, user_id: int) -> Optional[dict[str, str]]:
+    return await load_cached_user_value(application, ("user_id", user_id), lambda: get_user_by_id(user_id))
+
+
+async def get_cached_user_storage_summary(application: Application, user_id: int) -> dict[str, int]:
+    return await load_cached_user_value(
+        application,
+        ("user_summary", user_id),
+        lambda: get_user_storage_summary(user_id),
+    )
+
+
+def invalidate_user_cache(application: Application, email: Optional[str] = None) -> None:
+    application.bot_data["user_cache_generation"] = application.bot_data.get("user_cache_generation", 0) + 1
+    cache = application.bot_data.setdefault("user_cache", OrderedDict())
+    if email is None:
+        cache.clear()
+        return
+    cached = cache.pop(("user_email", email.strip().lower()), None)
+    if cached is not None:
+        user_id = int(cached[1].get("id", "0") or 0)
+        cache.pop(("user_id", user_id), None)
+        cache.pop(("user_summary", user_id), None)
+
+
+def user_cache_stats(application: Application) -> dict[str, Any]:
+    stats = application.bot_data.get("user_cache_stats") or {"hits": 0, "misses": 0}
+    total = stats["hits"] + stats["misses"]
+    return {
+        "size": len(application.bot_data.get("user_cache") or {}),
+        "hits": stats["hits"],
+        "misses": stats["misses"],
+        "hit_rate": stats["hits"] / total if total else 0.0,
+    }
+
+
+async def _prefetch_page(
+    application: Application,
+    chat_id: int,
+    key: tuple[Any, ...],
+    loader: Callable[[], Awaitable[Any]],
+) -> None:
+    try:
+        await load_cached_page(application, key, loader)
+    except Exception as exc:
+        logger.debug("Prefetch %s не удался: %s", key, exc)
+    finally:
+        application.bot_data.setdefault("prefetch_inflight", {}).get(chat_id, set()).discard(key)
+
+
+def prefetch_pages(
+    application: Application,
+    chat_id: int,
+    requests: list[tuple[tuple[Any, ...], Callable[[], Awaitable[Any]]]],
+) -> None:
+    cache = application.bot_data.setdefault("page_cache", OrderedDict())
+    inflight = application.bot_data.setdefault("prefetch_inflight", {}).setdefault(chat_id, set())
+    tasks = application.bot_data.setdefault("prefetch_tasks", set())
+    now_ts = now_utc_ts()
+    for key, loader in requests:
+        cached = cache.get(key)
+        if key in inflight or (cached is not None and now_ts - cached[0] < PAGE_CACHE_TTL_SECONDS):
+            continue
+        if len(inflight) >= max(PREFETCH_MAX_PER_CHAT, 1):
+            break
+        inflight.add(key)
+        task = asyncio.create_task(_prefetch_page(application, chat_id, key, loader))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+def neighbour_pages(page: int, total_pages: int) -> list[int]:
+    # Вперед листают чаще, поэтому N+1 идет первым и занимает слот раньше N-1.
+    return [candidate for candidate in (page + 1, page - 1) if 1 <= candidate <= total_pages]
+
+
+async def load_users_page(application: Application, page: int, force: bool = False) -> dict[str, Any]:
+    return await load_cached_page(application, ("users", page), lambda: fetch_users_page(page), force)
+
+
+async def load_server_files_page(application: Application, page: int, force: bool = False) -> dict[str, Any]:
+    return await load_cached_page(
+        application,
+        ("files", page),
+        lambda: fetch_server_files_page(page=page, limit=SERVER_FILES_PAGE_SIZE),
+        force,
+    )
+
+
+async def load_user_tracks_page(
+    application: Application,
+    user_id: int,
+    page: int,
+) -> tuple[list[dict[str, str]], int]:
+    return await load_cached_page(
+        application,
+        ("user_tracks", user_id, page),
+        lambda: get_user_tracks(user_id, page, USER_TRACKS_PAGE_SIZE),
+    )
+
+
+async def load_user_playlists_page(
+    application: Application,
+    user_id: int,
+    page: int,
+) -> tuple[list[dict[str, str]], int]:
+    return await load_cached_page(
+        application,
+        ("user_playlists", user_id, page),
+        lambda: get_user_playlists(user_id, page, USER_PLAYLISTS_PAGE_SIZE),
+    )
+
+
+def prefetch_users_neighbours(application: Application, chat_id: int, page: int, total_pages: int) -> None:
+    prefetch_pages(
+        application,
+        chat_id,
+        [(("users", p), lambda p=p: fetch_users_page(p)) for p in neighbour_pages(page, total_pages)],
+    )
+
+
+def prefetch_files_neighbours(application: Application, chat_id: int, page: int, total_pages: int) -> None:
+    prefetch_pages(
+        application,
+        chat_id,
+        [
+            (("files", p), lambda p=p: fetch_server_files_page(page=p, limit=SERVER_FILES_PAGE_SIZE))
+            for p in neighbour_pages(page, total_pages)
+        ],
+    )
+
+
+def prefetch_user_list_neighbours(
+    application: Application,
+    chat_id: int,
+    kind: str,
+    user_id: int,
+    page: int,
+    total_pages: int,
+) -> None:
+    if kind == "tracks":
+        requests = [
+            (("user_tracks", user_id, p), lambda p=p: get_user_tracks(user_id, p, USER_TRACKS_PAGE_SIZE))
+            for p in neighbour_pages(page, total_pages)
+        ]
+    else:
+        requests = [
+            (
+                ("user_playlists", user_id, p),
+                lambda p=p: get_user_playlists(user_id, p, USER_PLAYLISTS_PAGE_SIZE),
+            )
+            for p in neighbour_pages(page, total_pages)
+        ]
+    prefetch_pages(application, chat_id, requests)
+
+
+def now_utc_ts() -> float:
+    return datetime.now(timezone.utc).timestamp()
+
+
+def _user_callback_key() -> bytes:
+    secret = USER_CALLBACK_SECRET or TELEGRAM_BOT_TOKEN
+    return hashlib.sha256(b"cloudtune-user-callback:" + secret.encode("utf-8")).digest()
+
+
+USER_CALLBACK_KEY = _user_callback_key()
+
+
+def encode_user_callback(view: str, user_id: int, page: int = 1) -> str:
+    # Кнопки карточки пользователя самодостаточны: id, экран, страница и срок жизни
+    # подписаны усеченным HMAC, поэтому серверных сессий нет и кнопки переживают рестарт.
+    # Срок округляется вверх до USER_CALLBACK_EXPIRY_STEP_SECONDS: в пределах шага клавиатура
+    # не меняется и повторная отрисовка того же экрана остается no-op для кэша отпечатков.
+    step = USER_CALLBACK_EXPIRY_STEP_SECONDS
+    expires_at = (int(now_utc_ts()) + max(USER_SESSION_TTL_SECONDS, 60)) // step * step + step
+    payload = USER_CALLBACK_STRUCT.pack(
+        USER_CALLBACK_VIEWS.index(view),
+        user_id,
+        min(expires_at, 0xFFFFFFFF),
+        min(max(page, 1), 0xFFFF),
+    )
+    mac = hmac.new(USER_CALLBACK_KEY, payload, hashlib.sha256).digest()[:USER_CALLBACK_MAC_BYTES]
+    return USER_CALLBACK_PREFIX + base64.urlsafe_b64encode(payload + mac).decode("ascii").rstrip("=")
+
+
+def decode_user_callback(data: str) -> Optional[tuple[str, int, int, int]]:
+    if not data.startswith(USER_CALLBACK_PREFIX):
+        return None
+    encoded = data[len(USER_CALLBACK_PREFIX) :]
+    try:
+        raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+    except ValueError:
+        return None
+    if len(raw) != USER_CALLBACK_STRUCT.size + USER_CALLBACK_MAC_BYTES:
+        return None
+    payload, mac = raw[: USER_CALLBACK_STRUCT.size], raw[USER_CALLBACK_STRUCT.size :]
+    expected = hmac.new(USER_CALLBACK_KEY, payload, hashlib.sha256).digest()[:USER_CALLBACK_MAC_BYTES]
+    if not hmac.compare_digest(mac, expected):
+        return None
+    view_code, user_id, expires_at, page = USER_CALLBACK_STRUCT.unpack(payload)
+    if view_code >= len(USER_CALLBACK_VIEWS):
+        return None
+    return USER_CALLBACK_VIEWS[view_code], user_id, page, expires_at
+
+
+@timed("backend health", label=lambda target=None: target.name if target is not None and is_multi_target() else "")
+async def check_backend_health(target: Optional[BackendTarget] = None) -> Tuple[bool, str]:
+    target = target or PRIMARY_TARGET
+    url = f"{target.base_url}{BACKEND_HEALTH_PATH}"
+    # Проба идет мимо лимитера, но ее результат кормит circuit breaker цели.
+    try:
+        response = await BACKEND_HTTP.get().get(url)
+        if 200 <= response.status_code < 300:
+            target.guard.observe_health(True)
+            return True, f"HTTP {response.status_code}"
+        target.guard.observe_health(False)
+        return False, f"HTTP {response.status_code}: {response.text[:120]}"
+    except Exception as exc:
+        target.guard.observe_health(False)
+        return False, str(exc)
+
+
+def split_output_chunks(value: str, chunk_size: int = DEPLOY_OUTPUT_CHUNK_SIZE) -> list[str]:
+    value = value.strip()
+    if not value:
+        return []
+
+    safe_chunk_size = max(chunk_size, 800)
+    chunks: list[str] = []
+    current_lines: list[str] = []
+    current_len = 0
+
+    def flush_current() -> None:
+        nonlocal current_lines, current_len
+        if current_lines:
+            chunks.append("\n".join(current_lines))
+            current_lines = []
+            current_len = 0
+
+    for raw_line in value.splitlines():
+        line = raw_line.rstrip("\n")
+        if not line:
+            if current_len + 1 <= safe_chunk_size:
+                current_lines.append("")
+                current_len += 1
+            else:
+                flush_current()
+                current_lines.append("")
+                current_len = 1
+            continue
 
         while len(line) > safe_chunk_size:
             if current_lines:
@@ -612,16 +2493,24 @@ def format_help_message() -> str:
     return (
         "🤖 <b>CloudTune Monitoring Bot</b>\n\n"
         "Доступные команды:\n"
-        "• /status\n"
+        "• /status [узел]\n"
         "• /storage\n"
         "• /connections\n"
         "• /runtime\n"
         "• /users\n"
         "• /files\n"
         "• /user &lt;email&gt;\n"
+        "• /find &lt;fragment&gt;\n"
+        "• /export users|tracks|playlists [csv|jsonl] [filters]\n"
         "• /delete_user &lt;email&gt;\n"
-        "• /purge_all_users CONFIRM\n"
-        "• /snapshot\n"
+        "• /purge_all_users CONFIRM|STOP|RESUME\n"
+        "• /live [interval_sec|stop]\n"
+        "• /history &lt;metric&gt; [24h|7d|90d]\n"
+        "• /chart &lt;metric&gt;[,&lt;metric&gt;] [24h|7d|90d]\n"
+        "• /top_users [n] [size|day|week]\n"
+        "• /reconcile\n"
+        "• /botstats\n"
+        "• /snapshot [узел]\n"
         "• /all\n"
         "• /deploy [branch]\n"
         "• /help\n\n"
@@ -796,7 +2685,30 @@ def format_server_files_page(payload: dict[str, Any]) -> tuple[str, Optional[Inl
     return text, keyboard
 
 
-def format_snapshot(payload: dict[str, Any]) -> str:
+def format_disk_forecast_lines(forecast: Optional[dict[str, Any]]) -> list[str]:
+    if forecast is None:
+        return ["🔮 Прогноз диска: <code>недостаточно истории</code>"]
+
+    size_rate_per_day = float(forecast["size_slope"]) * 86400
+    free_rate_per_day = float(forecast["free_slope"]) * 86400
+    size_sign = "+" if size_rate_per_day >= 0 else "-"
+    free_sign = "+" if free_rate_per_day >= 0 else "-"
+    lines = [
+        f"🔮 Рост uploads: <code>{size_sign}{format_bytes(int(abs(size_rate_per_day)))}/сутки</code>",
+        f"🔮 Изменение free: <code>{free_sign}{format_bytes(int(abs(free_rate_per_day)))}/сутки</code>",
+    ]
+    eta_seconds = forecast.get("eta_seconds")
+    if eta_seconds is None:
+        lines.append("🔮 До заполнения: <code>не прогнозируется</code>")
+    else:
+        lines.append(f"🔮 До заполнения: <code>~{format_duration(float(eta_seconds))}</code>")
+    lines.append(
+        f"🔮 Окно: <code>{format_duration(float(forecast['span_seconds']))}, {forecast['points']} точек</code>"
+    )
+    return lines
+
+
+def format_snapshot(payload: dict[str, Any], forecast: Optional[dict[str, Any]] = None) -> str:
     lines = [
         "🧪 <b>Технический снимок</b>",
         f"🕒 <code>{html.escape(str(payload.get('timestamp_utc', '-')))}</code>",
@@ -822,6 +2734,7 @@ def format_snapshot(payload: dict[str, Any]) -> str:
         f"💾 Upload 4xx/5xx: <code>{payload.get('upload_4xx_total', 0)}/{payload.get('upload_5xx_total', 0)}</code>",
         f"💾 Upload 4xx%/5xx%: <code>{float(payload.get('upload_4xx_rate_pct', 0)):.2f}/{float(payload.get('upload_5xx_rate_pct', 0)):.2f}</code>",
         f"💾 Upload top reason: <code>{html.escape(str(payload.get('upload_top_failure_reason', 'n/a')))} ({payload.get('upload_top_failure_reason_count', 0)})</code>",
+        *format_disk_forecast_lines(forecast),
         "",
         f"👥 Users: <code>{payload.get('users_total', 0)}</code>",
         f"🎵 Songs: <code>{payload.get('songs_total', 0)}</code>",
@@ -830,63 +2743,158 @@ def format_snapshot(payload: dict[str, Any]) -> str:
     return "\n".join(lines)
 
 
-def build_user_home_keyboard(token: str) -> InlineKeyboardMarkup:
+def format_reconcile_report(report: dict[str, Any]) -> str:
+    lines = [
+        "🧮 <b>Сверка uploads и songs</b>",
+        f"Корень: <code>{html.escape(str(report.get('root_path', '-')))}</code>",
+        "",
+        f"💾 Файлов на диске: <code>{report.get('disk_files', 0)}</code> "
+        f"(<code>{format_bytes(int(report.get('disk_bytes', 0)))}</code>)",
+        f"🗄️ Строк songs: <code>{report.get('db_rows', 0)}</code> "
+        f"(<code>{format_bytes(int(report.get('db_bytes', 0)))}</code>)",
+        f"✅ Сопоставлено: <code>{report.get('matched', 0)}</code>",
+        "",
+        f"👻 Файлы без строки: <code>{report.get('orphan_files', 0)}</code> "
+        f"(<code>{int(report.get('orphan_bytes', 0)):,}</code> байт)",
+    ]
+    for name, size in report.get("orphan_sample", []):
+        lines.append(f"   • <code>{html.escape(shorten(name, 60))}</code> — {format_bytes(size)}")
+
+    lines.append(
+        f"🕳️ Строки без файла: <code>{report.get('dangling_rows', 0)}</code> "
+        f"(<code>{int(report.get('dangling_bytes', 0)):,}</code> байт)"
+    )
+    for name, size in report.get("dangling_sample", []):
+        lines.append(f"   • <code>{html.escape(shorten(name, 60))}</code> — {format_bytes(size)}")
+
+    lines.append(
+        f"📏 Расхождения размера: <code>{report.get('mismatch_count', 0)}</code> "
+        f"(Δ <code>{int(report.get('mismatch_delta_bytes', 0)):,}</code> байт)"
+    )
+    for name, disk_size, row_size in report.get("mismatch_sample", []):
+        lines.append(
+            f"   • <code>{html.escape(shorten(name, 60))}</code> — "
+            f"диск {format_bytes(disk_size)} / БД {format_bytes(row_size)}"
+        )
+    return "\n".join(lines)
+
+
+def format_duration(seconds: float) -> str:
+    total = max(int(seconds), 0)
+    days, rest = divmod(total, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes = rest // 60
+    if days:
+        return f"{days} д {hours} ч"
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    return f"{minutes} мин"
+
+
+def format_top_users(
+    users: list[dict[str, Any]],
+    limit: int,
+    fetched_at: float,
+    mode: str,
+    growth: Optional[list[tuple[dict[str, Any], int]]] = None,
+    covered_seconds: float = 0.0,
+) -> str:
+    if mode == "size":
+        title = "🏆 <b>Топ пользователей по занятому месту</b>"
+    else:
+        title = f"📈 <b>Топ пользователей по росту ({'сутки' if mode == 'day' else 'неделя'})</b>"
+
+    lines = [
+        title,
+        f"🕒 Данные: <code>{datetime.fromtimestamp(fetched_at, timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}</code>",
+    ]
+    if mode != "size":
+        lines.append(f"⏱️ Покрытый интервал: <code>{format_duration(covered_seconds)}</code>")
+    lines.append("")
+
+    if mode == "size":
+        entries = [(user, user["used_bytes"]) for user in users[:limit]]
+    else:
+        entries = (growth or [])[:limit]
+
+    if not entries:
+        lines.append(
+            "Данных пока нет." if mode == "size" else "Недостаточно истории выборок для расчета роста."
+        )
+        return "\n".join(lines)
+
+    for idx, (user, value) in enumerate(entries, start=1):
+        lines.append(
+            f"{idx}. 📧 <code>{html.escape(shorten(user['email']))}</code> | "
+            f"👤 <b>{html.escape(shorten(user['username']))}</b>"
+        )
+        if mode == "size":
+            lines.append(
+                f"   💽 <code>{format_bytes(value)}</code> | 🎵 <code>{user['tracks_count']}</code>"
+            )
+        else:
+            sign = "+" if value >= 0 else "-"
+            lines.append(
+                f"   📈 <code>{sign}{format_bytes(abs(value))}</code> | "
+                f"💽 <code>{format_bytes(user['used_bytes'])}</code>"
+            )
+    return "\n".join(lines)
+
+
+def build_user_home_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
-        [[InlineKeyboardButton("О пользователе", callback_data=f"{USER_CALLBACK_PREFIX}about:{token}")]]
+        [[InlineKeyboardButton("О пользователе", callback_data=encode_user_callback("about", user_id))]]
     )
 
 
-def build_user_about_keyboard(token: str) -> InlineKeyboardMarkup:
+def build_user_about_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
             [
-                InlineKeyboardButton("Домой", callback_data=f"{USER_CALLBACK_PREFIX}home:{token}"),
-                InlineKeyboardButton("Файлы", callback_data=f"{USER_CALLBACK_PREFIX}files:{token}"),
-                InlineKeyboardButton("Плейлисты", callback_data=f"{USER_CALLBACK_PREFIX}playlists:{token}"),
+                InlineKeyboardButton("Домой", callback_data=encode_user_callback("home", user_id)),
+                InlineKeyboardButton("Файлы", callback_data=encode_user_callback("files", user_id)),
+                InlineKeyboardButton("Плейлисты", callback_data=encode_user_callback("playlists", user_id)),
             ]
         ]
     )
 
 
-def build_user_files_keyboard(token: str) -> InlineKeyboardMarkup:
+def build_user_files_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
             [
-                InlineKeyboardButton("Треки", callback_data=f"{USER_CALLBACK_PREFIX}tracks:{token}:1"),
-                InlineKeyboardButton("Домой", callback_data=f"{USER_CALLBACK_PREFIX}about:{token}"),
+                InlineKeyboardButton("Треки", callback_data=encode_user_callback("tracks", user_id, 1)),
+                InlineKeyboardButton("Домой", callback_data=encode_user_callback("about", user_id)),
             ]
         ]
     )
 
 
-def build_user_playlists_keyboard(token: str) -> InlineKeyboardMarkup:
+def build_user_playlists_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
             [
-                InlineKeyboardButton("Список", callback_data=f"{USER_CALLBACK_PREFIX}playlist_items:{token}:1"),
-                InlineKeyboardButton("Домой", callback_data=f"{USER_CALLBACK_PREFIX}about:{token}"),
+                InlineKeyboardButton("Список", callback_data=encode_user_callback("playlist_items", user_id, 1)),
+                InlineKeyboardButton("Домой", callback_data=encode_user_callback("about", user_id)),
             ]
         ]
     )
 
 
 def build_user_list_pagination_keyboard(
-    token: str,
+    user_id: int,
     kind: str,
     page: int,
     total_pages: int,
 ) -> InlineKeyboardMarkup:
-    if kind == "tracks":
-        prefix = f"{USER_CALLBACK_PREFIX}tracks:{token}:"
-    else:
-        prefix = f"{USER_CALLBACK_PREFIX}playlist_items:{token}:"
+    view = "tracks" if kind == "tracks" else "playlist_items"
 
     row: list[InlineKeyboardButton] = []
     if page > 1:
-        row.append(InlineKeyboardButton("⬅️", callback_data=f"{prefix}{page - 1}"))
-    row.append(InlineKeyboardButton("Домой", callback_data=f"{USER_CALLBACK_PREFIX}about:{token}"))
+        row.append(InlineKeyboardButton("⬅️", callback_data=encode_user_callback(view, user_id, page - 1)))
+    row.append(InlineKeyboardButton("Домой", callback_data=encode_user_callback("about", user_id)))
     if page < total_pages:
-        row.append(InlineKeyboardButton("➡️", callback_data=f"{prefix}{page + 1}"))
+        row.append(InlineKeyboardButton("➡️", callback_data=encode_user_callback(view, user_id, page + 1)))
     return InlineKeyboardMarkup([row])
 
 
@@ -976,7 +2984,21 @@ def format_user_playlists_page_text(rows: list[dict[str, str]], page: int, total
     return "\n".join(lines).rstrip()
 
 
-def build_threshold_issues(snapshot: dict[str, Any]) -> dict[str, str]:
+def build_threshold_issues(
+    snapshot: dict[str, Any],
+    thresholds: Optional[dict[str, float]] = None,
+) -> dict[str, str]:
+    limits = thresholds or ALERT_THRESHOLD_DEFAULTS
+    max_active_http_requests = limits["ALERT_MAX_ACTIVE_HTTP_REQUESTS"]
+    max_db_in_use_connections = limits["ALERT_MAX_DB_IN_USE_CONNECTIONS"]
+    max_goroutines = limits["ALERT_MAX_GOROUTINES"]
+    max_go_memory_mb = limits["ALERT_MAX_GO_MEMORY_MB"]
+    min_uploads_disk_free_mb = limits["ALERT_MIN_UPLOADS_DISK_FREE_MB"]
+    min_upload_requests_for_rate = limits["ALERT_MIN_UPLOAD_REQUESTS_FOR_RATE"]
+    max_upload_4xx_rate_pct = limits["ALERT_MAX_UPLOAD_4XX_RATE_PCT"]
+    max_upload_5xx_rate_pct = limits["ALERT_MAX_UPLOAD_5XX_RATE_PCT"]
+    max_upload_4xx_total = limits["ALERT_MAX_UPLOAD_4XX_TOTAL"]
+    max_upload_5xx_total = limits["ALERT_MAX_UPLOAD_5XX_TOTAL"]
     issues: dict[str, str] = {}
 
     http_active = int(snapshot.get("http_active_requests", 0))
@@ -990,75 +3012,1224 @@ def build_threshold_issues(snapshot: dict[str, Any]) -> dict[str, str]:
     upload_4xx_rate_pct = float(snapshot.get("upload_4xx_rate_pct", 0))
     upload_5xx_rate_pct = float(snapshot.get("upload_5xx_rate_pct", 0))
 
-    if http_active > ALERT_MAX_ACTIVE_HTTP_REQUESTS:
+    if http_active > max_active_http_requests:
         issues["http_active"] = (
-            f"HTTP active requests: {http_active} > {ALERT_MAX_ACTIVE_HTTP_REQUESTS}"
-        )
-    if db_in_use > ALERT_MAX_DB_IN_USE_CONNECTIONS:
-        issues["db_in_use"] = f"DB in_use: {db_in_use} > {ALERT_MAX_DB_IN_USE_CONNECTIONS}"
-    if goroutines > ALERT_MAX_GOROUTINES:
-        issues["goroutines"] = f"Goroutines: {goroutines} > {ALERT_MAX_GOROUTINES}"
-    if mem_alloc_mb > ALERT_MAX_GO_MEMORY_MB:
-        issues["memory"] = f"Go alloc: {mem_alloc_mb} MB > {ALERT_MAX_GO_MEMORY_MB} MB"
-    if uploads_free_mb < ALERT_MIN_UPLOADS_DISK_FREE_MB:
+            f"HTTP active requests: {http_active} > {max_active_http_requests}"
+        )
+    if db_in_use > max_db_in_use_connections:
+        issues["db_in_use"] = f"DB in_use: {db_in_use} > {max_db_in_use_connections}"
+    if goroutines > max_goroutines:
+        issues["goroutines"] = f"Goroutines: {goroutines} > {max_goroutines}"
+    if mem_alloc_mb > max_go_memory_mb:
+        issues["memory"] = f"Go alloc: {mem_alloc_mb} MB > {max_go_memory_mb} MB"
+    if uploads_free_mb < min_uploads_disk_free_mb:
         issues["disk_free"] = (
-            f"Uploads free: {uploads_free_mb} MB < {ALERT_MIN_UPLOADS_DISK_FREE_MB} MB"
+            f"Uploads free: {uploads_free_mb} MB < {min_uploads_disk_free_mb} MB"
         )
-    if upload_4xx_total > ALERT_MAX_UPLOAD_4XX_TOTAL:
+    if upload_4xx_total > max_upload_4xx_total:
         issues["upload_4xx_total"] = (
-            f"Upload 4xx total: {upload_4xx_total} > {ALERT_MAX_UPLOAD_4XX_TOTAL}"
+            f"Upload 4xx total: {upload_4xx_total} > {max_upload_4xx_total}"
         )
-    if upload_5xx_total > ALERT_MAX_UPLOAD_5XX_TOTAL:
+    if upload_5xx_total > max_upload_5xx_total:
         issues["upload_5xx_total"] = (
-            f"Upload 5xx total: {upload_5xx_total} > {ALERT_MAX_UPLOAD_5XX_TOTAL}"
+            f"Upload 5xx total: {upload_5xx_total} > {max_upload_5xx_total}"
         )
-    if upload_requests_total >= ALERT_MIN_UPLOAD_REQUESTS_FOR_RATE:
-        if upload_4xx_rate_pct > ALERT_MAX_UPLOAD_4XX_RATE_PCT:
+    if upload_requests_total >= min_upload_requests_for_rate:
+        if upload_4xx_rate_pct > max_upload_4xx_rate_pct:
             issues["upload_4xx_rate"] = (
                 "Upload 4xx rate: "
-                f"{upload_4xx_rate_pct:.2f}% > {ALERT_MAX_UPLOAD_4XX_RATE_PCT:.2f}% "
+                f"{upload_4xx_rate_pct:.2f}% > {max_upload_4xx_rate_pct:.2f}% "
                 f"(requests={upload_requests_total})"
             )
-        if upload_5xx_rate_pct > ALERT_MAX_UPLOAD_5XX_RATE_PCT:
+        if upload_5xx_rate_pct > max_upload_5xx_rate_pct:
             issues["upload_5xx_rate"] = (
                 "Upload 5xx rate: "
-                f"{upload_5xx_rate_pct:.2f}% > {ALERT_MAX_UPLOAD_5XX_RATE_PCT:.2f}% "
+                f"{upload_5xx_rate_pct:.2f}% > {max_upload_5xx_rate_pct:.2f}% "
                 f"(requests={upload_requests_total})"
             )
 
     return issues
 
 
-async def send_pretty_message(update: Update, text: str) -> None:
-    if update.message is None:
-        return
-    await update.message.reply_text(
-        text,
-        parse_mode=ParseMode.HTML,
-        reply_markup=MENU_KEYBOARD,
-        disable_web_page_preview=True,
+def record_storage_sample(application: Application, snapshot: dict[str, Any], now_ts: float) -> None:
+    history = application.bot_data.setdefault("storage_history", deque(maxlen=10000))
+    history.append(
+        (
+            now_ts,
+            int(snapshot.get("uploads_size_bytes", 0) or 0),
+            int(snapshot.get("uploads_fs_free_bytes", 0) or 0),
+        )
     )
+    window_seconds = max(DISK_FORECAST_WINDOW_HOURS, 1) * 3600
+    while history and now_ts - history[0][0] > window_seconds:
+        history.popleft()
 
 
-async def send_output_chunks(
-    update: Update,
-    title: str,
-    content: str,
-    *,
-    include_keyboard: bool = False,
-) -> None:
-    if update.message is None:
-        return
+def theil_sen_slope(xs: list[float], ys: list[float]) -> Optional[float]:
+    slopes = [
+        (ys[j] - ys[i]) / (xs[j] - xs[i])
+        for i in range(len(xs))
+        for j in range(i + 1, len(xs))
+        if xs[j] != xs[i]
+    ]
+    if not slopes:
+        return None
+    return statistics.median(slopes)
 
-    chunks = split_output_chunks(content, DEPLOY_OUTPUT_CHUNK_SIZE)
-    if not chunks:
-        return
 
-    limited_chunks = chunks[: max(DEPLOY_OUTPUT_MAX_CHUNKS, 1)]
-    total = len(limited_chunks)
-    truncated = len(chunks) > total
+def build_disk_forecast(application: Application) -> Optional[dict[str, Any]]:
+    history = list(application.bot_data.get("storage_history") or [])
+    if len(history) < DISK_FORECAST_MIN_POINTS:
+        return None
+    span_seconds = history[-1][0] - history[0][0]
+    if span_seconds < DISK_FORECAST_MIN_SPAN_SECONDS:
+        return None
 
-    for idx, chunk in enumerate(limited_chunks, start=1):
+    # Theil–Sen считает O(n^2) пар, поэтому длинную историю равномерно прореживаем.
+    stride = max((len(history) + DISK_FORECAST_MAX_POINTS - 1) // DISK_FORECAST_MAX_POINTS, 1)
+    points = history[::stride]
+    if points[-1] is not history[-1]:
+        points.append(history[-1])
+
+    xs = [point[0] for point in points]
+    size_slope = theil_sen_slope(xs, [float(point[1]) for point in points])
+    free_slope = theil_sen_slope(xs, [float(point[2]) for point in points])
+    if size_slope is None or free_slope is None:
+        return None
+
+    free_bytes = history[-1][2]
+    eta_seconds: Optional[float] = None
+    if free_slope < 0:
+        eta_seconds = free_bytes / -free_slope
+
+    return {
+        "size_slope": size_slope,
+        "free_slope": free_slope,
+        "free_bytes": free_bytes,
+        "eta_seconds": eta_seconds,
+        "points": len(points),
+        "span_seconds": span_seconds,
+    }
+
+
+def build_forecast_issues(forecast: Optional[dict[str, Any]]) -> dict[str, str]:
+    if forecast is None or forecast.get("eta_seconds") is None:
+        return {}
+    horizon_hours = max(DISK_FORECAST_ALERT_HORIZON_HOURS, 1)
+    if float(forecast["eta_seconds"]) >= horizon_hours * 3600:
+        return {}
+    # Текст стабилен между тиками, чтобы алерт не повторялся на каждом обновлении ETA.
+    return {"disk_forecast": f"Uploads disk forecast: full in < {horizon_hours} h"}
+
+
+def _ewma_update(state: list[float], value: float, alpha: float) -> None:
+    # state = [mean, var, count]; инкрементальная EWMA-дисперсия (West, 1979).
+    if state[2] == 0:
+        state[0] = value
+        state[1] = 0.0
+    else:
+        diff = value - state[0]
+        increment = alpha * diff
+        state[0] += increment
+        state[1] = (1 - alpha) * (state[1] + diff * increment)
+    state[2] += 1
+
+
+def build_anomaly_issues(
+    application: Application,
+    snapshot: dict[str, Any],
+    now_ts: float,
+) -> dict[str, str]:
+    if not ANOMALY_DETECTION_ENABLED:
+        return {}
+
+    states = application.bot_data.setdefault("anomaly_state", {})
+    moment = datetime.fromtimestamp(now_ts, timezone.utc)
+    hour_bucket = moment.hour
+    week_bucket = moment.weekday() * 24 + moment.hour
+    alpha = min(max(ANOMALY_EWMA_ALPHA, 0.001), 1.0)
+    seasonal_alpha = min(max(ANOMALY_SEASONAL_ALPHA, 0.001), 1.0)
+    sustain_ticks = max(ANOMALY_SUSTAIN_TICKS, 1)
+    issues: dict[str, str] = {}
+
+    for metric, label in ANOMALY_METRICS.items():
+        value = float(snapshot.get(metric, 0) or 0)
+        # Фиксированный объем на метрику: глобальная EWMA, 24 средних по часу суток,
+        # 168 по (день недели x час) и EWMA-дисперсия остатка относительно ожидаемого уровня.
+        state = states.setdefault(
+            metric,
+            {
+                "global": [0.0, 0.0, 0],
+                "hourly": [[0.0, 0.0, 0] for _ in range(24)],
+                "weekly": [[0.0, 0.0, 0] for _ in range(7 * 24)],
+                "residual": [0.0, 0.0, 0],
+                "streak": 0,
+                "calm": 0,
+                "active": False,
+                "direction": 0,
+            },
+        )
+        global_baseline = state["global"]
+        hourly_baseline = state["hourly"][hour_bucket]
+        weekly_baseline = state["weekly"][week_bucket]
+        # Берем самый точный из прогретых уровней: день недели + час -> час суток -> глобальный.
+        if weekly_baseline[2] >= ANOMALY_SEASONAL_MIN_SAMPLES:
+            expected = weekly_baseline[0]
+        elif hourly_baseline[2] >= ANOMALY_SEASONAL_MIN_SAMPLES:
+            expected = hourly_baseline[0]
+        else:
+            expected = global_baseline[0]
+        residual = value - expected
+        is_outlier = False
+
+        if global_baseline[2] >= ANOMALY_WARMUP_SAMPLES:
+            # Пол для дисперсии: на почти постоянной метрике любое колебание дало бы огромный z.
+            floor = max((0.05 * abs(expected)) ** 2, 1.0)
+            z_score = residual / math.sqrt(max(state["residual"][1], floor))
+            is_outlier = abs(z_score) >= ANOMALY_Z_THRESHOLD
+
+            if is_outlier:
+                state["streak"] += 1
+                state["calm"] = 0
+                state["direction"] = 1 if z_score > 0 else -1
+            else:
+                state["streak"] = 0
+                state["calm"] = state["calm"] + 1 if abs(z_score) < ANOMALY_Z_CLEAR else 0
+
+            # Гистерезис: включаемся после N подряд отклонений, выключаемся после N спокойных тиков.
+            if not state["active"] and state["streak"] >= sustain_ticks:
+                state["active"] = True
+            elif state["active"] and state["calm"] >= sustain_ticks:
+                state["active"] = False
+
+            if state["active"]:
+                direction = "выше" if state["direction"] > 0 else "ниже"
+                issues[f"anomaly_{metric}"] = (
+                    f"Anomaly {label}: {direction} обычного уровня (|z| >= {ANOMALY_Z_THRESHOLD:g})"
+                )
+
+        # На выбросах учимся в 10 раз медленнее: длительная аномалия не должна
+        # сразу стать новой нормой, но устойчивый сдвиг уровня со временем усваивается.
+        learn = 0.1 if is_outlier else 1.0
+        _ewma_update(global_baseline, value, alpha * learn)
+        _ewma_update(hourly_baseline, value, seasonal_alpha * learn)
+        _ewma_update(weekly_baseline, value, seasonal_alpha * learn)
+        _ewma_update(state["residual"], residual, alpha * learn)
+
+    return issues
+
+
+def mann_kendall_z(values: list[float]) -> float:
+    n = len(values)
+    if n < 3:
+        return 0.0
+    s_stat = 0
+    for i in range(n - 1):
+        for j in range(i + 1, n):
+            diff = values[j] - values[i]
+            if diff > 0:
+                s_stat += 1
+            elif diff < 0:
+                s_stat -= 1
+
+    tie_counts: dict[float, int] = {}
+    for value in values:
+        tie_counts[value] = tie_counts.get(value, 0) + 1
+    tie_term = sum(t * (t - 1) * (2 * t + 5) for t in tie_counts.values() if t > 1)
+    variance = (n * (n - 1) * (2 * n + 5) - tie_term) / 18
+    if variance <= 0:
+        return 0.0
+    if s_stat > 0:
+        return (s_stat - 1) / math.sqrt(variance)
+    if s_stat < 0:
+        return (s_stat + 1) / math.sqrt(variance)
+    return 0.0
+
+
+def record_leak_sample(application: Application, snapshot: dict[str, Any], now_ts: float) -> None:
+    history = application.bot_data.get("leak_history")
+    if history is None or history.maxlen != max(LEAK_WINDOW_SAMPLES, LEAK_MIN_SAMPLES):
+        history = deque(maxlen=max(LEAK_WINDOW_SAMPLES, LEAK_MIN_SAMPLES))
+        application.bot_data["leak_history"] = history
+
+    uptime = int(snapshot.get("uptime_seconds", 0) or 0)
+    # Backend перезапустился: старая серия больше не описывает текущий процесс.
+    if uptime < int(application.bot_data.get("leak_last_uptime", 0) or 0):
+        history.clear()
+    application.bot_data["leak_last_uptime"] = uptime
+
+    history.append(
+        (
+            now_ts,
+            float(snapshot.get("goroutines", 0) or 0),
+            float(snapshot.get("go_heap_in_use_bytes", 0) or 0),
+            int(snapshot.get("go_gc_count", 0) or 0),
+        )
+    )
+
+
+def _post_gc_minima(samples: list[tuple[float, float, float, int]]) -> list[tuple[float, float]]:
+    # Оставляем только точки, между которыми прошел хотя бы один GC,
+    # и берем минимум heap по каждой группе: это «пол» кучи после сборок.
+    after_gc = [
+        (samples[idx][0], samples[idx][2])
+        for idx in range(1, len(samples))
+        if samples[idx][3] > samples[idx - 1][3]
+    ]
+    minima: list[tuple[float, float]] = []
+    for start in range(0, len(after_gc), LEAK_MINIMA_CHUNK):
+        chunk = after_gc[start : start + LEAK_MINIMA_CHUNK]
+        if len(chunk) == LEAK_MINIMA_CHUNK:
+            minima.append(min(chunk, key=lambda item: item[1]))
+    return minima
+
+
+def analyze_resource_leaks(application: Application) -> list[dict[str, Any]]:
+    samples = list(application.bot_data.get("leak_history") or [])
+    if len(samples) < LEAK_MIN_SAMPLES:
+        return []
+
+    # История утечек ведется по основной цели — и ETA считаем до ее порогов,
+    # с учетом переопределений BACKEND_<NAME>_ALERT_MAX_*.
+    thresholds = PRIMARY_TARGET.thresholds
+    series = {
+        "goroutines": (
+            "Goroutines",
+            [(sample[0], sample[1]) for sample in samples],
+            float(thresholds["ALERT_MAX_GOROUTINES"]),
+        ),
+        "heap": (
+            "Go heap_in_use",
+            _post_gc_minima(samples),
+            float(thresholds["ALERT_MAX_GO_MEMORY_MB"]) * 1024 * 1024,
+        ),
+    }
+
+    leaks: list[dict[str, Any]] = []
+    for key, (label, points, limit) in series.items():
+        if len(points) < 4:
+            continue
+        values = [point[1] for point in points]
+        z_score = mann_kendall_z(values)
+        if z_score < LEAK_MK_Z_THRESHOLD:
+            continue
+        slope = theil_sen_slope([point[0] for point in points], values)
+        if slope is None or slope <= 0:
+            continue
+        current = samples[-1][1] if key == "goroutines" else samples[-1][2]
+        eta_seconds = (limit - current) / slope if current < limit else 0.0
+        leaks.append(
+            {
+                "key": key,
+                "label": label,
+                "z_score": z_score,
+                "rate_per_hour": slope * 3600,
+                "current": current,
+                "limit": limit,
+                "eta_seconds": eta_seconds,
+            }
+        )
+    return leaks
+
+
+def build_leak_issues(application: Application) -> dict[str, str]:
+    announced = application.bot_data.setdefault("leak_announced", {})
+    if not LEAK_DETECTION_ENABLED:
+        announced.clear()
+        return {}
+
+    issues: dict[str, str] = {}
+    for leak in analyze_resource_leaks(application):
+        issue_key = f"leak_{leak['key']}"
+        text = announced.get(issue_key)
+        if text is None:
+            # Текст фиксируется при первом обнаружении, чтобы алерт не повторялся,
+            # пока оценки скорости и ETA немного плавают между тиками.
+            if leak["key"] == "goroutines":
+                rate = f"+{leak['rate_per_hour']:.1f}/ч"
+                limit = f"{int(leak['limit'])}"
+            else:
+                rate = f"+{format_bytes(int(leak['rate_per_hour']))}/ч"
+                limit = f"{ALERT_MAX_GO_MEMORY_MB} MB"
+            text = (
+                f"Leak suspected: {leak['label']} растет монотонно ({rate}, MK z={leak['z_score']:.2f}), "
+                f"до {limit} ~{format_duration(leak['eta_seconds'])}"
+            )
+            announced[issue_key] = text
+        issues[issue_key] = text
+
+    for stale_key in set(announced) - set(issues):
+        announced.pop(stale_key, None)
+    return issues
+
+
+def extract_numeric_metrics(snapshot: dict[str, Any]) -> dict[str, float]:
+    return {
+        key: float(value)
+        for key, value in snapshot.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+
+
+class MetricsStore:
+    # SQLite в режиме WAL: сырые снимки за короткий срок + rollup-таблица
+    # (min/max/sum/count/last) по уровням 1m/1h/1d. Все методы блокирующие,
+    # из event loop их вызывают через asyncio.to_thread.
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS snapshots (
+                ts REAL PRIMARY KEY,
+                payload TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS metric_rollups (
+                tier INTEGER NOT NULL,
+                metric TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                min REAL NOT NULL,
+                max REAL NOT NULL,
+                sum REAL NOT NULL,
+                count INTEGER NOT NULL,
+                last REAL NOT NULL,
+                last_ts REAL NOT NULL,
+                PRIMARY KEY (tier, metric, bucket)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS user_usage_samples (
+                ts REAL NOT NULL,
+                user_id INTEGER NOT NULL,
+                used_bytes INTEGER NOT NULL,
+                PRIMARY KEY (ts, user_id)
+            ) WITHOUT ROWID;
+            """
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def write_batch(self, batch: list[tuple[float, dict[str, Any]]]) -> None:
+        if not batch:
+            return
+        rollup_rows = []
+        for ts, snapshot in batch:
+            for metric, value in extract_numeric_metrics(snapshot).items():
+                for tier in METRICS_ROLLUP_TIERS:
+                    bucket = int(ts // tier) * tier
+                    rollup_rows.append((tier, metric, bucket, value, value, value, value, ts))
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO snapshots (ts, payload) VALUES (?, ?)",
+                [(ts, json.dumps(snapshot, ensure_ascii=False)) for ts, snapshot in batch],
+            )
+            self._conn.executemany(
+                "INSERT INTO metric_rollups (tier, metric, bucket, min, max, sum, count, last, last_ts) "
+                "VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?) "
+                "ON CONFLICT (tier, metric, bucket) DO UPDATE SET "
+                "min = MIN(min, excluded.min), "
+                "max = MAX(max, excluded.max), "
+                "sum = sum + excluded.sum, "
+                "count = count + 1, "
+                "last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last ELSE last END, "
+                "last_ts = MAX(last_ts, excluded.last_ts)",
+                rollup_rows,
+            )
+            self._prune(batch[-1][0])
+
+    def _prune(self, now_ts: float) -> None:
+        self._conn.execute(
+            "DELETE FROM snapshots WHERE ts < ?",
+            (now_ts - max(METRICS_RAW_RETENTION_HOURS, 1) * 3600,),
+        )
+        for tier, retention in METRICS_ROLLUP_TIERS.items():
+            self._conn.execute(
+                "DELETE FROM metric_rollups WHERE tier = ? AND bucket < ?",
+                (tier, now_ts - retention),
+            )
+
+    def write_user_usage(self, ts: float, usage: list[tuple[int, int]], min_interval: float) -> bool:
+        # Выборка занятого места по пользователям для /top_users day|week: не чаще
+        # min_interval, старше TOP_USERS_SAMPLE_RETENTION_SECONDS удаляется.
+        with self._lock, self._conn:
+            last_ts = self._conn.execute("SELECT MAX(ts) FROM user_usage_samples").fetchone()[0]
+            if last_ts is not None and ts - float(last_ts) < min_interval:
+                return False
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO user_usage_samples (ts, user_id, used_bytes) VALUES (?, ?, ?)",
+                [(ts, user_id, used_bytes) for user_id, used_bytes in usage],
+            )
+            self._conn.execute(
+                "DELETE FROM user_usage_samples WHERE ts < ?",
+                (ts - TOP_USERS_SAMPLE_RETENTION_SECONDS,),
+            )
+        return True
+
+    def load_user_usage_baseline(self, since_ts: float) -> Optional[tuple[float, dict[int, int]]]:
+        # Самая ранняя выборка не старше since_ts — база для расчета роста.
+        with self._lock:
+            base_ts = self._conn.execute(
+                "SELECT MIN(ts) FROM user_usage_samples WHERE ts >= ?",
+                (since_ts,),
+            ).fetchone()[0]
+            if base_ts is None:
+                return None
+            rows = self._conn.execute(
+                "SELECT user_id, used_bytes FROM user_usage_samples WHERE ts = ?",
+                (base_ts,),
+            ).fetchall()
+        return float(base_ts), {int(user_id): int(used_bytes) for user_id, used_bytes in rows}
+
+    def load_snapshots(self, since_ts: float) -> list[tuple[float, dict[str, Any]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT ts, payload FROM snapshots WHERE ts >= ? ORDER BY ts",
+                (since_ts,),
+            ).fetchall()
+        out: list[tuple[float, dict[str, Any]]] = []
+        for ts, payload in rows:
+            try:
+                out.append((float(ts), json.loads(payload)))
+            except ValueError:
+                continue
+        return out
+
+    def pick_tier(self, start_ts: float, end_ts: float, max_points: int, min_points: int = 0) -> int:
+        now_ts = now_utc_ts()
+        span = max(end_ts - start_ts, 1.0)
+        if min_points > 0:
+            # Для графика: самый грубый из хранящих окно тиров, у которого точек не меньше,
+            # чем пикселей; если такого нет — самый подробный из доступных.
+            available = [
+                tier for tier, retention in sorted(METRICS_ROLLUP_TIERS.items())
+                if now_ts - start_ts <= retention
+            ]
+            dense = [tier for tier in available if span / tier >= min_points]
+            if dense:
+                return dense[-1]
+            return available[0] if available else max(METRICS_ROLLUP_TIERS)
+        for tier, retention in sorted(METRICS_ROLLUP_TIERS.items()):
+            if now_ts - start_ts <= retention and span / tier <= max(max_points, 1):
+                return tier
+        return max(METRICS_ROLLUP_TIERS)
+
+    def query(
+        self,
+        metrics: list[str],
+        start_ts: float,
+        end_ts: float,
+        max_points: int = 1000,
+        min_points: int = 0,
+    ) -> tuple[int, dict[str, list[tuple[float, float, float, float, float]]]]:
+        tier = self.pick_tier(start_ts, end_ts, max_points, min_points)
+        out: dict[str, list[tuple[float, float, float, float, float]]] = {}
+        with self._lock:
+            for metric in metrics:
+                rows = self._conn.execute(
+                    "SELECT bucket, min, max, sum / count, last FROM metric_rollups "
+                    "WHERE tier = ? AND metric = ? AND bucket >= ? AND bucket <= ? "
+                    "ORDER BY bucket",
+                    (tier, metric, int(start_ts // tier) * tier, end_ts),
+                ).fetchall()
+                out[metric] = [tuple(float(value) for value in row) for row in rows]
+        return tier, out
+
+    def known_metrics(self) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT metric FROM metric_rollups WHERE tier = ? ORDER BY metric",
+                (max(METRICS_ROLLUP_TIERS),),
+            ).fetchall()
+        return [str(row[0]) for row in rows]
+
+
+def get_metrics_store(application: Application) -> Optional[MetricsStore]:
+    store = application.bot_data.get("metrics_store")
+    return store if isinstance(store, MetricsStore) else None
+
+
+def enqueue_metrics_snapshot(application: Application, snapshot: dict[str, Any], now_ts: float) -> None:
+    if get_metrics_store(application) is None:
+        return
+    buffer = application.bot_data.setdefault("metrics_write_buffer", [])
+    buffer.append((now_ts, snapshot))
+    if len(buffer) >= max(METRICS_FLUSH_BATCH_SIZE, 1):
+        flush_event = application.bot_data.get("metrics_flush_event")
+        if flush_event is not None:
+            flush_event.set()
+
+
+async def flush_metrics_buffer(application: Application) -> None:
+    store = get_metrics_store(application)
+    batch = application.bot_data.get("metrics_write_buffer") or []
+    if store is None or not batch:
+        return
+    application.bot_data["metrics_write_buffer"] = []
+    try:
+        await asyncio.to_thread(store.write_batch, batch)
+    except Exception:
+        logger.exception("Ошибка записи истории метрик: batch=%s", len(batch))
+
+
+async def metrics_writer_loop(application: Application) -> None:
+    flush_event = application.bot_data.setdefault("metrics_flush_event", asyncio.Event())
+    while True:
+        try:
+            await asyncio.wait_for(flush_event.wait(), timeout=max(METRICS_FLUSH_INTERVAL_SECONDS, 1))
+        except asyncio.TimeoutError:
+            pass
+        flush_event.clear()
+        await flush_metrics_buffer(application)
+
+
+async def restore_metrics_history(application: Application) -> None:
+    store = get_metrics_store(application)
+    if store is None:
+        return
+    since_ts = now_utc_ts() - max(DISK_FORECAST_WINDOW_HOURS, 1) * 3600
+    snapshots = await asyncio.to_thread(store.load_snapshots, since_ts)
+    for ts, snapshot in snapshots:
+        record_storage_sample(application, snapshot, ts)
+        record_leak_sample(application, snapshot, ts)
+    logger.info("История метрик восстановлена: snapshots=%s", len(snapshots))
+
+
+class BotStateStore:
+    # Небольшое key/value-хранилище состояния бота (JSON по ключу) в SQLite.
+    # Хендлеры только помечают ключи грязными, запись идет пачкой из фоновой задачи.
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bot_state ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def load_all(self) -> dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM bot_state").fetchall()
+        state: dict[str, Any] = {}
+        for key, value in rows:
+            try:
+                state[key] = json.loads(value)
+            except ValueError:
+                logger.warning("Поврежденное состояние бота: key=%s", key)
+        return state
+
+    def save(self, items: dict[str, str]) -> None:
+        if not items:
+            return
+        updated_at = now_utc_ts()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO bot_state (key, value, updated_at) VALUES (?, ?, ?)",
+                [(key, value, updated_at) for key, value in items.items()],
+            )
+
+
+def get_bot_state_store(application: Application) -> Optional[BotStateStore]:
+    store = application.bot_data.get("bot_state_store")
+    return store if isinstance(store, BotStateStore) else None
+
+
+def mark_state_dirty(application: Application, key: str) -> None:
+    application.bot_data.setdefault("state_dirty_keys", set()).add(key)
+
+
+def collect_state_value(application: Application, key: str) -> Any:
+    if key == "runtime_chat_ids":
+        return sorted(application.bot_data.get("runtime_chat_ids", set()))
+    if key == "watchdog":
+        return application.bot_data.get("watchdog_state")
+    if key == "deploy":
+        return application.bot_data.get("deploy_state")
+    return None
+
+
+async def flush_bot_state(application: Application) -> None:
+    store = get_bot_state_store(application)
+    dirty = application.bot_data.get("state_dirty_keys")
+    if store is None or not dirty:
+        return
+    application.bot_data["state_dirty_keys"] = set()
+    try:
+        items = {
+            key: json.dumps(collect_state_value(application, key), ensure_ascii=False)
+            for key in dirty
+        }
+        await asyncio.to_thread(store.save, items)
+    except Exception:
+        logger.exception("Ошибка сохранения состояния бота: keys=%s", sorted(dirty))
+        application.bot_data.setdefault("state_dirty_keys", set()).update(dirty)
+
+
+async def bot_state_writer_loop(application: Application) -> None:
+    while True:
+        await asyncio.sleep(max(BOT_STATE_FLUSH_INTERVAL_SECONDS, 1))
+        await flush_bot_state(application)
+
+
+async def restore_bot_state(application: Application) -> None:
+    store = get_bot_state_store(application)
+    if store is None:
+        return
+    state = await asyncio.to_thread(store.load_all)
+
+    raw_chat_ids = state.get("runtime_chat_ids")
+    if isinstance(raw_chat_ids, list):
+        application.bot_data["runtime_chat_ids"] = {
+            int(chat_id) for chat_id in raw_chat_ids if isinstance(chat_id, int)
+        }
+
+    watchdog_state = state.get("watchdog")
+    if isinstance(watchdog_state, dict):
+        application.bot_data["watchdog_state"] = watchdog_state
+        leak_announced = watchdog_state.get("leak_announced")
+        if isinstance(leak_announced, dict):
+            application.bot_data["leak_announced"] = dict(leak_announced)
+
+    deploy_state = state.get("deploy")
+    if isinstance(deploy_state, dict):
+        application.bot_data["interrupted_deploy"] = deploy_state
+        application.bot_data["deploy_state"] = None
+        mark_state_dirty(application, "deploy")
+
+    logger.info(
+        "Состояние бота восстановлено: runtime_chats=%s, watchdog=%s",
+        len(application.bot_data.get("runtime_chat_ids", set())),
+        "yes" if isinstance(watchdog_state, dict) else "no",
+    )
+
+
+def remember_watchdog_state(
+    application: Application,
+    target_states: dict[str, dict[str, Any]],
+) -> None:
+    state = {
+        "targets": {
+            name: {"backend_up": value.get("backend_up"), "issues": dict(value.get("issues") or {})}
+            for name, value in target_states.items()
+        },
+        "leak_announced": dict(application.bot_data.get("leak_announced", {})),
+    }
+    if state != application.bot_data.get("watchdog_state"):
+        application.bot_data["watchdog_state"] = state
+        mark_state_dirty(application, "watchdog")
+
+
+async def notify_interrupted_deploy(application: Application) -> None:
+    deploy_state = application.bot_data.pop("interrupted_deploy", None)
+    if not isinstance(deploy_state, dict) or not isinstance(deploy_state.get("chat_id"), int):
+        return
+    started_at = datetime.fromtimestamp(float(deploy_state.get("started_at", 0)), tz=timezone.utc)
+    try:
+        await application.bot.send_message(
+            chat_id=deploy_state["chat_id"],
+            text=(
+                "♻️ <b>Бот перезапущен во время деплоя</b>\n"
+                f"• branch: <code>{html.escape(str(deploy_state.get('branch', '-')))}</code>\n"
+                f"• начат: <code>{started_at.strftime('%Y-%m-%d %H:%M:%S UTC')}</code>\n"
+                "Вывод скрипта не получен, проверьте /status."
+            ),
+            parse_mode=ParseMode.HTML,
+        )
+    except Exception:
+        logger.exception("Не удалось уведомить о прерванном деплое")
+
+
+def openmetrics_name(raw: str) -> str:
+    name = re.sub(r"[^a-zA-Z0-9_]", "_", raw)
+    return name if not name[:1].isdigit() else f"_{name}"
+
+
+def openmetrics_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def openmetrics_number(value: float) -> str:
+    # repr дал бы nan/inf, а парсер OpenMetrics принимает только NaN, +Inf и -Inf.
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render_openmetrics(application: Application) -> bytes:
+    # Только уже собранные данные: последний снимок watchdog, гистограммы задержек
+    # и внутренние счетчики. В backend ничего не запрашивается.
+    out = io.StringIO()
+    write = out.write
+
+    # Каждая серия backend помечена target: семейство выводится один раз со строками всех целей.
+    health = application.bot_data.get("target_health") or {}
+    write("# TYPE cloudtune_backend_up gauge\n")
+    for target in BACKEND_TARGETS:
+        is_up = (health.get(target.name) or (False, ""))[0]
+        write(f'cloudtune_backend_up{{target="{openmetrics_label(target.name)}"}} {1 if is_up else 0}\n')
+
+    snapshots = application.bot_data.get("target_snapshots") or {}
+    families: dict[str, tuple[str, list[str]]] = {}
+    for target in BACKEND_TARGETS:
+        last = snapshots.get(target.name)
+        if last is None:
+            continue
+        snapshot_ts, snapshot = last
+        label = f'{{target="{openmetrics_label(target.name)}"}}'
+        families.setdefault(
+            "cloudtune_backend_snapshot_timestamp_seconds", ("gauge", [])
+        )[1].append(f"cloudtune_backend_snapshot_timestamp_seconds{label} {snapshot_ts:.3f}")
+        for key, value in sorted(extract_numeric_metrics(snapshot).items()):
+            counter = BACKEND_OPENMETRICS_COUNTERS.get(key)
+            if counter is not None:
+                family = f"cloudtune_backend_{counter}"
+                families.setdefault(family, ("counter", []))[1].append(
+                    f"{family}_total{label} {openmetrics_number(value)}"
+                )
+                continue
+            name = BACKEND_OPENMETRICS_GAUGES.get(key) or openmetrics_name(key)
+            if name.endswith("_total"):
+                # Суффикс _total в OpenMetrics зарезервирован за счетчиками.
+                name = name[: -len("_total")]
+            family = f"cloudtune_backend_{name}"
+            families.setdefault(family, ("gauge", []))[1].append(
+                f"{family}{label} {openmetrics_number(value)}"
+            )
+    for family, (kind, samples) in families.items():
+        write(f"# TYPE {family} {kind}\n")
+        if family == "cloudtune_backend_snapshot_timestamp_seconds":
+            write(f"# UNIT {family} seconds\n")
+        write("\n".join(samples) + "\n")
+
+    write("# TYPE cloudtune_bot_latency_seconds summary\n")
+    write("# UNIT cloudtune_bot_latency_seconds seconds\n")
+    for name, hist in sorted(LATENCY_HISTOGRAMS.items()):
+        label = openmetrics_label(name)
+        for q in METRICS_EXPORTER_QUANTILES:
+            seconds = openmetrics_number(round(hist.percentile(q) / 1000, 6))
+            write(f'cloudtune_bot_latency_seconds{{name="{label}",quantile="{q:g}"}} {seconds}\n')
+        total_seconds = openmetrics_number(round(hist.total_ms / 1000, 6))
+        write(f'cloudtune_bot_latency_seconds_sum{{name="{label}"}} {total_seconds}\n')
+        write(f'cloudtune_bot_latency_seconds_count{{name="{label}"}} {hist.count}\n')
+    write("# TYPE cloudtune_bot_latency_errors counter\n")
+    for name, hist in sorted(LATENCY_HISTOGRAMS.items()):
+        write(f'cloudtune_bot_latency_errors_total{{name="{openmetrics_label(name)}"}} {hist.errors}\n')
+
+    queues = {
+        "metrics_write_buffer": len(application.bot_data.get("metrics_write_buffer") or []),
+        "state_dirty_keys": len(application.bot_data.get("state_dirty_keys") or ()),
+        "prefetch_tasks": len(application.bot_data.get("prefetch_tasks") or ()),
+        "live_sessions": len(application.bot_data.get("live_sessions") or {}),
+    }
+    processor = application.update_processor
+    if isinstance(processor, PrioritizedUpdateProcessor):
+        update_stats = processor.stats()
+        queues["updates_pending"] = update_stats["queued"]
+        queues["updates_active"] = update_stats["active"]
+    write("# TYPE cloudtune_bot_queue_depth gauge\n")
+    for queue, depth in queues.items():
+        write(f'cloudtune_bot_queue_depth{{queue="{queue}"}} {depth}\n')
+
+    counters = application.bot_data.get("alert_counters") or {"sent": 0, "failed": 0}
+    write("# TYPE cloudtune_bot_alerts counter\n")
+    write(f'cloudtune_bot_alerts_total{{result="sent"}} {counters["sent"]}\n')
+    write(f'cloudtune_bot_alerts_total{{result="failed"}} {counters["failed"]}\n')
+    watchdog_targets = (application.bot_data.get("watchdog_state") or {}).get("targets") or {}
+    write("# TYPE cloudtune_bot_active_issues gauge\n")
+    for target in BACKEND_TARGETS:
+        issues = (watchdog_targets.get(target.name) or {}).get("issues") or {}
+        write(f'cloudtune_bot_active_issues{{target="{openmetrics_label(target.name)}"}} {len(issues)}\n')
+    if isinstance(processor, PrioritizedUpdateProcessor):
+        write("# TYPE cloudtune_bot_updates counter\n")
+        for priority_name, count in update_stats["processed"].items():
+            write(f'cloudtune_bot_updates_total{{priority="{priority_name}"}} {count}\n')
+        write("# TYPE cloudtune_bot_updates_coalesced counter\n")
+        write(f"cloudtune_bot_updates_coalesced_total {update_stats['coalesced']}\n")
+
+    guards = [
+        (f'dependency="backend",target="{openmetrics_label(target.name)}"', target.guard)
+        for target in BACKEND_TARGETS
+    ]
+    guards.append(('dependency="db"', DB_GUARD))
+    write("# TYPE cloudtune_bot_dependency_circuit_open gauge\n")
+    for labels, guard in guards:
+        write(f"cloudtune_bot_dependency_circuit_open{{{labels}}} {int(guard.state != 'closed')}\n")
+    write("# TYPE cloudtune_bot_dependency_in_flight gauge\n")
+    for labels, guard in guards:
+        write(f"cloudtune_bot_dependency_in_flight{{{labels}}} {guard.in_flight}\n")
+    write("# TYPE cloudtune_bot_dependency_rejected counter\n")
+    for labels, guard in guards:
+        write(f"cloudtune_bot_dependency_rejected_total{{{labels}}} {guard.rejected}\n")
+
+    cache_stats = user_cache_stats(application)
+    write("# TYPE cloudtune_bot_user_cache_requests counter\n")
+    write(f'cloudtune_bot_user_cache_requests_total{{result="hit"}} {cache_stats["hits"]}\n')
+    write(f'cloudtune_bot_user_cache_requests_total{{result="miss"}} {cache_stats["misses"]}\n')
+
+    write("# EOF\n")
+    return out.getvalue().encode("utf-8")
+
+
+def get_openmetrics_payload(application: Application) -> bytes:
+    cached = application.bot_data.get("openmetrics_cache")
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < METRICS_EXPORTER_CACHE_SECONDS:
+        return cached[1]
+    payload = render_openmetrics(application)
+    application.bot_data["openmetrics_cache"] = (now, payload)
+    return payload
+
+
+class HTTPBodyTooLarge(ValueError):
+    pass
+
+
+async def read_http_request(
+    reader: asyncio.StreamReader,
+    max_body_bytes: int = 0,
+) -> tuple[str, str, dict[str, str], bytes]:
+    request_line = await asyncio.wait_for(reader.readline(), timeout=HTTP_READ_TIMEOUT_SECONDS)
+    headers: dict[str, str] = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout=HTTP_READ_TIMEOUT_SECONDS)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    parts = request_line.decode("latin-1").split()
+    method = parts[0].upper() if parts else ""
+    path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+    body = b""
+    length = int(headers.get("content-length", "0") or 0)
+    if length < 0:
+        raise ValueError(f"bad content-length: {length}")
+    if length > max_body_bytes:
+        raise HTTPBodyTooLarge(f"request body too large: {length}")
+    if length:
+        body = await asyncio.wait_for(reader.readexactly(length), timeout=HTTP_READ_TIMEOUT_SECONDS)
+    return method, path, headers, body
+
+
+async def write_http_response(
+    writer: asyncio.StreamWriter,
+    status: str,
+    body: bytes,
+    content_type: str = "text/plain; charset=utf-8",
+) -> None:
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+        + body
+    )
+    await writer.drain()
+
+
+async def handle_metrics_request(
+    application: Application,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    try:
+        method, path, _, _ = await read_http_request(reader)
+        if method == "GET" and path == "/metrics":
+            await write_http_response(
+                writer, "200 OK", get_openmetrics_payload(application), OPENMETRICS_CONTENT_TYPE
+            )
+        else:
+            await write_http_response(writer, "404 Not Found", b"not found\n")
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    except Exception:
+        logger.exception("Ошибка обработки запроса /metrics")
+    finally:
+        writer.close()
+
+
+async def handle_webhook_request(
+    application: Application,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    # Telegram ждет быстрый 2xx: апдейт только кладется в update_queue, дальше его
+    # разбирает тот же процессор апдейтов, что и в режиме polling.
+    try:
+        try:
+            method, path, headers, body = await read_http_request(reader, WEBHOOK_MAX_BODY_BYTES)
+        except HTTPBodyTooLarge:
+            await write_http_response(writer, "413 Payload Too Large", b"too large\n")
+            return
+        except ValueError:
+            # Неразбираемый Content-Length — это ошибка запроса, а не размер.
+            await write_http_response(writer, "400 Bad Request", b"bad request\n")
+            return
+        if path != WEBHOOK_PATH:
+            await write_http_response(writer, "404 Not Found", b"not found\n")
+            return
+        if method != "POST":
+            await write_http_response(writer, "405 Method Not Allowed", b"method not allowed\n")
+            return
+        secret = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(secret.encode("utf-8"), WEBHOOK_SECRET_TOKEN.encode("utf-8")):
+            logger.warning("Webhook: неверный secret token")
+            await write_http_response(writer, "403 Forbidden", b"forbidden\n")
+            return
+        try:
+            payload = json.loads(body)
+            # Валидный JSON, но не объект ([] или 1) ломает de_json на AttributeError.
+            if not isinstance(payload, dict):
+                raise ValueError("update must be a JSON object")
+            update = Update.de_json(payload, application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            await write_http_response(writer, "400 Bad Request", b"bad update\n")
+            return
+        if update is not None:
+            await application.update_queue.put(update)
+        await write_http_response(writer, "200 OK", b"ok\n")
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception:
+        logger.exception("Ошибка обработки webhook-запроса")
+    finally:
+        writer.close()
+
+
+async def start_metrics_exporter(application: Application) -> None:
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_metrics_request(application, reader, writer),
+        host=METRICS_EXPORTER_HOST,
+        port=METRICS_EXPORTER_PORT,
+    )
+    application.bot_data["metrics_exporter_server"] = server
+    logger.info("OpenMetrics exporter: http://%s:%s/metrics", METRICS_EXPORTER_HOST, METRICS_EXPORTER_PORT)
+
+
+def parse_range_seconds(raw: str) -> Optional[int]:
+    match = re.fullmatch(r"(\d+)([mhdw])", raw.strip().lower())
+    if match is None:
+        return None
+    multipliers = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+    value = int(match.group(1)) * multipliers[match.group(2)]
+    return value if value > 0 else None
+
+
+def encode_png(width: int, height: int, pixels: bytearray) -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    stride = width * 3
+    raw = b"".join(
+        b"\x00" + bytes(pixels[row * stride : (row + 1) * stride]) for row in range(height)
+    )
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def downsample_to_columns(
+    rows: list[tuple[float, float, float, float, float]],
+    start_ts: float,
+    end_ts: float,
+    columns: int,
+) -> list[Optional[tuple[float, float]]]:
+    # Min/max-децимация: на каждый пиксельный столбец одна пара (min, max),
+    # так пики не теряются при любом числе точек.
+    out: list[Optional[tuple[float, float]]] = [None] * columns
+    span = max(end_ts - start_ts, 1.0)
+    for bucket, low, high, _, _ in rows:
+        column = int((bucket - start_ts) / span * (columns - 1))
+        if column < 0 or column >= columns:
+            continue
+        current = out[column]
+        out[column] = (low, high) if current is None else (min(current[0], low), max(current[1], high))
+    return out
+
+
+def render_metric_chart_png(
+    series: list[tuple[str, list[tuple[float, float, float, float, float]]]],
+    start_ts: float,
+    end_ts: float,
+) -> bytes:
+    width = max(CHART_WIDTH, 200)
+    panel_height = max(CHART_PANEL_HEIGHT, 80)
+    height = panel_height * max(len(series), 1)
+    pixels = bytearray(b"\xff" * (width * height * 3))
+    plot_width = width - 2 * CHART_PADDING
+
+    def set_pixel(x: int, y: int, color: tuple[int, int, int]) -> None:
+        if 0 <= x < width and 0 <= y < height:
+            offset = (y * width + x) * 3
+            pixels[offset : offset + 3] = bytes(color)
+
+    def vertical(x: int, y0: int, y1: int, color: tuple[int, int, int]) -> None:
+        for y in range(min(y0, y1), max(y0, y1) + 1):
+            set_pixel(x, y, color)
+
+    def horizontal(y: int, x0: int, x1: int, color: tuple[int, int, int]) -> None:
+        for x in range(x0, x1 + 1):
+            set_pixel(x, y, color)
+
+    for panel_idx, (_, rows) in enumerate(series):
+        color = CHART_COLORS[panel_idx % len(CHART_COLORS)][1]
+        top = panel_idx * panel_height + CHART_PADDING
+        bottom = (panel_idx + 1) * panel_height - CHART_PADDING
+        left, right = CHART_PADDING, width - CHART_PADDING - 1
+
+        for step in range(5):
+            y = top + (bottom - top) * step // 4
+            horizontal(y, left, right, (225, 225, 225) if 0 < step < 4 else (160, 160, 160))
+        vertical(left, top, bottom, (160, 160, 160))
+        vertical(right, top, bottom, (160, 160, 160))
+
+        columns = downsample_to_columns(rows, start_ts, end_ts, plot_width)
+        present = [column for column in columns if column is not None]
+        if not present:
+            continue
+        low = min(column[0] for column in present)
+        high = max(column[1] for column in present)
+        scale = (bottom - top) / (high - low) if high > low else 0.0
+
+        def to_y(value: float) -> int:
+            if scale == 0.0:
+                return (top + bottom) // 2
+            return int(round(bottom - (value - low) * scale))
+
+        previous: Optional[tuple[int, int]] = None
+        for idx, column in enumerate(columns):
+            x = left + idx
+            if column is None:
+                continue
+            y_low, y_high = to_y(column[0]), to_y(column[1])
+            vertical(x, y_low, y_high, color)
+            # Соединяем с предыдущим столбцом, чтобы линия не рвалась между бакетами.
+            if previous is not None:
+                prev_x, prev_y = previous
+                if x - prev_x > 1:
+                    for step_x in range(prev_x + 1, x):
+                        ratio = (step_x - prev_x) / (x - prev_x)
+                        set_pixel(step_x, int(round(prev_y + (y_low - prev_y) * ratio)), color)
+                vertical(x, prev_y, y_low, color)
+            previous = (x, y_high)
+
+    return encode_png(width, height, pixels)
+
+
+def format_chart_caption(
+    series: list[tuple[str, list[tuple[float, float, float, float, float]]]],
+    range_seconds: int,
+    tier: int,
+) -> str:
+    tier_labels = {60: "1m", 3600: "1h", 86400: "1d"}
+    lines = [
+        f"📈 <b>График за {format_duration(range_seconds)}</b> (rollup <code>{tier_labels.get(tier, tier)}</code>)"
+    ]
+    for idx, (metric, rows) in enumerate(series):
+        color_name = CHART_COLORS[idx % len(CHART_COLORS)][0]
+        if rows:
+            low = min(row[1] for row in rows)
+            high = max(row[2] for row in rows)
+            lines.append(
+                f"{idx + 1}. <b>{html.escape(metric)}</b> ({color_name}): "
+                f"<code>{low:,.0f}…{high:,.0f}</code>, last <code>{rows[-1][4]:,.0f}</code>"
+            )
+        else:
+            lines.append(f"{idx + 1}. <b>{html.escape(metric)}</b> ({color_name}): нет данных")
+    return "\n".join(lines)
+
+
+async def build_metric_chart(
+    application: Application,
+    store: MetricsStore,
+    metrics: list[str],
+    range_seconds: int,
+) -> tuple[bytes, str]:
+    cache = application.bot_data.setdefault("chart_cache", OrderedDict())
+    now_ts = now_utc_ts()
+    ttl = max(CHART_CACHE_TTL_SECONDS, 1)
+    cache_key = (tuple(metrics), range_seconds)
+    cached = cache.get(cache_key)
+    if cached is not None and now_ts - cached[0] < ttl:
+        cache.move_to_end(cache_key)
+        return cached[1], cached[2]
+
+    end_ts = now_ts
+    start_ts = end_ts - range_seconds
+
+    def render() -> tuple[bytes, str]:
+        # Берем тир с точками не реже пикселя, дальше render_metric_chart_png сводит их
+        # к паре min/max на столбец: 24ч на 800px рисуются из 1m, а не 24 точками 1h.
+        plot_width = max(CHART_WIDTH, 200) - 2 * CHART_PADDING
+        tier, data = store.query(metrics, start_ts, end_ts, min_points=plot_width)
+        series = [(metric, data.get(metric, [])) for metric in metrics]
+        return render_metric_chart_png(series, start_ts, end_ts), format_chart_caption(series, range_seconds, tier)
+
+    png, caption = await asyncio.to_thread(render)
+    cache[cache_key] = (now_ts, png, caption)
+    cache.move_to_end(cache_key)
+    while len(cache) > CHART_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+    return png, caption
+
+
+async def send_pretty_message(update: Update, text: str) -> None:
+    if update.message is None:
+        return
+    await update.message.reply_text(
+        text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=MENU_KEYBOARD,
+        disable_web_page_preview=True,
+    )
+
+
+async def send_output_chunks(
+    update: Update,
+    title: str,
+    content: str,
+    *,
+    include_keyboard: bool = False,
+) -> None:
+    if update.message is None:
+        return
+
+    chunks = split_output_chunks(content, DEPLOY_OUTPUT_CHUNK_SIZE)
+    if not chunks:
+        return
+
+    limited_chunks = chunks[: max(DEPLOY_OUTPUT_MAX_CHUNKS, 1)]
+    total = len(limited_chunks)
+    truncated = len(chunks) > total
+
+    for idx, chunk in enumerate(limited_chunks, start=1):
         suffix = f" ({idx}/{total})" if total > 1 else ""
         text = f"<b>{html.escape(title)}{suffix}</b>\n<pre>{html.escape(chunk)}</pre>"
         await update.message.reply_text(
@@ -1081,7 +4252,57 @@ async def send_output_chunks(
         )
 
 
-async def send_monitoring(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, path: str) -> None:
+async def coalesce_chat_request(
+    application: Application,
+    chat_id: int,
+    key: str,
+    producer: Callable[[], Awaitable[Any]],
+) -> Optional[Any]:
+    # Повторные нажатия кнопок меню в одном чате. Пока такой же запрос еще выполняется,
+    # новое нажатие склеивается с ним (возвращаем None — отвечать не нужно: ответ придет
+    # от первого). В окне REQUEST_DEBOUNCE_SECONDS после ответа отдаем готовый результат
+    # без запроса в backend/БД. Ошибки не кэшируются.
+    requests = application.bot_data.setdefault("chat_requests", {})
+    counters = application.bot_data.setdefault("chat_request_counters", {"folded": 0, "cached": 0})
+    generation = application.bot_data.get("page_cache_generation", 0)
+    now_ts = now_utc_ts()
+    entry = requests.get((chat_id, key))
+    if entry is not None:
+        if not entry["future"].done():
+            counters["folded"] += 1
+            return None
+        if (
+            now_ts - entry["done_at"] < REQUEST_DEBOUNCE_SECONDS
+            and entry["generation"] == generation
+        ):
+            counters["cached"] += 1
+            return entry["future"].result()
+
+    for stale_key, stale in list(requests.items()):
+        if stale["future"].done() and now_ts - stale["done_at"] >= REQUEST_DEBOUNCE_SECONDS:
+            del requests[stale_key]
+
+    future: asyncio.Future = asyncio.get_running_loop().create_future()
+    entry = {"future": future, "done_at": 0.0, "generation": generation}
+    requests[(chat_id, key)] = entry
+    try:
+        result = await producer()
+    except BaseException:
+        future.cancel()
+        requests.pop((chat_id, key), None)
+        raise
+    future.set_result(result)
+    entry["done_at"] = now_utc_ts()
+    return result
+
+
+async def send_monitoring(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    kind: str,
+    path: str,
+    target: Optional[BackendTarget] = None,
+) -> None:
     chat = update.effective_chat
     if chat is None or update.message is None:
         return
@@ -1092,9 +4313,23 @@ async def send_monitoring(update: Update, context: ContextTypes.DEFAULT_TYPE, ki
 
     register_runtime_chat(context.application, chat.id)
 
+    target = target or PRIMARY_TARGET
+
+    async def render() -> str:
+        text = await fetch_monitoring_text(path, target)
+        message = format_target_line(target) + format_monitoring_message(kind, text)
+        if kind == "storage" and target is PRIMARY_TARGET:
+            forecast = build_disk_forecast(context.application)
+            message += "\n\n" + "\n".join(format_disk_forecast_lines(forecast))
+        return message
+
     try:
-        text = await fetch_monitoring_text(path)
-        await send_pretty_message(update, format_monitoring_message(kind, text))
+        message = await coalesce_chat_request(
+            context.application, chat.id, f"monitoring:{target.name}:{path}", render
+        )
+        if message is None:
+            return
+        await send_pretty_message(update, message)
     except Exception as exc:
         logger.exception("Ошибка получения метрик")
         await send_pretty_message(
@@ -1104,7 +4339,11 @@ async def send_monitoring(update: Update, context: ContextTypes.DEFAULT_TYPE, ki
         )
 
 
-async def send_snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def send_snapshot(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    target: Optional[BackendTarget] = None,
+) -> None:
     chat = update.effective_chat
     if chat is None or update.message is None:
         return
@@ -1114,9 +4353,20 @@ async def send_snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     register_runtime_chat(context.application, chat.id)
+    target = target or PRIMARY_TARGET
+
+    async def render() -> str:
+        payload = await fetch_snapshot(target=target)
+        forecast = build_disk_forecast(context.application) if target is PRIMARY_TARGET else None
+        message = format_target_line(target) + format_snapshot(payload, forecast)
+        notice = format_stale_notice(payload)
+        return f"{notice}\n\n{message}" if notice else message
+
     try:
-        payload = await fetch_snapshot()
-        await send_pretty_message(update, format_snapshot(payload))
+        message = await coalesce_chat_request(context.application, chat.id, f"snapshot:{target.name}", render)
+        if message is None:
+            return
+        await send_pretty_message(update, message)
     except Exception as exc:
         logger.exception("Ошибка получения snapshot")
         await send_pretty_message(
@@ -1126,7 +4376,43 @@ async def send_snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         )
 
 
-async def send_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int) -> None:
+def format_targets_overview(
+    rows: list[tuple[BackendTarget, Optional[dict[str, Any]], Optional[str]]],
+) -> str:
+    table = [f"{'узел':<10} {'':<4} {'http':>5} {'db':>4} {'gor':>5} {'mem':>7} {'free':>8} {'5xx%':>5}"]
+    errors = []
+    for target, payload, error in rows:
+        name = shorten(target.name, 10)
+        if payload is None:
+            table.append(f"{name:<10} {'DOWN':<4}")
+            errors.append(
+                f"• <code>{html.escape(target.name)}</code>: <code>{html.escape(shorten(error or '-', 120))}</code>"
+            )
+            continue
+        state = "OLD" if payload.get("stale_at") else "UP"
+        table.append(
+            f"{name:<10} {state:<4} "
+            f"{int(payload.get('http_active_requests', 0) or 0):>5} "
+            f"{int(payload.get('db_in_use_connections', 0) or 0):>4} "
+            f"{int(payload.get('goroutines', 0) or 0):>5} "
+            f"{format_bytes(int(payload.get('go_memory_alloc_bytes', 0) or 0)):>7} "
+            f"{format_bytes(int(payload.get('uploads_fs_free_bytes', 0) or 0)):>8} "
+            f"{float(payload.get('upload_5xx_rate_pct', 0) or 0):>5.1f}"
+        )
+
+    lines = [
+        "🌐 <b>Сводка по узлам</b>",
+        f"🕒 <code>{now_utc()}</code>",
+        f"<pre>{html.escape(chr(10).join(table))}</pre>",
+    ]
+    if errors:
+        lines.append("Ошибки:")
+        lines.extend(errors)
+    lines.append("Подробно по узлу: <code>/status &lt;узел&gt;</code>, <code>/snapshot &lt;узел&gt;</code>")
+    return "\n".join(lines)
+
+
+async def send_targets_overview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
     if chat is None or update.message is None:
         return
@@ -1137,18 +4423,239 @@ async def send_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
 
     register_runtime_chat(context.application, chat.id)
 
+    async def render() -> str:
+        # Все узлы опрашиваются параллельно через общий пул соединений; медленный
+        # или недоступный узел не задерживает остальные дольше своего таймаута.
+        results = await asyncio.gather(
+            *(fetch_snapshot(target=target) for target in BACKEND_TARGETS),
+            return_exceptions=True,
+        )
+        rows = [
+            (target, None, str(result)) if isinstance(result, BaseException) else (target, result, None)
+            for target, result in zip(BACKEND_TARGETS, results)
+        ]
+        return format_targets_overview(rows)
+
     try:
-        payload = await fetch_monitoring_json(
-            "/api/monitor/users/list",
-            params={"page": max(page, 1), "limit": max(USERS_PAGE_SIZE, 1)},
+        message = await coalesce_chat_request(context.application, chat.id, "targets_overview", render)
+        if message is None:
+            return
+        await send_pretty_message(update, message)
+    except Exception as exc:
+        logger.exception("Ошибка получения сводки по узлам")
+        await send_pretty_message(
+            update,
+            "🚨 <b>Ошибка загрузки сводки по узлам</b>\n"
+            f"<code>{html.escape(str(exc))}</code>",
         )
-        text, keyboard = format_users_page(payload)
-        await update.message.reply_text(
+
+
+async def resolve_target_arg(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+) -> tuple[bool, Optional[BackendTarget]]:
+    # (ok, target): target=None без аргумента; ok=False — узел не найден, ответ уже отправлен.
+    if not context.args:
+        return True, None
+    target = find_backend_target(context.args[0])
+    if target is None:
+        known = ", ".join(f"<code>{html.escape(item.name)}</code>" for item in BACKEND_TARGETS)
+        await send_pretty_message(
+            update,
+            f"⚠️ Неизвестный узел <code>{html.escape(context.args[0])}</code>\nДоступные: {known}",
+        )
+        return False, None
+    return True, target
+
+
+def format_live_deltas(payload: dict[str, Any], previous: Optional[dict[str, Any]]) -> list[str]:
+    if previous is None:
+        return ["Δ с прошлого обновления: <code>первое обновление</code>"]
+
+    parts = []
+    for key, label, is_bytes in LIVE_DELTA_METRICS:
+        delta = int(payload.get(key, 0) or 0) - int(previous.get(key, 0) or 0)
+        if delta == 0:
+            continue
+        sign = "+" if delta > 0 else "-"
+        value = format_bytes(abs(delta)) if is_bytes else str(abs(delta))
+        parts.append(f"• {label}: <code>{sign}{value}</code>")
+    if not parts:
+        return ["Δ с прошлого обновления: <code>без изменений</code>"]
+    return ["Δ с прошлого обновления:", *parts]
+
+
+def render_live_dashboard(
+    session: dict[str, Any],
+    payload: Optional[dict[str, Any]],
+    forecast: Optional[dict[str, Any]],
+    error: Optional[str],
+) -> tuple[str, str]:
+    expires_at = datetime.fromtimestamp(session["expires_at"], timezone.utc).strftime("%H:%M:%S UTC")
+    header = (
+        f"🔴 <b>Live</b> • каждые <code>{session['interval']}</code> сек • до <code>{expires_at}</code>\n"
+        "Остановить: <code>/live stop</code>\n\n"
+    )
+    if payload is None:
+        body = f"🚨 <b>Ошибка загрузки snapshot</b>\n<code>{html.escape(error or '-')}</code>"
+        return header + body, body
+
+    deltas = "\n".join(format_live_deltas(payload, session.get("previous")))
+    body = f"{format_snapshot(payload, forecast)}\n\n{deltas}"
+    # Время снимка и uptime меняются на каждом запросе; без них сравниваем,
+    # изменилось ли что-то содержательное, и не редактируем сообщение впустую.
+    content_key = f"{format_snapshot({**payload, 'timestamp_utc': '', 'uptime_seconds': 0}, forecast)}\n{deltas}"
+    return header + body, content_key
+
+
+def get_live_wakeup(application: Application) -> asyncio.Event:
+    wakeup = application.bot_data.get("live_wakeup")
+    if wakeup is None:
+        wakeup = application.bot_data["live_wakeup"] = asyncio.Event()
+    return wakeup
+
+
+async def stop_live_session(application: Application, chat_id: int, reason: str) -> None:
+    sessions = application.bot_data.setdefault("live_sessions", {})
+    session = sessions.pop(chat_id, None)
+    if session is None:
+        return
+    get_live_wakeup(application).set()
+    try:
+        await application.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=session["message_id"],
+            text=f"⏹ <b>Live остановлен</b>\n{html.escape(reason)}",
+            parse_mode=ParseMode.HTML,
+        )
+    except Exception:
+        logger.debug("Не удалось обновить завершенное live-сообщение chat_id=%s", chat_id)
+    try:
+        await application.bot.unpin_chat_message(chat_id=chat_id, message_id=session["message_id"])
+    except Exception:
+        logger.debug("Не удалось открепить live-сообщение chat_id=%s", chat_id)
+
+
+async def refresh_live_session(
+    application: Application,
+    chat_id: int,
+    session: dict[str, Any],
+    payload: Optional[dict[str, Any]],
+    forecast: Optional[dict[str, Any]],
+    error: Optional[str],
+) -> None:
+    text, content_key = render_live_dashboard(session, payload, forecast, error)
+    if payload is not None:
+        session["previous"] = payload
+    if content_key == session.get("content_key"):
+        return
+    # Пока грузился snapshot, сессию могли остановить: не затираем "Live остановлен".
+    if application.bot_data.get("live_sessions", {}).get(chat_id) is not session:
+        return
+    try:
+        await application.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=session["message_id"],
+            text=text,
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True,
+        )
+        session["content_key"] = content_key
+    except BadRequest as exc:
+        if "not modified" in str(exc).lower():
+            session["content_key"] = content_key
+            return
+        logger.warning("Live-сообщение недоступно chat_id=%s: %s", chat_id, exc)
+        application.bot_data.setdefault("live_sessions", {}).pop(chat_id, None)
+    except Exception:
+        logger.exception("Ошибка обновления live-сообщения chat_id=%s", chat_id)
+
+
+async def live_dashboard_loop(application: Application) -> None:
+    # Один цикл на все live-сессии: за тик делаем один запрос snapshot
+    # и раздаем его всем чатам, у которых подошло время обновления.
+    # Сон прерывается событием live_wakeup: новая сессия получает первый снимок сразу,
+    # а не после интервала уже идущих сессий.
+    sessions: dict[int, dict[str, Any]] = application.bot_data.setdefault("live_sessions", {})
+    wakeup = get_live_wakeup(application)
+    while sessions:
+        wakeup.clear()
+        now_ts = now_utc_ts()
+        for chat_id, session in list(sessions.items()):
+            if session["expires_at"] <= now_ts:
+                await stop_live_session(application, chat_id, "Сессия истекла по таймауту.")
+
+        due = [(chat_id, session) for chat_id, session in sessions.items() if session["next_at"] <= now_ts]
+        if due:
+            payload: Optional[dict[str, Any]] = None
+            error: Optional[str] = None
+            try:
+                payload = await fetch_snapshot(allow_stale=False)
+            except Exception as exc:
+                logger.exception("Ошибка получения snapshot для live")
+                error = str(exc)
+            forecast = build_disk_forecast(application)
+            for chat_id, session in due:
+                if sessions.get(chat_id) is not session:
+                    continue
+                session["next_at"] = now_ts + session["interval"]
+                await refresh_live_session(application, chat_id, session, payload, forecast, error)
+
+        if not sessions:
+            break
+        wake_at = min(min(session["next_at"], session["expires_at"]) for session in sessions.values())
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=max(wake_at - now_utc_ts(), 1.0))
+        except asyncio.TimeoutError:
+            pass
+
+
+def ensure_live_loop(application: Application) -> None:
+    get_live_wakeup(application).set()
+    task = application.bot_data.get("live_task")
+    if task is None or task.done():
+        application.bot_data["live_task"] = asyncio.create_task(live_dashboard_loop(application))
+
+
+async def send_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int) -> None:
+    chat = update.effective_chat
+    if chat is None or update.message is None:
+        return
+
+    if not is_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
+        return
+
+    register_runtime_chat(context.application, chat.id)
+
+    async def render() -> tuple[dict[str, Any], str, Optional[InlineKeyboardMarkup]]:
+        payload = await load_users_page(context.application, max(page, 1))
+        return (payload, *format_users_page(payload))
+
+    try:
+        rendered = await coalesce_chat_request(context.application, chat.id, f"users:{max(page, 1)}", render)
+        if rendered is None:
+            return
+        payload, text, keyboard = rendered
+        message = await update.message.reply_text(
             text,
             parse_mode=ParseMode.HTML,
             reply_markup=keyboard,
             disable_web_page_preview=True,
         )
+        remember_message_render(
+            context.application,
+            chat.id,
+            message.message_id,
+            message_fingerprint(text, keyboard),
+            f"{USERS_CALLBACK_PREFIX}{max(page, 1)}",
+        )
+        prefetch_users_neighbours(
+            context.application,
+            chat.id,
+            int(payload.get("page", page) or page),
+            int(payload.get("total_pages", 0) or 0),
+        )
     except Exception as exc:
         logger.exception("Ошибка получения списка пользователей")
         await send_pretty_message(
@@ -1173,118 +4680,806 @@ async def send_server_files_page(
 
     register_runtime_chat(context.application, chat.id)
 
-    try:
-        payload = await fetch_server_files_page(page=page, limit=SERVER_FILES_PAGE_SIZE)
-        text, keyboard = format_server_files_page(payload)
-        await update.message.reply_text(
-            text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=keyboard,
-            disable_web_page_preview=True,
-        )
-    except Exception as exc:
-        logger.exception("Ошибка загрузки файлов сервера")
-        await send_pretty_message(
-            update,
-            "🚨 <b>Ошибка загрузки файлов сервера</b>\n"
-            f"<code>{html.escape(str(exc))}</code>",
-        )
+    async def render() -> tuple[dict[str, Any], str, Optional[InlineKeyboardMarkup]]:
+        payload = await load_server_files_page(context.application, max(page, 1))
+        return (payload, *format_server_files_page(payload))
+
+    try:
+        rendered = await coalesce_chat_request(context.application, chat.id, f"files:{max(page, 1)}", render)
+        if rendered is None:
+            return
+        payload, text, keyboard = rendered
+        message = await update.message.reply_text(
+            text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=keyboard,
+            disable_web_page_preview=True,
+        )
+        remember_message_render(
+            context.application,
+            chat.id,
+            message.message_id,
+            message_fingerprint(text, keyboard),
+            f"{FILES_CALLBACK_PREFIX}{max(page, 1)}",
+        )
+        prefetch_files_neighbours(
+            context.application,
+            chat.id,
+            int(payload.get("page", page) or page),
+            int(payload.get("total_pages", 0) or 0),
+        )
+    except Exception as exc:
+        logger.exception("Ошибка загрузки файлов сервера")
+        await send_pretty_message(
+            update,
+            "🚨 <b>Ошибка загрузки файлов сервера</b>\n"
+            f"<code>{html.escape(str(exc))}</code>",
+        )
+
+
+def message_fingerprint(text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> str:
+    markup = json.dumps(reply_markup.to_dict(), sort_keys=True) if reply_markup is not None else ""
+    return hashlib.blake2b(f"{text}\x00{markup}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+def remember_message_render(
+    application: Application,
+    chat_id: int,
+    message_id: int,
+    fingerprint: str,
+    callback_data: Optional[str],
+) -> None:
+    cache = application.bot_data.setdefault("message_fingerprints", OrderedDict())
+    key = (chat_id, message_id)
+    cache[key] = {"fingerprint": fingerprint, "data": callback_data, "rendered_at": now_utc_ts()}
+    cache.move_to_end(key)
+    while len(cache) > MESSAGE_FINGERPRINT_MAX_ENTRIES:
+        cache.popitem(last=False)
+
+
+def forget_message_renders(application: Application) -> None:
+    application.bot_data.setdefault("message_fingerprints", OrderedDict()).clear()
+
+
+def is_callback_render_fresh(application: Application, query: Any) -> bool:
+    # Повторное нажатие той же кнопки на том же сообщении, только что отрисованном:
+    # данные заведомо свежие, не ходим ни в backend, ни в Telegram.
+    if query.message is None:
+        return False
+    cache = application.bot_data.get("message_fingerprints") or {}
+    entry = cache.get((query.message.chat.id, query.message.message_id))
+    return (
+        entry is not None
+        and entry["data"] == query.data
+        and now_utc_ts() - entry["rendered_at"] < MESSAGE_RENDER_FRESH_SECONDS
+    )
+
+
+def is_refresh_click(application: Application, query: Any) -> bool:
+    if query.message is None:
+        return False
+    cache = application.bot_data.get("message_fingerprints") or {}
+    entry = cache.get((query.message.chat.id, query.message.message_id))
+    return entry is not None and entry["data"] == query.data
+
+
+async def edit_query_message(
+    application: Application,
+    query: Any,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> bool:
+    fingerprint = message_fingerprint(text, reply_markup)
+    message = query.message
+    cache = application.bot_data.get("message_fingerprints") or {}
+    entry = cache.get((message.chat.id, message.message_id)) if message is not None else None
+    if entry is not None and entry["fingerprint"] == fingerprint:
+        remember_message_render(application, message.chat.id, message.message_id, fingerprint, query.data)
+        return False
+
+    try:
+        await query.edit_message_text(
+            text=text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup,
+            disable_web_page_preview=True,
+        )
+    except BadRequest as exc:
+        if "not modified" not in str(exc).lower():
+            raise
+    if message is not None:
+        remember_message_render(application, message.chat.id, message.message_id, fingerprint, query.data)
+    return True
+
+
+async def handle_users_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if query is None or query.data is None:
+        return
+
+    chat = query.message.chat if query.message else None
+    if chat is None:
+        await query.answer()
+        return
+
+    if not is_chat_allowed(chat.id):
+        await query.answer("Доступ запрещен", show_alert=True)
+        return
+
+    register_runtime_chat(context.application, chat.id)
+
+    if is_callback_render_fresh(context.application, query):
+        await query.answer()
+        return
+
+    page_raw = query.data.replace(USERS_CALLBACK_PREFIX, "", 1)
+    try:
+        page = max(int(page_raw), 1)
+    except ValueError:
+        page = 1
+
+    try:
+        payload = await load_users_page(
+            context.application,
+            page,
+            force=is_refresh_click(context.application, query),
+        )
+        text, keyboard = format_users_page(payload)
+        await edit_query_message(context.application, query, text, keyboard)
+        await query.answer()
+        prefetch_users_neighbours(
+            context.application,
+            chat.id,
+            int(payload.get("page", page) or page),
+            int(payload.get("total_pages", 0) or 0),
+        )
+    except Exception as exc:
+        logger.exception("Ошибка переключения страницы пользователей")
+        await query.answer("Ошибка загрузки страницы", show_alert=True)
+        if query.message is not None:
+            await query.message.reply_text(
+                "🚨 <b>Ошибка загрузки страницы пользователей</b>\n"
+                f"<code>{html.escape(str(exc))}</code>",
+                parse_mode=ParseMode.HTML,
+                reply_markup=MENU_KEYBOARD,
+            )
+
+
+async def handle_files_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if query is None or query.data is None:
+        return
+
+    chat = query.message.chat if query.message else None
+    if chat is None:
+        await query.answer()
+        return
+
+    if not is_chat_allowed(chat.id):
+        await query.answer("Доступ запрещен", show_alert=True)
+        return
+
+    register_runtime_chat(context.application, chat.id)
+
+    if is_callback_render_fresh(context.application, query):
+        await query.answer()
+        return
+
+    page_raw = query.data.replace(FILES_CALLBACK_PREFIX, "", 1)
+    try:
+        page = max(int(page_raw), 1)
+    except ValueError:
+        page = 1
+
+    try:
+        # 🔄 ведет на текущую страницу сообщения: это явный запрос свежих данных, кэш обходим.
+        payload = await load_server_files_page(
+            context.application,
+            page,
+            force=is_refresh_click(context.application, query),
+        )
+        text, keyboard = format_server_files_page(payload)
+        await edit_query_message(context.application, query, text, keyboard)
+        await query.answer()
+        prefetch_files_neighbours(
+            context.application,
+            chat.id,
+            int(payload.get("page", page) or page),
+            int(payload.get("total_pages", 0) or 0),
+        )
+    except Exception as exc:
+        logger.exception("Ошибка переключения страницы файлов сервера")
+        await query.answer("Ошибка загрузки страницы", show_alert=True)
+        if query.message is not None:
+            await query.message.reply_text(
+                "🚨 <b>Ошибка загрузки файлов сервера</b>\n"
+                f"<code>{html.escape(str(exc))}</code>",
+                parse_mode=ParseMode.HTML,
+                reply_markup=MENU_KEYBOARD,
+            )
+
+
+async def send_user_home(update: Update, context: ContextTypes.DEFAULT_TYPE, email: str) -> None:
+    chat = update.effective_chat
+    if chat is None or update.message is None:
+        return
+
+    if not is_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
+        return
+
+    register_runtime_chat(context.application, chat.id)
+
+    normalized_email = email.strip().lower()
+    if not looks_like_email(normalized_email):
+        await send_pretty_message(
+            update,
+            "⚠️ <b>Неверный формат email</b>\n"
+            "Используйте: <code>/user user@example.com</code>",
+        )
+        return
+
+    try:
+        user = await get_cached_user_by_email(context.application, normalized_email)
+        if user is None:
+            await send_pretty_message(
+                update,
+                "🔎 <b>Пользователь не найден</b>\n"
+                f"Email: <code>{html.escape(normalized_email)}</code>",
+            )
+            return
+
+        await update.message.reply_text(
+            format_user_home_text(user),
+            parse_mode=ParseMode.HTML,
+            reply_markup=build_user_home_keyboard(int(user["id"])),
+            disable_web_page_preview=True,
+        )
+    except Exception as exc:
+        logger.exception("Ошибка загрузки карточки пользователя email=%s", normalized_email)
+        await send_pretty_message(
+            update,
+            "🚨 <b>Ошибка загрузки пользователя</b>\n"
+            f"<code>{html.escape(str(exc))}</code>",
+        )
+
+
+async def handle_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if query is None or query.data is None:
+        return
+
+    chat = query.message.chat if query.message else None
+    if chat is None:
+        await query.answer()
+        return
+
+    if not is_chat_allowed(chat.id):
+        await query.answer("Доступ запрещен", show_alert=True)
+        return
+
+    register_runtime_chat(context.application, chat.id)
+
+    if is_callback_render_fresh(context.application, query):
+        await query.answer()
+        return
+
+    decoded = decode_user_callback(query.data)
+    if decoded is None:
+        await query.answer("Некорректная кнопка", show_alert=True)
+        return
+
+    action, user_id, page, expires_at = decoded
+    if expires_at <= now_utc_ts():
+        await query.answer("Кнопка устарела. Выполните /user <email>", show_alert=True)
+        return
+
+    try:
+        user = await get_cached_user_by_id(context.application, user_id)
+        if user is None:
+            await edit_query_message(
+                context.application,
+                query,
+                (
+                    "🔎 <b>Пользователь не найден</b>\n"
+                    f"ID: <code>{user_id}</code>"
+                ),
+            )
+            await query.answer()
+            return
+
+        if action == "home":
+            await edit_query_message(
+                context.application,
+                query,
+                format_user_home_text(user),
+                build_user_home_keyboard(user_id),
+            )
+            await query.answer()
+            return
+
+        if action == "about":
+            summary = await get_cached_user_storage_summary(context.application, user_id)
+            await edit_query_message(
+                context.application,
+                query,
+                format_user_about_text(user, summary),
+                build_user_about_keyboard(user_id),
+            )
+            await query.answer()
+            return
+
+        if action == "files":
+            summary = await get_cached_user_storage_summary(context.application, user_id)
+            await edit_query_message(
+                context.application,
+                query,
+                format_user_files_text(summary),
+                build_user_files_keyboard(user_id),
+            )
+            await query.answer()
+            return
+
+        if action == "tracks":
+            rows, total_tracks = await load_user_tracks_page(context.application, user_id, page)
+            total_pages = max((total_tracks + USER_TRACKS_PAGE_SIZE - 1) // USER_TRACKS_PAGE_SIZE, 1)
+            page = min(page, total_pages)
+            if page != 1 and not rows:
+                rows, total_tracks = await load_user_tracks_page(context.application, user_id, page)
+            await edit_query_message(
+                context.application,
+                query,
+                format_user_tracks_page_text(rows, page, total_pages, total_tracks),
+                build_user_list_pagination_keyboard(user_id, "tracks", page, total_pages),
+            )
+            await query.answer()
+            prefetch_user_list_neighbours(context.application, chat.id, "tracks", user_id, page, total_pages)
+            return
+
+        if action == "playlists":
+            total_rows, total_playlists = await get_user_playlists(user_id, 1, 1)
+            _ = total_rows
+            await edit_query_message(
+                context.application,
+                query,
+                (
+                    "📚 <b>Плейлисты пользователя</b>\n\n"
+                    f"Всего плейлистов: <b>{total_playlists}</b>\n\n"
+                    "Нажмите <b>Список</b>, чтобы открыть плейлисты по 5 шт."
+                ),
+                build_user_playlists_keyboard(user_id),
+            )
+            await query.answer()
+            return
+
+        if action == "playlist_items":
+            rows, total_playlists = await load_user_playlists_page(context.application, user_id, page)
+            total_pages = max((total_playlists + USER_PLAYLISTS_PAGE_SIZE - 1) // USER_PLAYLISTS_PAGE_SIZE, 1)
+            page = min(page, total_pages)
+            if page != 1 and not rows:
+                rows, total_playlists = await load_user_playlists_page(context.application, user_id, page)
+            await edit_query_message(
+                context.application,
+                query,
+                format_user_playlists_page_text(rows, page, total_pages, total_playlists),
+                build_user_list_pagination_keyboard(user_id, "playlists", page, total_pages),
+            )
+            await query.answer()
+            prefetch_user_list_neighbours(context.application, chat.id, "playlists", user_id, page, total_pages)
+            return
+
+        await query.answer("Неизвестное действие", show_alert=True)
+    except Exception as exc:
+        logger.exception("Ошибка user callback: %s", query.data)
+        await query.answer("Ошибка загрузки", show_alert=True)
+        if query.message is not None:
+            await query.message.reply_text(
+                "🚨 <b>Ошибка пользовательской сводки</b>\n"
+                f"<code>{html.escape(str(exc))}</code>",
+                parse_mode=ParseMode.HTML,
+                reply_markup=MENU_KEYBOARD,
+            )
+
+
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    if update.message is None or chat is None:
+        return
+
+    if not is_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
+        return
+
+    register_runtime_chat(context.application, chat.id)
+    await send_pretty_message(update, format_help_message())
+
+
+async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await cmd_start(update, context)
+
+
+async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ok, target = await resolve_target_arg(update, context)
+    if not ok:
+        return
+    if target is None and is_multi_target():
+        await send_targets_overview(update, context)
+        return
+    await send_monitoring(update, context, "status", "/api/monitor/status", target)
+
+
+async def cmd_storage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await send_monitoring(update, context, "storage", "/api/monitor/storage")
+
+
+async def cmd_connections(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await send_monitoring(update, context, "connections", "/api/monitor/connections")
+
+
+async def cmd_runtime(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await send_monitoring(update, context, "runtime", "/api/monitor/runtime")
+
+
+async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await send_users_page(update, context, 1)
+
+
+async def cmd_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await send_server_files_page(update, context, 1)
+
+
+async def cmd_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message is None:
+        return
+    if not context.args:
+        await send_pretty_message(
+            update,
+            "Использование: <code>/user user@example.com</code>",
+        )
+        return
+    email = " ".join(context.args).strip()
+    await send_user_home(update, context, email)
+
+
+async def cmd_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    if update.message is None or chat is None:
+        return
+
+    if not is_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
+        return
+
+    if not is_deploy_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Удаление пользователей запрещено для этого чата</b>")
+        return
+
+    register_runtime_chat(context.application, chat.id)
+
+    if not context.args:
+        await send_pretty_message(
+            update,
+            "Использование: <code>/delete_user user@example.com</code>",
+        )
+        return
+
+    email = " ".join(context.args).strip().lower()
+    if not looks_like_email(email):
+        await send_pretty_message(
+            update,
+            "⚠️ <b>Неверный формат email</b>\n"
+            "Использование: <code>/delete_user user@example.com</code>",
+        )
+        return
+
+    await send_pretty_message(
+        update,
+        "🗑️ <b>Запускаю удаление пользователя</b>\n"
+        f"Email: <code>{html.escape(email)}</code>",
+    )
+
+    try:
+        payload = await delete_user_profile_by_email(email)
+        forget_message_renders(context.application)
+        invalidate_page_cache(context.application)
+        invalidate_user_cache(context.application, email)
+        forget_indexed_email(context.application, email)
+        summary = payload.get("summary") if isinstance(payload.get("summary"), dict) else {}
+
+        await send_pretty_message(
+            update,
+            "✅ <b>Пользователь удален</b>\n"
+            f"Email: <code>{html.escape(str(payload.get('email', email)))}</code>\n"
+            f"ID: <code>{html.escape(str(payload.get('user_id', '-')))}</code>\n"
+            f"Кандидатов песен: <code>{html.escape(str(summary.get('candidate_songs', 0)))}</code>\n"
+            f"Удалено песен: <code>{html.escape(str(summary.get('deleted_songs', 0)))}</code>\n"
+            f"Удалено файлов: <code>{html.escape(str(summary.get('deleted_files', 0)))}</code>\n"
+            f"Ошибок удаления файлов: <code>{html.escape(str(summary.get('file_delete_errors', 0)))}</code>",
+        )
+    except Exception as exc:
+        logger.exception("Ошибка удаления пользователя email=%s", email)
+        await send_pretty_message(
+            update,
+            "🚨 <b>Ошибка удаления пользователя</b>\n"
+            f"<code>{html.escape(str(exc))}</code>",
+        )
+
+
+async def cmd_purge_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    if update.message is None or chat is None:
+        return
+
+    if not is_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
+        return
+
+    if not is_deploy_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Массовое удаление запрещено для этого чата</b>")
+        return
+
+    register_runtime_chat(context.application, chat.id)
+
+    action = context.args[0].strip().upper() if context.args else ""
+    running = get_purge_task(context.application)
+
+    if action == "STOP":
+        state = context.application.bot_data.get("purge_state")
+        if running is not None:
+            running.cancel()
+            try:
+                await running
+            except asyncio.CancelledError:
+                pass
+        await asyncio.to_thread(clear_purge_checkpoint)
+        if isinstance(state, dict) and state.get("status") == "running":
+            state["status"] = "stopped"
+            await send_pretty_message(update, format_purge_progress(state))
+            return
+        await send_pretty_message(update, "ℹ️ <b>Массовое удаление не выполняется</b>")
+        return
+
+    if is_purge_busy(context.application):
+        await send_pretty_message(
+            update,
+            "⏳ <b>Массовое удаление уже выполняется</b>\n"
+            "Остановить: <code>/purge_all_users STOP</code>",
+        )
+        return
+
+    if action not in ("RESUME", "CONFIRM"):
+        await send_pretty_message(
+            update,
+            "⚠️ <b>Команда опасна</b>\n"
+            "Это удалит всех пользователей и их песни через API.\n\n"
+            "Запуск: <code>/purge_all_users CONFIRM</code>\n"
+            "Остановить: <code>/purge_all_users STOP</code>\n"
+            "Продолжить после ошибки: <code>/purge_all_users RESUME</code>",
+        )
+        return
+
+    bulk_lock = context.application.bot_data.setdefault("bulk_delete_lock", asyncio.Lock())
+    if bulk_lock.locked():
+        await send_pretty_message(update, "⏳ <b>Выполняется удаление по списку</b>, дождитесь его окончания")
+        return
+
+    # Блокировка берется без await после проверок выше: два быстрых CONFIRM не запустят
+    # две задачи, а удаление по списку не стартует, пока очистка запускается.
+    async with get_purge_start_lock(context.application):
+        try:
+            checkpoint = await asyncio.to_thread(load_purge_checkpoint)
+            if action == "RESUME":
+                if checkpoint is None:
+                    await send_pretty_message(update, "ℹ️ <b>Нет сохраненного checkpoint для продолжения</b>")
+                    return
+                state = checkpoint
+                state["status"] = "running"
+                state.pop("error", None)
+            else:
+                if checkpoint is not None:
+                    await send_pretty_message(
+                        update,
+                        "⚠️ <b>Есть незавершенная очистка</b>\n"
+                        f"Обработано: <code>{int(checkpoint.get('processed', 0))}</code> из "
+                        f"<code>{int(checkpoint.get('total', 0))}</code>\n\n"
+                        "Продолжить: <code>/purge_all_users RESUME</code>\n"
+                        "Сбросить checkpoint: <code>/purge_all_users STOP</code>",
+                    )
+                    return
+                state = {
+                    "status": "running",
+                    "started_at": now_utc_ts(),
+                    "after_id": 0,
+                    "total": await count_users(),
+                    "processed": 0,
+                    "deleted": 0,
+                    "failed": 0,
+                    "deleted_songs": 0,
+                    "deleted_files": 0,
+                    "failures": [],
+                }
+            progress_message = await update.message.reply_text(
+                format_purge_progress(state),
+                parse_mode=ParseMode.HTML,
+            )
+            state["chat_id"] = progress_message.chat_id
+            state["message_id"] = progress_message.message_id
+            await asyncio.to_thread(save_purge_checkpoint, state)
+            start_purge_task(context.application, state)
+        except Exception as exc:
+            logger.exception("Ошибка запуска массового удаления пользователей")
+            await send_pretty_message(
+                update,
+                "🚨 <b>Ошибка массового удаления</b>\n"
+                f"<code>{html.escape(str(exc))}</code>",
+            )
+
+
+async def cmd_reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    if update.message is None or chat is None:
+        return
+
+    if not is_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
+        return
+
+    register_runtime_chat(context.application, chat.id)
+
+    async def run_reconcile() -> None:
+        try:
+            await send_pretty_message(
+                update,
+                "🧮 <b>Запускаю сверку uploads и songs</b>\n"
+                "Сканирую файлы сервера и строки БД, это может занять время.",
+            )
+            report = await reconcile_uploads_with_songs()
+            await send_pretty_message(update, format_reconcile_report(report))
+        except Exception as exc:
+            logger.exception("Ошибка сверки uploads и songs")
+            await send_pretty_message(
+                update,
+                "🚨 <b>Ошибка сверки</b>\n"
+                f"<code>{html.escape(str(exc))}</code>",
+            )
 
+    if not start_background_job(context.application, "reconcile", run_reconcile()):
+        await send_pretty_message(update, "⏳ <b>Сверка уже выполняется</b>")
 
-async def handle_users_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    if query is None or query.data is None:
-        return
 
-    chat = query.message.chat if query.message else None
-    if chat is None:
-        await query.answer()
+async def cmd_top_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    if update.message is None or chat is None:
         return
 
     if not is_chat_allowed(chat.id):
-        await query.answer("Доступ запрещен", show_alert=True)
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
         return
 
     register_runtime_chat(context.application, chat.id)
 
-    page_raw = query.data.replace(USERS_CALLBACK_PREFIX, "", 1)
-    try:
-        page = max(int(page_raw), 1)
-    except ValueError:
-        page = 1
+    limit = TOP_USERS_DEFAULT_LIMIT
+    mode = "size"
+    for arg in context.args or []:
+        value = arg.strip().lower()
+        if value.isdigit():
+            limit = min(max(int(value), 1), TOP_USERS_MAX_LIMIT)
+        elif value in TOP_USERS_GROWTH_WINDOWS or value == "size":
+            mode = value
+        else:
+            await send_pretty_message(
+                update,
+                "Использование: <code>/top_users [n] [size|day|week]</code>",
+            )
+            return
 
     try:
-        payload = await fetch_monitoring_json(
-            "/api/monitor/users/list",
-            params={"page": page, "limit": max(USERS_PAGE_SIZE, 1)},
-        )
-        text, keyboard = format_users_page(payload)
-        await query.edit_message_text(
-            text=text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=keyboard,
-            disable_web_page_preview=True,
+        cache = await get_users_usage(context.application)
+        users = cache["users"]
+        growth = None
+        covered_seconds = 0.0
+        if mode != "size":
+            growth, covered_seconds = await rank_users_by_growth(
+                context.application,
+                users,
+                TOP_USERS_GROWTH_WINDOWS[mode],
+                now_utc_ts(),
+            )
+        await send_pretty_message(
+            update,
+            format_top_users(users, limit, float(cache["fetched_at"]), mode, growth, covered_seconds),
         )
-        await query.answer()
     except Exception as exc:
-        logger.exception("Ошибка переключения страницы пользователей")
-        await query.answer("Ошибка загрузки страницы", show_alert=True)
-        if query.message is not None:
-            await query.message.reply_text(
-                "🚨 <b>Ошибка загрузки страницы пользователей</b>\n"
-                f"<code>{html.escape(str(exc))}</code>",
-                parse_mode=ParseMode.HTML,
-                reply_markup=MENU_KEYBOARD,
-            )
+        logger.exception("Ошибка загрузки топа пользователей")
+        await send_pretty_message(
+            update,
+            "🚨 <b>Ошибка загрузки топа пользователей</b>\n"
+            f"<code>{html.escape(str(exc))}</code>",
+        )
 
 
-async def handle_files_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    if query is None or query.data is None:
-        return
+def format_metric_history(
+    metric: str,
+    range_seconds: int,
+    tier: int,
+    rows: list[tuple[float, float, float, float, float]],
+    elapsed_ms: float,
+) -> str:
+    tier_labels = {60: "1m", 3600: "1h", 86400: "1d"}
+    lines = [
+        f"📈 <b>История {html.escape(metric)}</b>",
+        f"Окно: <code>{format_duration(range_seconds)}</code> | rollup: <code>{tier_labels.get(tier, tier)}</code>",
+        f"Точек: <code>{len(rows)}</code> | запрос: <code>{elapsed_ms:.1f} мс</code>",
+        "",
+    ]
+    if not rows:
+        lines.append("Данных за период нет.")
+        return "\n".join(lines)
 
-    chat = query.message.chat if query.message else None
-    if chat is None:
-        await query.answer()
+    low = min(row[1] for row in rows)
+    high = max(row[2] for row in rows)
+    avg = sum(row[3] for row in rows) / len(rows)
+    last = rows[-1][4]
+    lines.extend(
+        [
+            f"min: <code>{low:,.2f}</code>",
+            f"max: <code>{high:,.2f}</code>",
+            f"avg: <code>{avg:,.2f}</code>",
+            f"last: <code>{last:,.2f}</code>",
+        ]
+    )
+    return "\n".join(lines)
+
+
+async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    if update.message is None or chat is None:
         return
 
     if not is_chat_allowed(chat.id):
-        await query.answer("Доступ запрещен", show_alert=True)
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
         return
 
     register_runtime_chat(context.application, chat.id)
 
-    page_raw = query.data.replace(FILES_CALLBACK_PREFIX, "", 1)
-    try:
-        page = max(int(page_raw), 1)
-    except ValueError:
-        page = 1
+    store = get_metrics_store(context.application)
+    if store is None:
+        await send_pretty_message(update, "⚠️ <b>История метрик отключена</b>")
+        return
+
+    args = context.args or []
+    range_seconds = parse_range_seconds(args[1]) if len(args) >= 2 else 24 * 3600
+    if not args or range_seconds is None:
+        known = await asyncio.to_thread(store.known_metrics)
+        await send_pretty_message(
+            update,
+            "Использование: <code>/history &lt;metric&gt; [24h|7d|90d]</code>\n"
+            f"Метрики: <code>{html.escape(', '.join(known) or '-')}</code>",
+        )
+        return
 
+    metric = args[0].strip()
+    end_ts = now_utc_ts()
     try:
-        payload = await fetch_server_files_page(page=page, limit=SERVER_FILES_PAGE_SIZE)
-        text, keyboard = format_server_files_page(payload)
-        await query.edit_message_text(
-            text=text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=keyboard,
-            disable_web_page_preview=True,
+        started = time.perf_counter()
+        tier, series = await asyncio.to_thread(store.query, [metric], end_ts - range_seconds, end_ts)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        await send_pretty_message(
+            update,
+            format_metric_history(metric, range_seconds, tier, series.get(metric, []), elapsed_ms),
         )
-        await query.answer()
     except Exception as exc:
-        logger.exception("Ошибка переключения страницы файлов сервера")
-        await query.answer("Ошибка загрузки страницы", show_alert=True)
-        if query.message is not None:
-            await query.message.reply_text(
-                "🚨 <b>Ошибка загрузки файлов сервера</b>\n"
-                f"<code>{html.escape(str(exc))}</code>",
-                parse_mode=ParseMode.HTML,
-                reply_markup=MENU_KEYBOARD,
-            )
+        logger.exception("Ошибка запроса истории метрик")
+        await send_pretty_message(
+            update,
+            "🚨 <b>Ошибка запроса истории</b>\n"
+            f"<code>{html.escape(str(exc))}</code>",
+        )
 
 
-async def send_user_home(update: Update, context: ContextTypes.DEFAULT_TYPE, email: str) -> None:
+async def cmd_chart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
-    if chat is None or update.message is None:
+    if update.message is None or chat is None:
         return
 
     if not is_chat_allowed(chat.id):
@@ -1293,251 +5488,260 @@ async def send_user_home(update: Update, context: ContextTypes.DEFAULT_TYPE, ema
 
     register_runtime_chat(context.application, chat.id)
 
-    normalized_email = email.strip().lower()
-    if not looks_like_email(normalized_email):
+    store = get_metrics_store(context.application)
+    if store is None:
+        await send_pretty_message(update, "⚠️ <b>История метрик отключена</b>")
+        return
+
+    args = context.args or []
+    metrics = [item.strip() for item in args[0].split(",") if item.strip()] if args else []
+    range_seconds = parse_range_seconds(args[1]) if len(args) >= 2 else 24 * 3600
+    if not metrics or range_seconds is None or len(metrics) > CHART_MAX_METRICS:
         await send_pretty_message(
             update,
-            "⚠️ <b>Неверный формат email</b>\n"
-            "Используйте: <code>/user user@example.com</code>",
+            "Использование: <code>/chart &lt;metric&gt;[,&lt;metric&gt;] [24h|7d|90d]</code>\n"
+            f"Не больше {CHART_MAX_METRICS} метрик, например "
+            "<code>/chart http_active_requests,db_in_use_connections 6h</code>",
         )
         return
 
     try:
-        user = await get_user_by_email(normalized_email)
-        if user is None:
-            await send_pretty_message(
-                update,
-                "🔎 <b>Пользователь не найден</b>\n"
-                f"Email: <code>{html.escape(normalized_email)}</code>",
-            )
-            return
-
-        token = create_user_session(context.application, normalized_email)
-        await update.message.reply_text(
-            format_user_home_text(user),
+        png, caption = await build_metric_chart(context.application, store, metrics, range_seconds)
+        await update.message.reply_photo(
+            photo=png,
+            caption=caption,
             parse_mode=ParseMode.HTML,
-            reply_markup=build_user_home_keyboard(token),
-            disable_web_page_preview=True,
+            reply_markup=MENU_KEYBOARD,
         )
     except Exception as exc:
-        logger.exception("Ошибка загрузки карточки пользователя email=%s", normalized_email)
+        logger.exception("Ошибка построения графика")
         await send_pretty_message(
             update,
-            "🚨 <b>Ошибка загрузки пользователя</b>\n"
+            "🚨 <b>Ошибка построения графика</b>\n"
             f"<code>{html.escape(str(exc))}</code>",
         )
 
 
-async def handle_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    if query is None or query.data is None:
-        return
-
-    chat = query.message.chat if query.message else None
-    if chat is None:
-        await query.answer()
+async def cmd_live(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    if update.message is None or chat is None:
         return
 
     if not is_chat_allowed(chat.id):
-        await query.answer("Доступ запрещен", show_alert=True)
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
         return
 
     register_runtime_chat(context.application, chat.id)
 
-    parts = query.data.split(":")
-    # Expected:
-    # user:home:<token>
-    # user:about:<token>
-    # user:files:<token>
-    # user:tracks:<token>:<page>
-    # user:playlists:<token>
-    # user:playlist_items:<token>:<page>
-    if len(parts) < 3:
-        await query.answer("Некорректная кнопка", show_alert=True)
-        return
-
-    _, action, token = parts[0], parts[1], parts[2]
-    email = resolve_user_email_by_token(context.application, token)
-    if not email:
-        await query.answer("Сессия устарела. Выполните /user <email>", show_alert=True)
-        return
-
-    try:
-        user = await get_user_by_email(email)
-        if user is None:
-            await query.edit_message_text(
-                text=(
-                    "🔎 <b>Пользователь не найден</b>\n"
-                    f"Email: <code>{html.escape(email)}</code>"
-                ),
-                parse_mode=ParseMode.HTML,
-                disable_web_page_preview=True,
-            )
-            await query.answer()
-            return
-
-        user_id = int(user["id"])
-
-        if action == "home":
-            await query.edit_message_text(
-                text=format_user_home_text(user),
-                parse_mode=ParseMode.HTML,
-                reply_markup=build_user_home_keyboard(token),
-                disable_web_page_preview=True,
-            )
-            await query.answer()
-            return
-
-        if action == "about":
-            summary = await get_user_storage_summary(user_id)
-            await query.edit_message_text(
-                text=format_user_about_text(user, summary),
-                parse_mode=ParseMode.HTML,
-                reply_markup=build_user_about_keyboard(token),
-                disable_web_page_preview=True,
-            )
-            await query.answer()
-            return
-
-        if action == "files":
-            summary = await get_user_storage_summary(user_id)
-            await query.edit_message_text(
-                text=format_user_files_text(summary),
-                parse_mode=ParseMode.HTML,
-                reply_markup=build_user_files_keyboard(token),
-                disable_web_page_preview=True,
-            )
-            await query.answer()
+    arg = context.args[0].strip().lower() if context.args else ""
+    if arg == "stop":
+        if chat.id not in context.application.bot_data.get("live_sessions", {}):
+            await send_pretty_message(update, "ℹ️ <b>Live-режим не запущен</b>")
             return
+        await stop_live_session(context.application, chat.id, "Остановлено командой /live stop.")
+        await send_pretty_message(update, "⏹ <b>Live-режим остановлен</b>")
+        return
 
-        if action == "tracks":
-            page = 1
-            if len(parts) >= 4:
-                try:
-                    page = max(int(parts[3]), 1)
-                except ValueError:
-                    page = 1
-            rows, total_tracks = await get_user_tracks(user_id, page, USER_TRACKS_PAGE_SIZE)
-            total_pages = max((total_tracks + USER_TRACKS_PAGE_SIZE - 1) // USER_TRACKS_PAGE_SIZE, 1)
-            page = min(page, total_pages)
-            if page != 1 and not rows:
-                rows, total_tracks = await get_user_tracks(user_id, page, USER_TRACKS_PAGE_SIZE)
-            await query.edit_message_text(
-                text=format_user_tracks_page_text(rows, page, total_pages, total_tracks),
-                parse_mode=ParseMode.HTML,
-                reply_markup=build_user_list_pagination_keyboard(token, "tracks", page, total_pages),
-                disable_web_page_preview=True,
-            )
-            await query.answer()
+    interval = LIVE_DEFAULT_INTERVAL_SECONDS
+    if arg:
+        if not arg.isdigit():
+            await send_pretty_message(update, "Использование: <code>/live [interval_sec|stop]</code>")
             return
+        interval = int(arg)
+    interval = max(interval, LIVE_MIN_INTERVAL_SECONDS)
 
-        if action == "playlists":
-            total_rows, total_playlists = await get_user_playlists(user_id, 1, 1)
-            _ = total_rows
-            await query.edit_message_text(
-                text=(
-                    "📚 <b>Плейлисты пользователя</b>\n\n"
-                    f"Всего плейлистов: <b>{total_playlists}</b>\n\n"
-                    "Нажмите <b>Список</b>, чтобы открыть плейлисты по 5 шт."
-                ),
-                parse_mode=ParseMode.HTML,
-                reply_markup=build_user_playlists_keyboard(token),
-                disable_web_page_preview=True,
-            )
-            await query.answer()
-            return
+    if chat.id in context.application.bot_data.get("live_sessions", {}):
+        await stop_live_session(context.application, chat.id, "Запущена новая live-сессия.")
 
-        if action == "playlist_items":
-            page = 1
-            if len(parts) >= 4:
-                try:
-                    page = max(int(parts[3]), 1)
-                except ValueError:
-                    page = 1
-            rows, total_playlists = await get_user_playlists(user_id, page, USER_PLAYLISTS_PAGE_SIZE)
-            total_pages = max((total_playlists + USER_PLAYLISTS_PAGE_SIZE - 1) // USER_PLAYLISTS_PAGE_SIZE, 1)
-            page = min(page, total_pages)
-            if page != 1 and not rows:
-                rows, total_playlists = await get_user_playlists(user_id, page, USER_PLAYLISTS_PAGE_SIZE)
-            await query.edit_message_text(
-                text=format_user_playlists_page_text(rows, page, total_pages, total_playlists),
-                parse_mode=ParseMode.HTML,
-                reply_markup=build_user_list_pagination_keyboard(token, "playlists", page, total_pages),
-                disable_web_page_preview=True,
-            )
-            await query.answer()
-            return
+    message = await update.message.reply_text(
+        "🔴 <b>Live</b>: загружаю snapshot…",
+        parse_mode=ParseMode.HTML,
+    )
+    try:
+        await context.bot.pin_chat_message(
+            chat_id=chat.id,
+            message_id=message.message_id,
+            disable_notification=True,
+        )
+    except Exception:
+        logger.info("Не удалось закрепить live-сообщение chat_id=%s", chat.id)
 
-        await query.answer("Неизвестное действие", show_alert=True)
-    except Exception as exc:
-        logger.exception("Ошибка user callback: %s", query.data)
-        await query.answer("Ошибка загрузки", show_alert=True)
-        if query.message is not None:
-            await query.message.reply_text(
-                "🚨 <b>Ошибка пользовательской сводки</b>\n"
-                f"<code>{html.escape(str(exc))}</code>",
-                parse_mode=ParseMode.HTML,
-                reply_markup=MENU_KEYBOARD,
-            )
+    now_ts = now_utc_ts()
+    context.application.bot_data.setdefault("live_sessions", {})[chat.id] = {
+        "message_id": message.message_id,
+        "interval": interval,
+        "expires_at": now_ts + max(LIVE_SESSION_TIMEOUT_SECONDS, interval),
+        "next_at": now_ts,
+        "previous": None,
+        "content_key": None,
+    }
+    ensure_live_loop(context.application)
 
 
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def cmd_find(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
     if update.message is None or chat is None:
         return
 
-    if not is_chat_allowed(chat.id):
-        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
-        return
-
-    register_runtime_chat(context.application, chat.id)
-    await send_pretty_message(update, format_help_message())
-
-
-async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await cmd_start(update, context)
-
+    if not is_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
+        return
 
-async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_monitoring(update, context, "status", "/api/monitor/status")
+    register_runtime_chat(context.application, chat.id)
 
+    fragment = " ".join(context.args or []).strip()
+    if len(fragment) < 2:
+        await send_pretty_message(
+            update,
+            "Использование: <code>/find &lt;часть email или username&gt;</code> (минимум 2 символа)",
+        )
+        return
 
-async def cmd_storage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_monitoring(update, context, "storage", "/api/monitor/storage")
+    index = get_email_index(context.application)
+    if index is None:
+        await send_pretty_message(update, "⏳ <b>Индекс пользователей еще строится</b>")
+        return
 
+    started = time.perf_counter()
+    matches = index.search(fragment, FIND_RESULTS_LIMIT)
+    elapsed_us = (time.perf_counter() - started) * 1_000_000
 
-async def cmd_connections(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_monitoring(update, context, "connections", "/api/monitor/connections")
+    lines = [
+        f"🔎 <b>Поиск:</b> <code>{html.escape(fragment)}</code>",
+        f"Найдено: <code>{len(matches)}</code> (показано до {FIND_RESULTS_LIMIT}) | "
+        f"индекс: <code>{len(index)}</code> | <code>{elapsed_us:.0f} мкс</code>",
+        "",
+    ]
+    if not matches:
+        lines.append("Совпадений нет.")
+    for idx, (email, username) in enumerate(matches, start=1):
+        lines.append(
+            f"{idx}. 📧 <code>{html.escape(email)}</code> | 👤 <b>{html.escape(username)}</b>"
+        )
+    if matches:
+        lines.append("")
+        lines.append("Отправьте email сообщением или <code>/user &lt;email&gt;</code>, чтобы открыть карточку.")
+    await send_pretty_message(update, "\n".join(lines))
 
 
-async def cmd_runtime(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_monitoring(update, context, "runtime", "/api/monitor/runtime")
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    inline_query = update.inline_query
+    if inline_query is None:
+        return
 
+    if not is_inline_user_allowed(inline_query.from_user.id):
+        await inline_query.answer([], cache_time=60, is_personal=True)
+        return
 
-async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_users_page(update, context, 1)
+    index = get_email_index(context.application)
+    fragment = inline_query.query.strip()
+    if index is None or len(fragment) < 2:
+        await inline_query.answer([], cache_time=5, is_personal=True)
+        return
 
+    results = [
+        InlineQueryResultArticle(
+            id=hashlib.blake2b(email.encode("utf-8"), digest_size=8).hexdigest(),
+            title=email,
+            description=username,
+            input_message_content=InputTextMessageContent(email),
+        )
+        for email, username in index.search(fragment, INLINE_RESULTS_LIMIT)
+    ]
+    await inline_query.answer(results, cache_time=5, is_personal=True)
 
-async def cmd_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_server_files_page(update, context, 1)
 
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    if update.message is None or chat is None:
+        return
 
-async def cmd_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if update.message is None:
+    if not is_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
         return
-    if not context.args:
+
+    register_runtime_chat(context.application, chat.id)
+
+    try:
+        kind, output_format, filters = parse_export_args(context.args or [])
+    except ValueError:
         await send_pretty_message(
             update,
-            "Использование: <code>/user user@example.com</code>",
+            "Использование: <code>/export users|tracks|playlists [csv|jsonl] [фильтры]</code>\n"
+            "Фильтры: <code>since=YYYY-MM-DD</code>, <code>until=YYYY-MM-DD</code>, "
+            "<code>user=&lt;email&gt;</code>, <code>q=&lt;fragment&gt;</code> (только users)",
         )
         return
-    email = " ".join(context.args).strip()
-    await send_user_home(update, context, email)
 
+    filters_text = " ".join(f"{key}={value}" for key, value in sorted(filters.items())) or "—"
+    title = f"📦 <b>Экспорт {kind}</b> (<code>{output_format}.gz</code>)"
 
-async def cmd_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    async def run_export() -> None:
+        started = time.perf_counter()
+        try:
+            progress_message = await update.message.reply_text(
+                f"{title}\nФильтры: <code>{html.escape(filters_text)}</code>\n⏳ Подготовка...",
+                parse_mode=ParseMode.HTML,
+            )
+            select_sql, count_sql = build_export_query(kind, filters)
+            count_rows = await run_db_query(count_sql)
+            total = int(count_rows[0].get("total", "0") or 0) if count_rows else 0
+
+            async def report(rows: int, compressed: int) -> None:
+                percent = f" ({min(rows * 100 // total, 100)}%)" if total else ""
+                try:
+                    await progress_message.edit_text(
+                        f"{title}\nФильтры: <code>{html.escape(filters_text)}</code>\n"
+                        f"⏳ Строк: <code>{rows}/{total}</code>{percent} | "
+                        f"gzip: <code>{format_bytes(compressed)}</code> | "
+                        f"<code>{time.perf_counter() - started:.0f} с</code>",
+                        parse_mode=ParseMode.HTML,
+                    )
+                except BadRequest:
+                    pass
+
+            with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES) as spool:
+                rows, raw_bytes = await write_export(select_sql, output_format, spool, report)
+                compressed = spool.tell()
+                spool.seek(0)
+                stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+                elapsed = time.perf_counter() - started
+                await update.message.reply_document(
+                    document=spool,
+                    filename=f"cloudtune-{kind}-{stamp}.{output_format}.gz",
+                    caption=(
+                        f"{title}\n"
+                        f"Строк: <code>{rows}</code> | "
+                        f"<code>{format_bytes(raw_bytes)}</code> → <code>{format_bytes(compressed)}</code> | "
+                        f"<code>{elapsed:.1f} с</code>"
+                    ),
+                    parse_mode=ParseMode.HTML,
+                    write_timeout=EXPORT_UPLOAD_TIMEOUT_SECONDS,
+                    read_timeout=EXPORT_UPLOAD_TIMEOUT_SECONDS,
+                )
+            try:
+                await progress_message.edit_text(
+                    f"{title}\n✅ Готово: <code>{rows}</code> строк за <code>{elapsed:.1f} с</code>",
+                    parse_mode=ParseMode.HTML,
+                )
+            except BadRequest:
+                pass
+        except Exception as exc:
+            logger.exception("Ошибка экспорта")
+            await send_pretty_message(
+                update,
+                "🚨 <b>Ошибка экспорта</b>\n"
+                f"<code>{html.escape(str(exc))}</code>",
+            )
+
+    if not start_background_job(context.application, "export", run_export()):
+        await send_pretty_message(update, "⏳ <b>Экспорт уже выполняется</b>")
+
+
+async def handle_bulk_delete_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
-    if update.message is None or chat is None:
+    message = update.message
+    if message is None or message.document is None or chat is None:
         return
 
     if not is_chat_allowed(chat.id):
@@ -1550,121 +5754,281 @@ async def cmd_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     register_runtime_chat(context.application, chat.id)
 
-    if not context.args:
+    document = message.document
+    if (document.file_size or 0) > BULK_DELETE_MAX_FILE_BYTES:
         await send_pretty_message(
             update,
-            "Использование: <code>/delete_user user@example.com</code>",
+            f"⚠️ <b>Файл слишком большой</b> (лимит {format_bytes(BULK_DELETE_MAX_FILE_BYTES)})",
         )
         return
 
-    email = " ".join(context.args).strip().lower()
-    if not looks_like_email(email):
+    try:
+        telegram_file = await document.get_file()
+        data = bytes(await telegram_file.download_as_bytearray())
+        emails, invalid, duplicates = parse_email_list(data)
+    except Exception as exc:
+        logger.exception("Ошибка чтения списка email")
         await send_pretty_message(
             update,
-            "⚠️ <b>Неверный формат email</b>\n"
-            "Использование: <code>/delete_user user@example.com</code>",
+            "🚨 <b>Не удалось прочитать файл</b>\n"
+            f"<code>{html.escape(str(exc))}</code>",
         )
         return
 
-    await send_pretty_message(
-        update,
-        "🗑️ <b>Запускаю удаление пользователя</b>\n"
-        f"Email: <code>{html.escape(email)}</code>",
+    lines = [
+        "📄 <b>Список на удаление</b>",
+        f"Файл: <code>{html.escape(document.file_name or '-')}</code>",
+        f"Email к удалению: <code>{len(emails)}</code>",
+        f"Дубликатов: <code>{duplicates}</code> | некорректных: <code>{len(invalid)}</code>",
+    ]
+    if invalid:
+        preview = ", ".join(html.escape(shorten(item, 40)) for item in invalid[:BULK_DELETE_FAILURE_PREVIEW])
+        lines.append(f"Пропущены: <code>{preview}</code>")
+    if not emails:
+        lines.append("")
+        lines.append("В файле нет корректных email.")
+        await send_pretty_message(update, "\n".join(lines))
+        return
+    if len(emails) > BULK_DELETE_MAX_EMAILS:
+        lines.append("")
+        lines.append(f"⚠️ Больше {BULK_DELETE_MAX_EMAILS} email за раз не удаляется, разбейте файл.")
+        await send_pretty_message(update, "\n".join(lines))
+        return
+
+    jobs = cleanup_bulk_delete_jobs(context.application)
+    job_id = uuid.uuid4().hex[:12]
+    jobs[job_id] = {"emails": emails, "chat_id": chat.id, "created_at": time.monotonic()}
+    lines.append("")
+    lines.append("Пользователи, их песни и файлы будут удалены без возможности восстановления.")
+    keyboard = InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    f"🗑️ Удалить {len(emails)}",
+                    callback_data=f"{BULK_DELETE_CALLBACK_PREFIX}run:{job_id}",
+                ),
+                InlineKeyboardButton("Отмена", callback_data=f"{BULK_DELETE_CALLBACK_PREFIX}cancel:{job_id}"),
+            ]
+        ]
     )
+    await message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=keyboard)
 
-    try:
-        payload = await delete_user_profile_by_email(email)
-        summary = payload.get("summary") if isinstance(payload.get("summary"), dict) else {}
 
-        await send_pretty_message(
-            update,
-            "✅ <b>Пользователь удален</b>\n"
-            f"Email: <code>{html.escape(str(payload.get('email', email)))}</code>\n"
-            f"ID: <code>{html.escape(str(payload.get('user_id', '-')))}</code>\n"
-            f"Кандидатов песен: <code>{html.escape(str(summary.get('candidate_songs', 0)))}</code>\n"
-            f"Удалено песен: <code>{html.escape(str(summary.get('deleted_songs', 0)))}</code>\n"
-            f"Удалено файлов: <code>{html.escape(str(summary.get('deleted_files', 0)))}</code>\n"
-            f"Ошибок удаления файлов: <code>{html.escape(str(summary.get('file_delete_errors', 0)))}</code>",
-        )
-    except Exception as exc:
-        logger.exception("Ошибка удаления пользователя email=%s", email)
-        await send_pretty_message(
-            update,
-            "🚨 <b>Ошибка удаления пользователя</b>\n"
-            f"<code>{html.escape(str(exc))}</code>",
-        )
+async def handle_bulk_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if query is None or query.data is None:
+        return
 
+    chat = query.message.chat if query.message else None
+    if chat is None:
+        await query.answer()
+        return
 
-async def cmd_purge_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat = update.effective_chat
-    if update.message is None or chat is None:
+    if not is_chat_allowed(chat.id) or not is_deploy_chat_allowed(chat.id):
+        await query.answer("Доступ запрещен", show_alert=True)
         return
 
-    if not is_chat_allowed(chat.id):
-        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
+    _, action, job_id = query.data.split(":", 2)
+    jobs = cleanup_bulk_delete_jobs(context.application)
+    job = jobs.get(job_id)
+    if job is None or job["chat_id"] != chat.id:
+        await query.answer("Список устарел, отправьте файл заново", show_alert=True)
         return
 
-    if not is_deploy_chat_allowed(chat.id):
-        await send_pretty_message(update, "⛔ <b>Массовое удаление запрещено для этого чата</b>")
+    if action == "cancel":
+        jobs.pop(job_id, None)
+        await query.answer()
+        await query.edit_message_text("❎ <b>Удаление по списку отменено</b>", parse_mode=ParseMode.HTML)
         return
 
-    register_runtime_chat(context.application, chat.id)
+    lock = context.application.bot_data.setdefault("bulk_delete_lock", asyncio.Lock())
+    if lock.locked() or is_purge_busy(context.application):
+        await query.answer("Уже выполняется другое массовое удаление", show_alert=True)
+        return
 
-    confirmation = context.args[0].strip().upper() if context.args else ""
-    if confirmation != "CONFIRM":
-        await send_pretty_message(
-            update,
-            "⚠️ <b>Команда опасна</b>\n"
-            "Это удалит всех пользователей и их песни через API.\n\n"
-            "Запуск: <code>/purge_all_users CONFIRM</code>",
+    # Блокировка берется сразу после проверки, до первого await: двойное нажатие
+    # «подтвердить» (или другой список) не запустит второй прогон удаления.
+    async with lock:
+        jobs.pop(job_id, None)
+        await query.answer()
+        emails: list[str] = job["emails"]
+        result: dict[str, Any] = {
+            "processed": 0,
+            "deleted": 0,
+            "not_found": 0,
+            "deleted_songs": 0,
+            "deleted_files": 0,
+            "file_delete_errors": 0,
+            "failures": [],
+        }
+
+        def on_result(email: str, payload: Optional[dict[str, Any]], error: Optional[Exception]) -> None:
+            result["processed"] += 1
+            if error is not None:
+                if isinstance(error, BackendHTTPError) and error.status_code == 404:
+                    result["not_found"] += 1
+                    forget_indexed_email(context.application, email)
+                else:
+                    result["failures"].append((email, str(error)))
+                return
+            forget_indexed_email(context.application, email)
+            summary = payload.get("summary") if isinstance(payload.get("summary"), dict) else {}
+            result["deleted"] += 1
+            result["deleted_songs"] += int(summary.get("deleted_songs", 0) or 0)
+            result["deleted_files"] += int(summary.get("deleted_files", 0) or 0)
+            result["file_delete_errors"] += int(summary.get("file_delete_errors", 0) or 0)
+
+        async def report_progress() -> None:
+            while True:
+                await asyncio.sleep(BULK_DELETE_PROGRESS_INTERVAL_SECONDS)
+                try:
+                    await query.edit_message_text(
+                        format_bulk_delete_result(result, len(emails), finished=False),
+                        parse_mode=ParseMode.HTML,
+                    )
+                except BadRequest:
+                    pass
+
+        await query.edit_message_text(
+            format_bulk_delete_result(result, len(emails), finished=False),
+            parse_mode=ParseMode.HTML,
         )
-        return
+        reporter = asyncio.create_task(report_progress())
+        try:
+            await run_delete_pool(emails, BULK_DELETE_CONCURRENCY, on_result)
+        finally:
+            reporter.cancel()
+            try:
+                await reporter
+            except asyncio.CancelledError:
+                pass
+            forget_deleted_users(context.application)
 
-    await send_pretty_message(
-        update,
-        "🧹 <b>Запускаю массовое удаление через API</b>\n"
-        "Удаляю всех пользователей, их песни и файлы.",
+        text = format_bulk_delete_result(result, len(emails), finished=True)
+        try:
+            await query.edit_message_text(text, parse_mode=ParseMode.HTML)
+        except BadRequest:
+            pass
+        if len(result["failures"]) > BULK_DELETE_FAILURE_PREVIEW and query.message is not None:
+            report = "\n".join(f"{email}\t{reason}" for email, reason in result["failures"])
+            await query.message.reply_document(
+                document=report.encode("utf-8"),
+                filename="bulk-delete-failures.tsv",
+                caption=f"Ошибки удаления: {len(result['failures'])}",
+            )
+
+
+def format_latency_ms(value: float) -> str:
+    if value >= 1000:
+        return f"{value / 1000:.1f}s"
+    if value >= 10:
+        return f"{value:.0f}ms"
+    return f"{value:.1f}ms"
+
+
+def format_bot_stats(application: Application) -> str:
+    groups = (
+        ("Хендлеры", "handler "),
+        ("Backend", "backend"),
+        ("БД", "db "),
+        ("Telegram API", "telegram "),
     )
+    lines = ["📈 <b>Статистика бота</b>"]
+    started_at = application.bot_data.get("bot_started_at")
+    if started_at:
+        lines.append(f"Аптайм: <code>{format_duration(now_utc_ts() - float(started_at))}</code>")
+
+    for title, prefix in groups:
+        rows = sorted(
+            ((name, hist) for name, hist in LATENCY_HISTOGRAMS.items() if name.startswith(prefix)),
+            key=lambda item: item[1].count,
+            reverse=True,
+        )
+        if not rows:
+            continue
+        table = [f"{'':<24} {'n':>6} {'err':>5} {'p50':>7} {'p95':>7} {'p99':>7}"]
+        for name, hist in rows[:BOTSTATS_MAX_ROWS]:
+            error_rate = f"{hist.errors * 100 / hist.count:.0f}%" if hist.count else "-"
+            table.append(
+                f"{shorten(name[len(prefix):].strip() or name, 24):<24} {hist.count:>6} {error_rate:>5} "
+                f"{format_latency_ms(hist.percentile(0.50)):>7} "
+                f"{format_latency_ms(hist.percentile(0.95)):>7} "
+                f"{format_latency_ms(hist.percentile(0.99)):>7}"
+            )
+        lines.append("")
+        lines.append(f"<b>{title}</b>")
+        lines.append(f"<pre>{html.escape(chr(10).join(table))}</pre>")
 
-    try:
-        payload = await purge_all_users_via_api()
-        totals = payload.get("totals") if isinstance(payload.get("totals"), dict) else {}
-        failures = payload.get("failures") if isinstance(payload.get("failures"), list) else []
-        failed_preview = ""
-        if failures:
-            preview_lines = []
-            for item in failures[:3]:
-                if not isinstance(item, dict):
-                    continue
-                email = html.escape(str(item.get("email", "-")))
-                reason = html.escape(str(item.get("error", "-")))
-                preview_lines.append(f"• <code>{email}</code>: {reason}")
-            if preview_lines:
-                failed_preview = "\n\nПервые ошибки:\n" + "\n".join(preview_lines)
+    processor = application.update_processor
+    if isinstance(processor, PrioritizedUpdateProcessor):
+        update_stats = processor.stats()
+        processed = update_stats["processed"]
+        lines.append("")
+        lines.append("<b>Апдейты</b>")
+        lines.append(
+            f"Обработчики: <code>{update_stats['active']}/{update_stats['workers']}</code>, "
+            f"в очереди: <code>{update_stats['queued']}</code>, "
+            f"склеено кликов: <code>{update_stats['coalesced']}</code>"
+        )
+        lines.append(
+            "control/alerts/browsing: "
+            f"<code>{processed['control']}/{processed['alerts']}/{processed['browsing']}</code>"
+        )
 
-        await send_pretty_message(
-            update,
-            "✅ <b>Массовое удаление завершено</b>\n"
-            f"Обработано: <code>{html.escape(str(payload.get('processed_users', 0)))}</code>\n"
-            f"Удалено пользователей: <code>{html.escape(str(payload.get('deleted_users', 0)))}</code>\n"
-            f"Ошибок: <code>{html.escape(str(payload.get('failed_users', 0)))}</code>\n"
-            f"Удалено песен: <code>{html.escape(str(totals.get('deleted_songs', 0)))}</code>\n"
-            f"Удалено файлов: <code>{html.escape(str(totals.get('deleted_files', 0)))}</code>\n"
-            f"Осталось пользователей: <code>{html.escape(str(payload.get('remaining_users', 0)))}</code>\n"
-            f"Осталось песен: <code>{html.escape(str(payload.get('remaining_songs', 0)))}</code>"
-            f"{failed_preview}",
+    lines.append("")
+    lines.append("<b>Зависимости</b>")
+    for guard in (*(target.guard for target in BACKEND_TARGETS), DB_GUARD):
+        state = guard.state
+        if state == "open":
+            state = f"open, повтор через {guard.retry_in():.0f} с"
+        lines.append(
+            f"{guard.name}: <code>{state}</code>, в работе <code>{guard.in_flight}/{guard.limit}</code>, "
+            f"отклонено <code>{guard.rejected}</code>"
         )
-    except Exception as exc:
-        logger.exception("Ошибка массового удаления пользователей")
-        await send_pretty_message(
-            update,
-            "🚨 <b>Ошибка массового удаления</b>\n"
-            f"<code>{html.escape(str(exc))}</code>",
+
+    cache_stats = user_cache_stats(application)
+    index = get_email_index(application)
+    request_counters = application.bot_data.get("chat_request_counters") or {"folded": 0, "cached": 0}
+    lines.append("")
+    lines.append("<b>Кэши</b>")
+    lines.append(
+        f"Повторные нажатия меню: склеено <code>{request_counters['folded']}</code>, "
+        f"из кэша <code>{request_counters['cached']}</code>"
+    )
+    lines.append(
+        f"Пользователи: <code>{cache_stats['size']}</code> записей, "
+        f"hit rate <code>{cache_stats['hit_rate'] * 100:.0f}%</code> "
+        f"({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})"
+    )
+    lines.append(f"Страницы: <code>{len(application.bot_data.get('page_cache') or {})}</code> записей")
+    if index is not None:
+        lines.append(
+            f"Индекс email: <code>{len(index)}</code> пользователей, ~<code>{format_bytes(index.memory_bytes())}</code>"
         )
+    return "\n".join(lines)
+
+
+async def cmd_botstats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat = update.effective_chat
+    if update.message is None or chat is None:
+        return
+
+    if not is_chat_allowed(chat.id):
+        await send_pretty_message(update, "⛔ <b>Доступ запрещен для этого чата</b>")
+        return
+
+    register_runtime_chat(context.application, chat.id)
+    await send_pretty_message(update, format_bot_stats(context.application))
 
 
 async def cmd_snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await send_snapshot(update, context)
+    ok, target = await resolve_target_arg(update, context)
+    if not ok:
+        return
+    if target is None and is_multi_target():
+        await send_targets_overview(update, context)
+        return
+    await send_snapshot(update, context, target)
 
 
 async def cmd_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1721,6 +6085,14 @@ async def cmd_deploy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     )
 
     async with lock:
+        # Деплой может перезапустить самого бота: отметка пишется сразу, без write-behind.
+        context.application.bot_data["deploy_state"] = {
+            "branch": branch,
+            "chat_id": chat.id,
+            "started_at": now_utc_ts(),
+        }
+        mark_state_dirty(context.application, "deploy")
+        await flush_bot_state(context.application)
         try:
             return_code, stdout, stderr = await run_deploy_script(branch)
             stdout_main, stdout_tests = split_deploy_stdout(stdout)
@@ -1758,6 +6130,9 @@ async def cmd_deploy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
                 "🚨 <b>Ошибка запуска деплоя</b>\n"
                 f"<code>{html.escape(str(exc))}</code>",
             )
+        finally:
+            context.application.bot_data["deploy_state"] = None
+            mark_state_dirty(context.application, "deploy")
 
 
 async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1788,7 +6163,11 @@ async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     if text == MENU_BUTTON_SNAPSHOT:
-        await send_snapshot(update, context)
+        await cmd_snapshot(update, context)
+        return
+
+    if text == MENU_BUTTON_STATUS:
+        await cmd_status(update, context)
         return
 
     if text == MENU_BUTTON_DEPLOY:
@@ -1813,11 +6192,14 @@ async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 async def broadcast_alert(application: Application, text: str) -> None:
+    if not ALERTS_ENABLED:
+        return
     recipients = resolve_alert_recipients(application)
     if not recipients:
         logger.warning("Не заданы получатели для алертов")
         return
 
+    counters = application.bot_data.setdefault("alert_counters", {"sent": 0, "failed": 0})
     for chat_id in recipients:
         try:
             await application.bot.send_message(
@@ -1826,7 +6208,9 @@ async def broadcast_alert(application: Application, text: str) -> None:
                 parse_mode=ParseMode.HTML,
                 disable_web_page_preview=True,
             )
+            counters["sent"] += 1
         except Exception:
+            counters["failed"] += 1
             logger.exception("Не удалось отправить алерт chat_id=%s", chat_id)
 
 
@@ -1834,114 +6218,315 @@ def now_utc() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
 
 
-async def watchdog_loop(application: Application) -> None:
-    previous_backend_state: Optional[bool] = None
-    previous_issue_states: dict[str, str] = {}
+def restore_target_watchdog_states(application: Application) -> dict[str, dict[str, Any]]:
+    # После перезапуска продолжаем с сохраненного состояния, чтобы активные алерты не повторялись.
+    # Состояние до появления нескольких целей (backend_up/issues в корне) относится к основной.
+    restored = application.bot_data.get("watchdog_state") or {}
+    raw_targets = restored.get("targets")
+    if not isinstance(raw_targets, dict):
+        raw_targets = {PRIMARY_TARGET.name: restored}
 
-    while True:
-        is_up, detail = await check_backend_health()
-        application.bot_data["backend_is_up"] = is_up
-        application.bot_data["backend_health_detail"] = detail
-
-        if previous_backend_state is None:
-            if ALERT_NOTIFY_ON_START:
-                startup_text = (
-                    "✅ <b>Мониторинг запущен</b>\n"
-                    f"🕒 <code>{now_utc()}</code>\n"
-                    f"🔎 Проверка: <code>{html.escape(BACKEND_HEALTH_PATH)}</code>\n"
-                    f"📡 Статус backend: <b>{'UP' if is_up else 'DOWN'}</b>\n"
-                    f"ℹ️ Детали: <code>{html.escape(detail)}</code>"
-                )
-                await broadcast_alert(application, startup_text)
-        elif previous_backend_state and not is_up:
-            alert_text = (
-                "🚨 <b>CloudTune Alert: BACKEND НЕДОСТУПЕН</b>\n"
-                f"🕒 <code>{now_utc()}</code>\n"
-                f"🔎 Проверка: <code>{html.escape(BACKEND_HEALTH_PATH)}</code>\n"
-                f"ℹ️ Детали: <code>{html.escape(detail)}</code>"
-            )
-            await broadcast_alert(application, alert_text)
-        elif not previous_backend_state and is_up:
-            recovery_text = (
-                "✅ <b>CloudTune Alert: BACKEND ВОССТАНОВЛЕН</b>\n"
+    states: dict[str, dict[str, Any]] = {}
+    for target in BACKEND_TARGETS:
+        raw = raw_targets.get(target.name)
+        if not isinstance(raw, dict):
+            continue
+        backend_up = raw.get("backend_up")
+        issues = raw.get("issues")
+        states[target.name] = {
+            "backend_up": backend_up if isinstance(backend_up, bool) else None,
+            "issues": (
+                {str(key): str(value) for key, value in issues.items()}
+                if isinstance(issues, dict)
+                else {}
+            ),
+        }
+    return states
+
+
+async def watch_target(
+    application: Application,
+    target: BackendTarget,
+    previous: dict[str, Any],
+) -> dict[str, Any]:
+    previous_backend_state: Optional[bool] = previous.get("backend_up")
+    previous_issue_states: dict[str, str] = previous.get("issues") or {}
+    target_line = format_target_line(target)
+
+    is_up, detail = await check_backend_health(target)
+    application.bot_data.setdefault("target_health", {})[target.name] = (is_up, detail)
+
+    if previous_backend_state is None:
+        if ALERT_NOTIFY_ON_START:
+            startup_text = (
+                "✅ <b>Мониторинг запущен</b>\n"
+                f"{target_line}"
                 f"🕒 <code>{now_utc()}</code>\n"
                 f"🔎 Проверка: <code>{html.escape(BACKEND_HEALTH_PATH)}</code>\n"
+                f"📡 Статус backend: <b>{'UP' if is_up else 'DOWN'}</b>\n"
                 f"ℹ️ Детали: <code>{html.escape(detail)}</code>"
             )
-            await broadcast_alert(application, recovery_text)
-
-        previous_backend_state = is_up
+            await broadcast_alert(application, startup_text)
+    elif previous_backend_state and not is_up:
+        alert_text = (
+            "🚨 <b>CloudTune Alert: BACKEND НЕДОСТУПЕН</b>\n"
+            f"{target_line}"
+            f"🕒 <code>{now_utc()}</code>\n"
+            f"🔎 Проверка: <code>{html.escape(BACKEND_HEALTH_PATH)}</code>\n"
+            f"ℹ️ Детали: <code>{html.escape(detail)}</code>"
+        )
+        await broadcast_alert(application, alert_text)
+    elif not previous_backend_state and is_up:
+        recovery_text = (
+            "✅ <b>CloudTune Alert: BACKEND ВОССТАНОВЛЕН</b>\n"
+            f"{target_line}"
+            f"🕒 <code>{now_utc()}</code>\n"
+            f"🔎 Проверка: <code>{html.escape(BACKEND_HEALTH_PATH)}</code>\n"
+            f"ℹ️ Детали: <code>{html.escape(detail)}</code>"
+        )
+        await broadcast_alert(application, recovery_text)
 
-        # Пороговые алерты доступны, только если backend сейчас отвечает.
-        if is_up:
-            try:
-                snapshot = await fetch_snapshot()
-                current_issues = build_threshold_issues(snapshot)
-
-                for issue_key, issue_text in current_issues.items():
-                    prev_text = previous_issue_states.get(issue_key)
-                    if prev_text != issue_text:
-                        await broadcast_alert(
-                            application,
-                            "⚠️ <b>Порог мониторинга превышен</b>\n"
-                            f"🕒 <code>{now_utc()}</code>\n"
-                            f"ℹ️ <code>{html.escape(issue_text)}</code>",
-                        )
-
-                for recovered_key in set(previous_issue_states.keys()) - set(current_issues.keys()):
-                    await broadcast_alert(
-                        application,
-                        "✅ <b>Порог мониторинга восстановлен</b>\n"
-                        f"🕒 <code>{now_utc()}</code>\n"
-                        f"ℹ️ <code>{html.escape(recovered_key)}</code>",
-                    )
+    # Пороговые алерты доступны, только если backend сейчас отвечает.
+    if not is_up:
+        return {"backend_up": is_up, "issues": {}}
 
-                previous_issue_states = current_issues
-            except Exception as exc:
-                logger.exception("Ошибка получения snapshot в watchdog")
+    try:
+        snapshot = await fetch_snapshot(allow_stale=False, target=target)
+        tick_ts = now_utc_ts()
+        application.bot_data.setdefault("target_snapshots", {})[target.name] = (tick_ts, snapshot)
+        current_issues = build_threshold_issues(snapshot, target.thresholds)
+        # История, прогноз диска, аномалии и утечки ведутся по основной цели:
+        # локальное хранилище метрик хранит один ряд.
+        if target is PRIMARY_TARGET:
+            enqueue_metrics_snapshot(application, snapshot, tick_ts)
+            record_storage_sample(application, snapshot, tick_ts)
+            current_issues.update(build_forecast_issues(build_disk_forecast(application)))
+            current_issues.update(build_anomaly_issues(application, snapshot, tick_ts))
+            record_leak_sample(application, snapshot, tick_ts)
+            current_issues.update(build_leak_issues(application))
+
+        for issue_key, issue_text in current_issues.items():
+            prev_text = previous_issue_states.get(issue_key)
+            if prev_text != issue_text:
                 await broadcast_alert(
                     application,
-                    "⚠️ <b>Ошибка расширенного мониторинга</b>\n"
+                    "⚠️ <b>Порог мониторинга превышен</b>\n"
+                    f"{target_line}"
                     f"🕒 <code>{now_utc()}</code>\n"
-                    f"ℹ️ <code>{html.escape(str(exc))}</code>",
+                    f"ℹ️ <code>{html.escape(issue_text)}</code>",
                 )
-                previous_issue_states = {}
-        else:
-            previous_issue_states = {}
 
+        for recovered_key in set(previous_issue_states.keys()) - set(current_issues.keys()):
+            await broadcast_alert(
+                application,
+                "✅ <b>Порог мониторинга восстановлен</b>\n"
+                f"{target_line}"
+                f"🕒 <code>{now_utc()}</code>\n"
+                f"ℹ️ <code>{html.escape(recovered_key)}</code>",
+            )
+        return {"backend_up": is_up, "issues": current_issues}
+    except Exception as exc:
+        logger.exception("Ошибка получения snapshot в watchdog: target=%s", target.name)
+        await broadcast_alert(
+            application,
+            "⚠️ <b>Ошибка расширенного мониторинга</b>\n"
+            f"{target_line}"
+            f"🕒 <code>{now_utc()}</code>\n"
+            f"ℹ️ <code>{html.escape(str(exc))}</code>",
+        )
+        return {"backend_up": is_up, "issues": {}}
+
+
+async def watchdog_loop(application: Application) -> None:
+    # Все цели опрашиваются параллельно; состояние каждой живет отдельно, так что сбой
+    # или перезапуск опроса одного узла не сбрасывает активные алерты других.
+    states = restore_target_watchdog_states(application)
+    while True:
+        results = await asyncio.gather(
+            *(watch_target(application, target, states.get(target.name) or {}) for target in BACKEND_TARGETS),
+            return_exceptions=True,
+        )
+        for target, result in zip(BACKEND_TARGETS, results):
+            if isinstance(result, BaseException):
+                logger.error("Watchdog: ошибка опроса цели %s: %s", target.name, result)
+                continue
+            states[target.name] = result
+
+        remember_watchdog_state(application, states)
         await asyncio.sleep(max(ALERT_CHECK_INTERVAL_SECONDS, 60))
 
 
 async def on_startup(application: Application) -> None:
-    if not ALERTS_ENABLED:
-        logger.info("Алерты отключены: ALERTS_ENABLED=false")
-        return
+    application.bot_data["bot_started_at"] = now_utc_ts()
+    if BOT_STATE_ENABLED:
+        try:
+            application.bot_data["bot_state_store"] = await asyncio.to_thread(BotStateStore, BOT_STATE_PATH)
+            await restore_bot_state(application)
+            application.bot_data["bot_state_task"] = asyncio.create_task(bot_state_writer_loop(application))
+            await notify_interrupted_deploy(application)
+        except Exception:
+            logger.exception("Не удалось открыть хранилище состояния %s", BOT_STATE_PATH)
 
+    if METRICS_STORE_ENABLED:
+        try:
+            application.bot_data["metrics_store"] = await asyncio.to_thread(MetricsStore, METRICS_DB_PATH)
+            await restore_metrics_history(application)
+            application.bot_data["metrics_writer_task"] = asyncio.create_task(
+                metrics_writer_loop(application)
+            )
+            logger.info("История метрик: %s", METRICS_DB_PATH)
+        except Exception:
+            logger.exception("Не удалось открыть хранилище метрик %s", METRICS_DB_PATH)
+
+    application.bot_data["user_usage_sampler_task"] = asyncio.create_task(
+        user_usage_sampler_loop(application)
+    )
+    if EMAIL_INDEX_ENABLED:
+        application.bot_data["email_index_task"] = asyncio.create_task(email_index_loop(application))
+    if METRICS_EXPORTER_ENABLED:
+        try:
+            await start_metrics_exporter(application)
+        except OSError:
+            logger.exception(
+                "Не удалось запустить OpenMetrics exporter на %s:%s",
+                METRICS_EXPORTER_HOST,
+                METRICS_EXPORTER_PORT,
+            )
+    await resume_purge(application)
+
+    # Watchdog работает всегда: он же собирает историю для /history, /chart и прогноза диска.
+    # ALERTS_ENABLED=false только глушит отправку алертов.
     task = asyncio.create_task(watchdog_loop(application))
     application.bot_data["watchdog_task"] = task
-    logger.info("Watchdog запущен: interval=%s сек", ALERT_CHECK_INTERVAL_SECONDS)
+    logger.info(
+        "Watchdog запущен: interval=%s сек, алерты %s",
+        ALERT_CHECK_INTERVAL_SECONDS,
+        "включены" if ALERTS_ENABLED else "отключены (ALERTS_ENABLED=false)",
+    )
 
 
 async def on_shutdown(application: Application) -> None:
-    task = application.bot_data.get("watchdog_task")
-    if task is None:
-        return
+    for task_key in (
+        "watchdog_task",
+        "user_usage_sampler_task",
+        "metrics_writer_task",
+        "live_task",
+        "email_index_task",
+        "purge_task",
+        "bot_state_task",
+    ):
+        task = application.bot_data.get(task_key)
+        if task is None:
+            continue
 
-    task.cancel()
-    try:
-        await task
-    except asyncio.CancelledError:
-        pass
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    for task in (application.bot_data.get("background_jobs") or {}).values():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    store = get_metrics_store(application)
+    if store is not None:
+        await flush_metrics_buffer(application)
+        await asyncio.to_thread(store.close)
+
+    exporter = application.bot_data.get("metrics_exporter_server")
+    if exporter is not None:
+        exporter.close()
+        await exporter.wait_closed()
+
+    await BACKEND_HTTP.aclose()
+
+    cache_stats = user_cache_stats(application)
+    logger.info(
+        "Кэш пользователей: hits=%s misses=%s hit_rate=%.0f%%",
+        cache_stats["hits"],
+        cache_stats["misses"],
+        cache_stats["hit_rate"] * 100,
+    )
+
+    state_store = get_bot_state_store(application)
+    if state_store is not None:
+        await flush_bot_state(application)
+        await asyncio.to_thread(state_store.close)
 
 
 def validate_config() -> Optional[str]:
     if not TELEGRAM_BOT_TOKEN:
         return "TELEGRAM_BOT_TOKEN is required"
-    if not BACKEND_MONITORING_API_KEY:
-        return "BACKEND_MONITORING_API_KEY is required"
+    if BACKEND_TARGETS_INVALID:
+        invalid = ", ".join(BACKEND_TARGETS_INVALID)
+        return f"BACKEND_TARGETS: invalid entries {invalid} (expected name=http(s)://host)"
+    names = [target.name for target in BACKEND_TARGETS]
+    if len(set(names)) != len(names):
+        return "BACKEND_TARGETS: target names must be unique"
+    for target in BACKEND_TARGETS:
+        if not target.api_key:
+            if len(BACKEND_TARGETS) == 1:
+                return "BACKEND_MONITORING_API_KEY is required"
+            return (
+                f"BACKEND_{target.name.upper().replace('-', '_')}_MONITORING_API_KEY "
+                "or BACKEND_MONITORING_API_KEY is required"
+            )
+    if WEBHOOK_ENABLED and not WEBHOOK_SECRET_RE.match(WEBHOOK_SECRET_TOKEN):
+        return "WEBHOOK_SECRET_TOKEN is required in webhook mode (1-256 chars: A-Z, a-z, 0-9, _ and -)"
     return None
 
 
+async def run_webhook(application: Application) -> None:
+    # Свой минимальный HTTP-сервер вместо Application.run_webhook: не нужен extra
+    # python-telegram-bot[webhooks], а post_init/post_shutdown вызываются как в polling.
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_webhook_request(application, reader, writer),
+        host=WEBHOOK_LISTEN_HOST,
+        port=WEBHOOK_LISTEN_PORT,
+    )
+    try:
+        if WEBHOOK_PUBLIC_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_PUBLIC_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            logger.warning("WEBHOOK_PUBLIC_URL не задан: setWebhook не вызывается (локальный режим)")
+        await application.start()
+        logger.info(
+            "Webhook слушает http://%s:%s%s",
+            WEBHOOK_LISTEN_HOST,
+            WEBHOOK_LISTEN_PORT,
+            WEBHOOK_PATH,
+        )
+        await stop_event.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        if application.running:
+            await application.stop()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+
 def main() -> None:
     config_error = validate_config()
     if config_error:
@@ -1950,7 +6535,10 @@ def main() -> None:
     app = (
         Application.builder()
         .token(TELEGRAM_BOT_TOKEN)
-        .concurrent_updates(True)
+        .request(InstrumentedHTTPXRequest(connection_pool_size=256))
+        .concurrent_updates(
+            PrioritizedUpdateProcessor(UPDATE_WORKERS, UPDATE_RESERVED_WORKERS, UPDATE_QUEUE_LIMIT)
+        )
         .post_init(on_startup)
         .post_shutdown(on_shutdown)
         .build()
@@ -1965,17 +6553,35 @@ def main() -> None:
     app.add_handler(CommandHandler("users", cmd_users))
     app.add_handler(CommandHandler("files", cmd_files))
     app.add_handler(CommandHandler("user", cmd_user))
+    app.add_handler(CommandHandler("find", cmd_find))
+    app.add_handler(CommandHandler("export", cmd_export))
     app.add_handler(CommandHandler("delete_user", cmd_delete_user))
     app.add_handler(CommandHandler("purge_all_users", cmd_purge_all_users))
+    app.add_handler(CommandHandler("live", cmd_live))
+    app.add_handler(CommandHandler("history", cmd_history))
+    app.add_handler(CommandHandler("chart", cmd_chart))
+    app.add_handler(CommandHandler("top_users", cmd_top_users))
+    app.add_handler(CommandHandler("reconcile", cmd_reconcile))
+    app.add_handler(CommandHandler("botstats", cmd_botstats))
     app.add_handler(CommandHandler("snapshot", cmd_snapshot))
     app.add_handler(CommandHandler("all", cmd_all))
     app.add_handler(CommandHandler("deploy", cmd_deploy))
     app.add_handler(CallbackQueryHandler(handle_users_page_callback, pattern=r"^users_page:\d+$"))
     app.add_handler(CallbackQueryHandler(handle_files_page_callback, pattern=r"^files_page:\d+$"))
     app.add_handler(CallbackQueryHandler(handle_user_callback, pattern=r"^user:"))
+    app.add_handler(
+        CallbackQueryHandler(handle_bulk_delete_callback, pattern=r"^bulk_delete:(run|cancel):[0-9a-f]+$")
+    )
+    app.add_handler(InlineQueryHandler(handle_inline_query))
+    app.add_handler(MessageHandler(BULK_DELETE_DOCUMENT_FILTER, handle_bulk_delete_document))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu_buttons))
 
+    instrument_handlers(app)
+
     logger.info("Запуск CloudTune monitoring bot")
+    if WEBHOOK_ENABLED:
+        asyncio.run(run_webhook(app))
+        return
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 